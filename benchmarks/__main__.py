@@ -0,0 +1,5 @@
+from __future__ import unicode_literals, print_function
+
+from .checks import main
+
+main()
@@ -0,0 +1,490 @@
+from __future__ import unicode_literals, print_function
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import six
+from fabric.api import hide, settings
+
+from vps_tools.redaction import RedactingStream, redacting
+from vps_tools.transport import script_command, use_transport
+from vps_tools.utils import port_registry_script
+from vps_tools.hmara import main as hmara_main
+# commands run in temporary folder, import everything before chdir
+from vps_tools import project, config, domains, service, pg, pg_store, ports, status, logs, stats, rolling, \
+    bluegreen  # noqa
+
+from .fake_server import FAKE_DUMP, FakeServer
+
+__all__ = ['STARTUP_BUDGETS', 'STARTUP_FORBIDDEN_MODULES', 'COMMANDS', 'SCALING_COMMANDS', 'SCALING_PROJECTS',
+           'REDACTION_MIN_THROUGHPUT', 'REDACTION_SECRET_COUNTS', 'measure_startup', 'check_startup',
+           'allowed_round_trips', 'measure_command', 'check_commands', 'check_registry', 'measure_redaction',
+           'check_redaction', 'main']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# median wall time in seconds of a cold `hmara <command>` process, interpreter start included
+STARTUP_BUDGETS = [
+    (['version'], 0.15),
+    (['agent', 'status'], 0.15),
+]
+# modules light commands must not import
+STARTUP_FORBIDDEN_MODULES = ['fabric.api', 'paramiko', 'storm', 'git', 'vps_tools.project', 'vps_tools.utils']
+
+startup_code = """import json, sys
+from vps_tools.hmara import main
+try:
+    main(sys.argv[1:])
+finally:
+    sys.stderr.write('@@' + json.dumps(sorted(m for m in {forbidden!r} if m in sys.modules)) + '\\n')
+"""
+
+
+def measure_startup(argv, runs=5):
+    """
+    Run `hmara argv` in fresh interpreters, return median wall time and forbidden modules it imported.
+    """
+    code = startup_code.format(forbidden=[str(m) for m in STARTUP_FORBIDDEN_MODULES])
+    environ = dict(os.environ, HMARA_NO_AGENT='1', PYTHONPATH=ROOT)
+    timings = []
+    imported = []
+    for _ in range(runs):
+        started = time.time()
+        process = subprocess.Popen([sys.executable, '-c', code] + list(argv), env=environ,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = process.communicate()
+        timings.append(time.time() - started)
+        for line in err.decode('utf-8', 'replace').splitlines():
+            if line.startswith('@@'):
+                imported = json.loads(line[2:])
+    timings.sort()
+    return timings[len(timings) // 2], imported
+
+
+def check_startup(runs=5):
+    """
+    Measure every command from STARTUP_BUDGETS, print report and return True when all are within budget.
+    """
+    ok = True
+    for argv, budget in STARTUP_BUDGETS:
+        elapsed, imported = measure_startup(argv, runs)
+        passed = elapsed <= budget and not imported
+        ok = ok and passed
+        print('{:<5} hmara {:<20} {:>6.3f}s (budget {:.3f}s){}'.format(
+            'ok' if passed else 'FAIL', ' '.join(argv), elapsed, budget,
+            ', imports {}'.format(', '.join(imported)) if imported else ''))
+    return ok
+
+
+# expectations on state of fake host after command: (description, check taking server, output and local files)
+def output_has(text, present=True):
+    return '{}"{}" in output'.format('' if present else 'no ', text), \
+        lambda server, output, local_files: (text in output) == present
+
+
+def running(program):
+    return 'program {} running'.format(program), \
+        lambda server, output, local_files: server.programs.get(program) == 'RUNNING'
+
+
+def has_program(program, present=True):
+    return '{}program {}'.format('' if present else 'no ', program), \
+        lambda server, output, local_files: (program in server.programs) == present
+
+
+def serving(project_name):
+    return '{} answering on PORT of its .env'.format(project_name), \
+        lambda server, output, local_files: server.serving(server.env(project_name).get('PORT'))
+
+
+def proxied(project_name):
+    return 'nginx of {} proxying to running program'.format(project_name), \
+        lambda server, output, local_files: server.serving(re.search(
+            r'proxy_pass http://127\.0\.0\.1:(\d+);', server.cat('/etc/nginx/sites-available/' + project_name)
+            + 'proxy_pass http://127.0.0.1:0;').group(1))
+
+
+def started_by_supervisor(program, present=True):
+    return '{}program {} started by supervisor reload'.format('' if present else 'no ', program), \
+        lambda server, output, local_files: (program in server.started_by_supervisor()) == present
+
+
+def happened(action, name):
+    return '{} {}'.format(action, name), lambda server, output, local_files: (action, name) in server.events
+
+
+def ran(command):
+    return 'forego run {}'.format(command), lambda server, output, local_files: ('run', command) in server.events
+
+
+def no_restart():
+    return 'no restart', lambda server, output, local_files: not any(
+        event[0] in ('restart', 'stop', 'start') for event in server.events)
+
+
+def nginx_reloaded():
+    return 'nginx reloaded', lambda server, output, local_files: server.nginx_generation > 0
+
+
+def env_value(project_name, name, value):
+    return '{} {}'.format(project_name, '{}={}'.format(name, value) if value is not None else 'without ' + name), \
+        lambda server, output, local_files: server.env(project_name).get(name) == value
+
+
+def has_database(name, present=True):
+    return '{}database {}'.format('' if present else 'no ', name), \
+        lambda server, output, local_files: (name in server.databases) == present
+
+
+def has_port(key, present=True):
+    return '{}port of {}'.format('' if present else 'no ', key), \
+        lambda server, output, local_files: (key in server.ports) == present
+
+
+def has_file(path, present=True):
+    return '{}{} on host'.format('' if present else 'no ', path), \
+        lambda server, output, local_files: server.exists(path) == present
+
+
+def file_has(path, text, present=True):
+    pattern = re.compile(r'(?<![\w.-]){}(?![\w.-])'.format(re.escape(text)))
+    return '{}{} in {}'.format('' if present else 'no ', text, path), \
+        lambda server, output, local_files: bool(pattern.search(server.cat(path))) == present
+
+
+def local_file(path):
+    return 'local {}'.format(path), lambda server, output, local_files: path in local_files
+
+
+# round trips each command takes now against FakeServer, built with keyword arguments of fourth item if any.
+# Check allows a quarter more, at least one, so that a call added for good reason does not need a budget change in
+# the same commit; what this guards against, a call per project, file or domain, grows with the host and is caught
+# by SCALING_COMMANDS below whatever the headroom.
+COMMANDS = [
+    (['project', 'list'], 1, [output_has('app'), output_has('shop')]),
+    (['project', 'create', '--name', 'newapp', '--repo-url', 'git@example.com:newapp.git'], 25,
+     [running('newapp'), serving('newapp'), has_database('newapp'), has_port('newapp'),
+      ran('python manage.py migrate --noinput'), has_file('/etc/nginx/sites-available/newapp')]),
+    (['project', 'deploy', '--name', 'app'], 10,
+     [happened('restart', 'app'), ran('python manage.py collectstatic --noinput'), serving('app'),
+      file_has('/home/app/.deployed_rev', '{:040x}'.format(1))]),
+    (['project', 'deploy', '--name', 'app', '--full'], 12,
+     [happened('pip install', 'app'), ran('python manage.py migrate --noinput'), happened('restart', 'app')]),
+    (['project', 'deploy', '--name', 'app', '--rolling', '--batch', '2'], 13, [happened('restart', 'app'),
+                                                                             serving('app')]),
+    (['project', 'restart', '--name', 'app'], 3, [happened('restart', 'app'), serving('app')]),
+    (['project', 'run', '--name', 'app', '--cmd', 'python', 'manage.py', 'check'], 1,
+     [ran('python manage.py check')]),
+    (['project', 'bluegreen', '--name', 'app'], 6, [running('app_blue'), serving('app'), running('shop')]),
+    (['project', 'restart', '--name', 'app'], 16,
+     [running('app_green'), has_program('app_blue'), proxied('app'), started_by_supervisor('app_green'),
+      started_by_supervisor('app_blue', False), running('shop')], {'bluegreen_projects': ['app']}),
+    (['project', 'destroy', '--name', 'app'], 14,
+     [has_program('app', False), has_database('app', False), has_port('app', False), has_file('/home/app', False),
+      running('shop')]),
+    (['config', 'list', '--name', 'app'], 1, [output_has('SECRET=abc'), output_has('postgres://app:secret@')]),
+    (['config', 'set', '--name', 'app', '--vars', 'DEBUG=1'], 5, [env_value('app', 'DEBUG', '1'),
+                                                                  happened('restart', 'app')]),
+    (['config', 'set', '--name', 'app', '--vars', 'SECRET=abc'], 1, [output_has('postgres://app:secret@'),
+                                                                    no_restart()]),
+    (['config', 'unset', '--name', 'app', '--vars', 'SECRET'], 5, [env_value('app', 'SECRET', None),
+                                                                   happened('restart', 'app')]),
+    (['config', 'list', '--all'], 1, [output_has('PORT=8011'), output_has('PORT=8012')]),
+    (['config', 'set', '--all', '--vars', 'DEBUG=1'], 5,
+     [env_value('app', 'DEBUG', '1'), env_value('shop', 'DEBUG', '1'), happened('restart', 'app'),
+      happened('restart', 'shop')]),
+    (['config', 'unset', '--name', 'app', 'shop', '--vars', 'SECRET'], 5,
+     [env_value('app', 'SECRET', None), env_value('shop', 'SECRET', None)]),
+    (['config', 'versions', '--name', 'app'], 1, [output_has('20200101-000059')]),
+    (['config', 'rollback', '--name', 'app'], 4, [env_value('app', 'SECRET', None), env_value('app', 'PORT', '8011'),
+                                                  happened('restart', 'app')]),
+    (['domain', 'list', '--name', 'app'], 1, [output_has('app.example.com')]),
+    (['domain', 'set', '--name', 'app', 'shop', '--domains', 'example.com'], 13,
+     [file_has('/home/app/.domains', 'example.com'), file_has('/home/shop/.domains', 'example.com'),
+      file_has('/etc/nginx/sites-available/app', 'example.com'), nginx_reloaded()]),
+    (['domain', 'unset', '--name', 'app', '--domains', 'app.example.com'], 8,
+     [file_has('/home/app/.domains', 'app.example.com', False), nginx_reloaded()]),
+    (['service', 'nginx', 'reload'], 1, [nginx_reloaded()]),
+    (['port', 'list'], 1, [output_has('8011 app'), output_has('8012 shop')]),
+    (['port', 'who', '--port', '8011'], 1, [output_has('app')]),
+    (['port', 'prune'], 1, [has_port('old', False), has_port('app'), has_port('shop')]),
+    (['pg', 'dump', '--name', 'app', '--dump', 'app.dump'], 3, [local_file('app.dump')]),
+    (['pg', 'dump', '--name', 'app', '--dump', 'app.dump', '--stream', '--compress', 'gzip'], 2,
+     [local_file('app.dump.gz'), local_file('app.dump.gz.sha256')]),
+    (['pg', 'restore', '--name', 'app'], 11, [happened('restore', 'app'), running('app')]),
+    (['pg', 'restore', '--name', 'app', '--tables', 'shop_order'], 12, [happened('restore', 'app'), running('app')]),
+    (['pg', 'restore', '--name', 'app', '--data-only'], 12, [happened('truncate', 'app'), happened('restore', 'app'),
+                                                            running('app')]),
+    (['pg', 'restore', '--name', 'app', '--shadow'], 14, [happened('swap', 'app_shadow'), has_database('app_prev'),
+                                                         running('app')]),
+    (['pg', 'rollback', '--name', 'app'], 8, [happened('swap', 'app_prev'), running('app')]),
+    (['pg', 'backup', '--all', '--store', 'pg-store'], 3, [local_file('pg-store/snapshots/fake/app'),
+                                                          local_file('pg-store/snapshots/fake/shop')]),
+    (['status', '--ttl', '0'], 1, [output_has('app'), output_has('shop')]),
+    (['logs', '--name', 'app'], 1, [output_has('ValueError: boom')]),
+    (['logs', '--name', 'app', 'shop', '--grep', 'POST', '--since-last'], 1, [output_has('"POST /items/'),
+                                                                            output_has('"GET /items/', False)]),
+    (['stats', '--name', 'app', 'shop'], 1, [output_has('/items/:id/')]),
+]
+# commands over all projects: round trips must be the same on host with many projects as with two. pg backup is
+# not one of them, it streams every database on its own, jobs at once
+SCALING_COMMANDS = [
+    ['project', 'list'],
+    ['config', 'list', '--all'],
+    ['config', 'set', '--all', '--vars', 'DEBUG=1'],
+    ['status', '--ttl', '0'],
+    ['port', 'list'],
+]
+SCALING_PROJECTS = 20
+
+
+def allowed_round_trips(trips):
+    return trips + max(trips // 4, 1)
+
+
+@contextmanager
+def local_state(folder):
+    """
+    Keep log offsets and status cache of command in folder instead of ~/.hmara, so runs do not see each other.
+    """
+    saved = logs.OFFSETS_PATH, status.CACHE_PATH
+    logs.OFFSETS_PATH = os.path.join(folder, 'log-offsets.json')
+    status.CACHE_PATH = os.path.join(folder, 'status.json')
+    try:
+        yield
+    finally:
+        logs.OFFSETS_PATH, status.CACHE_PATH = saved
+
+
+@contextmanager
+def no_drain():
+    """
+    Stop old color of blue/green cutover at once, fake host has no requests in flight.
+    """
+    saved = bluegreen.DRAIN_SECONDS
+    bluegreen.DRAIN_SECONDS = 0
+    try:
+        yield
+    finally:
+        bluegreen.DRAIN_SECONDS = saved
+
+
+def measure_command(argv, server=None, expectations=()):
+    """
+    Run `hmara argv --host fake` against FakeServer in temporary folder. Returns transport stats, wall time,
+    exit code, output and descriptions of expectations which do not hold after the command.
+    """
+    server = server or FakeServer()
+    folder = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    sys.stdout = six.StringIO()
+    code = 0
+    started = time.time()
+    failed = []
+    try:
+        os.chdir(folder)
+        with open('latest.dump', 'wb') as dump_file:
+            dump_file.write(FAKE_DUMP)
+        with use_transport(server.host), hide('running'), settings(ssh_config_path=os.devnull), \
+                local_state(folder), no_drain():
+            # host goes in front of options, as last argument it would be taken by option with many values
+            position = next((index for index, arg in enumerate(argv) if arg.startswith('--')), len(argv))
+            hmara_main(argv[:position] + ['--host', 'fake'] + argv[position:])
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    finally:
+        elapsed = time.time() - started
+        output = sys.stdout.getvalue()
+        sys.stdout = stdout
+        local_files = set(os.path.relpath(os.path.join(path, name), folder)
+                          for path, folders, names in os.walk(folder) for name in folders + names)
+        failed = [description for description, holds in expectations if not holds(server, output, local_files)]
+        failed += ['unknown command {}'.format(command[:80]) for command in server.unknown_commands]
+        os.chdir(cwd)
+        shutil.rmtree(folder)
+    return server.host.stats, elapsed, code, output, failed
+
+
+def check_commands(verbose=False):
+    """
+    Run every command from COMMANDS against fake host, print round trips, bytes and wall time, return True when
+    every command succeeded, left fake host in expected state and stayed within its round trips, and commands
+    over all projects took as many round trips on a host with SCALING_PROJECTS projects.
+    """
+    logging.disable(logging.INFO)
+    ok = True
+    print('{:<5} {:<70} {:>5} {:>6} {:>9} {:>9} {:>8}'.format('', 'command', 'trips', 'budget', 'sent', 'received',
+                                                              'time'))
+    for entry in COMMANDS:
+        argv, trips, expectations = entry[:3]
+        server = FakeServer(**entry[3]) if len(entry) > 3 else None
+        stats, elapsed, code, output, failed = measure_command(argv, server, expectations)
+        budget = allowed_round_trips(trips)
+        passed = code == 0 and not failed and stats.round_trips <= budget
+        ok = ok and passed
+        print('{:<5} {:<70} {:>5} {:>6} {:>9} {:>9} {:>7.0f}ms'.format(
+            'ok' if passed else 'FAIL', ' '.join(argv)[:70], stats.round_trips, budget, stats.bytes_sent,
+            stats.bytes_received, elapsed * 1000))
+        for description in failed:
+            print('      expected {}'.format(description))
+        if verbose or not passed:
+            for kind, detail in stats.operations:
+                print('      {} {}'.format(kind, detail[:100]))
+            if code != 0:
+                print(output)
+    for argv in SCALING_COMMANDS:
+        few = measure_command(argv)[0].round_trips
+        server = FakeServer(['app', 'shop'] + ['project{}'.format(i) for i in range(SCALING_PROJECTS - 2)])
+        stats, elapsed, code, output, failed = measure_command(argv, server)
+        passed = code == 0 and not failed and stats.round_trips == few
+        ok = ok and passed
+        print('{:<5} {:<70} {:>5} {:>6} {:>9} {:>9} {:>7.0f}ms'.format(
+            'ok' if passed else 'FAIL', '{} ({} projects)'.format(' '.join(argv), SCALING_PROJECTS)[:70],
+            stats.round_trips, few, stats.bytes_sent, stats.bytes_received, elapsed * 1000))
+        if not passed and code != 0:
+            print(output)
+    return ok
+
+
+def check_registry():
+    """
+    Run port_registry_script locally on temporary registry: allocations in a row must get different ports
+    whether project home exists yet or not, and only prune may reclaim them. Returns True when it holds.
+    """
+    folder = tempfile.mkdtemp()
+    registry = os.path.join(folder, 'ports')
+    open(registry, 'w').close()
+
+    def call(*args):
+        command = script_command(port_registry_script, [args[0], registry, '8011'] + list(args[1:]))
+        return subprocess.check_output(['sh', '-c', command]).decode('utf-8').split()
+
+    try:
+        first, second, again = call('allocate', 'hmara-check-a'), call('allocate', 'hmara-check-b'), \
+            call('allocate', 'hmara-check-a')
+        listed = call('list')
+        pruned = call('prune')
+        left = call('list')
+    finally:
+        shutil.rmtree(folder)
+    passed = first != second and first == again and len(listed) == 4 and len(pruned) == 4 and not left
+    print('{:<5} port registry allocate {} {} {}, prune released {}'.format(
+        'ok' if passed else 'FAIL', first[0], second[0], again[0], ' '.join(pruned[1::2])))
+    return passed
+
+
+# redacted output is what hmara receives over ssh, so redaction must not be what limits it: on this floor in MB/s,
+# twice what a 100 Mbit/s link delivers, it is not, even with many projects' secrets at once. Scans per secret (one
+# `in` lookup over output, the least any redactor must do) and raw passthrough are reported for reference only:
+# passthrough is a bare method call and redaction is hundreds of times slower than it whatever the implementation.
+REDACTION_MIN_THROUGHPUT = 25
+REDACTION_SECRET_COUNTS = [4, 20]
+
+
+class NullStream(object):
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+    def flush(self):
+        pass
+
+
+def throughput(chunks, write, runs=1):
+    """
+    Best MB/s of writing all chunks runs times.
+    """
+    megabytes = sum(len(chunk) for chunk in chunks) / 1024.0 / 1024.0
+    timings = []
+    for _ in range(runs):
+        started = time.time()
+        for chunk in chunks:
+            write(chunk)
+        timings.append(time.time() - started)
+    return megabytes / max(min(timings), 1e-6)
+
+
+def measure_redaction(size=8 * 1024 * 1024, chunk_size=4096, secret_count=20):
+    """
+    Stream size bytes of log-like output with secrets cut across chunk borders through RedactingStream.
+    Returns MB/s, MB/s of plain passthrough, MB/s of one scan of output for absent string, and whether no secret
+    or part of it longer than half leaked.
+    """
+    secrets = [hashlib.sha1(str(i).encode('ascii')).hexdigest()[:8 + i] for i in range(secret_count)]
+    lines = []
+    for i in range(200):
+        lines.append('GET /api/items/{} 200 {}ms user=admin password={}\n'.format(i, i % 97, secrets[i % secret_count]))
+        lines.append('INFO worker {} processed batch of {} items in {}ms\n'.format(i % 8, i * 3, i % 50) * 3)
+    text = ''.join(lines)
+    text = text * (size // len(text) + 1)
+    chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+    plain = throughput(chunks, NullStream().write, 5)
+    absent = 'absent-' + secrets[-1]
+    scan = throughput(chunks, lambda chunk: absent in chunk, 5)
+
+    collected = six.StringIO()
+    stream = RedactingStream(collected)
+    timed = RedactingStream(NullStream())
+    stdout = sys.stdout
+    sys.stdout = stream
+    try:
+        with redacting(secrets):
+            for chunk in chunks:
+                stream.write(chunk)
+            stream.release()
+            redacted = throughput(chunks, timed.write, 5)
+    finally:
+        sys.stdout = stdout
+    output = collected.getvalue()
+    clean = not any(secret[:len(secret) // 2 + 1] in output for secret in secrets) and \
+        output.count('password=********') == text.count('password=')
+    return redacted, plain, scan, clean
+
+
+def check_redaction():
+    """
+    Print throughput of redacted output, return True when all secrets are masked and output is redacted at
+    REDACTION_MIN_THROUGHPUT MB/s at least.
+    """
+    ok = True
+    for secret_count in REDACTION_SECRET_COUNTS:
+        redacted, plain, scan, clean = measure_redaction(secret_count=secret_count)
+        passed = clean and redacted >= REDACTION_MIN_THROUGHPUT
+        ok = ok and passed
+        print('{:<5} redaction of {:>2} secrets {:>7.1f} MB/s (floor {} MB/s, {:.2f} scans per secret, scan {:.0f} '
+              'MB/s, passthrough {:.0f} MB/s){}'.format('ok' if passed else 'FAIL', secret_count, redacted,
+                                                     REDACTION_MIN_THROUGHPUT, scan / redacted / secret_count, scan,
+                                                     plain, '' if clean else ', secrets leaked'))
+    return ok
+
+
+def main():
+    """
+    Run suites named in arguments, all by default, from folder containing benchmarks and vps_tools:
+    python -m benchmarks [startup] [commands [-v]] [registry] [redaction]
+    """
+    suites = sys.argv[1:] or ['startup', 'commands', 'registry', 'redaction']
+    ok = True
+    if 'startup' in suites:
+        ok = check_startup() and ok
+    if 'commands' in suites:
+        ok = check_commands(verbose='-v' in suites) and ok
+    if 'registry' in suites:
+        ok = check_registry() and ok
+    if 'redaction' in suites:
+        ok = check_redaction() and ok
+    sys.exit(0 if ok else 1)
+
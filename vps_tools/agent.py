@@ -0,0 +1,356 @@
+from __future__ import unicode_literals, print_function
+
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+
+__all__ = ['AGENT_DIR', 'SOCKET_PATH', 'IDLE_TIMEOUT', 'LOCAL_COMMANDS', 'LOCAL_OPTIONS', 'ClientGone', 'forward',
+           'request', 'start', 'stop', 'status', 'serve']
+
+AGENT_DIR = os.path.expanduser('~/.hmara')
+SOCKET_PATH = os.path.join(AGENT_DIR, 'agent.sock')
+IDLE_TIMEOUT = 600
+LOCAL_COMMANDS = ['agent', 'update']
+# commands running until interrupted would keep agent from serving anything else
+LOCAL_OPTIONS = ['--follow', '--watch']
+
+
+class ClientGone(KeyboardInterrupt):
+    """
+    Client of running command closed connection, command is interrupted as by Ctrl-C.
+    """
+
+
+class SocketStream(object):
+    """
+    File-like object sending everything written to it to agent client as {"<name>": text} lines.
+    """
+    encoding = 'utf-8'
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+
+    def write(self, text):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', 'replace')
+        if text:
+            try:
+                send_message(self.connection, {self.name: text})
+            except socket.error:
+                raise ClientGone()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def send_message(connection, message):
+    connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+
+def read_messages(connection):
+    buf = b''
+    while True:
+        data = connection.recv(65536)
+        if not data:
+            return
+        buf += data
+        while b'\n' in buf:
+            line, buf = buf.split(b'\n', 1)
+            yield json.loads(line.decode('utf-8'))
+
+
+def connect(path=SOCKET_PATH):
+    """
+    Return socket connected to running agent or None.
+    """
+    if not os.path.exists(path):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except socket.error:
+        connection.close()
+        return None
+    return connection
+
+
+def request(message, path=SOCKET_PATH):
+    """
+    Send one request to agent and return its reply messages, None when agent is not running.
+    """
+    connection = connect(path)
+    if connection is None:
+        return None
+    try:
+        send_message(connection, message)
+        return list(read_messages(connection))
+    finally:
+        connection.close()
+
+
+def forward(argv, path=SOCKET_PATH):
+    """
+    Run hmara command line in running agent, copying its output here. Returns exit code,
+    or None when there is no agent and command must run in this process.
+    """
+    if argv[:1] and argv[0] in LOCAL_COMMANDS:
+        return None
+    # argparse takes unique prefixes of options too
+    if any(option.startswith(arg.split('=', 1)[0]) for arg in argv if arg.startswith('--') and len(arg) > 2
+           for option in LOCAL_OPTIONS):
+        return None
+    connection = connect(path)
+    if connection is None:
+        return None
+    try:
+        send_message(connection, {'argv': argv, 'cwd': os.getcwd()})
+        for message in read_messages(connection):
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+                sys.stdout.flush()
+            elif 'err' in message:
+                sys.stderr.write(message['err'])
+                sys.stderr.flush()
+            elif 'exit' in message:
+                return message['exit']
+    finally:
+        connection.close()
+    sys.stderr.write('hmara agent closed connection unexpectedly\n')
+    return 1
+
+
+def exit_code(exc):
+    if exc.code is None:
+        return 0
+    if isinstance(exc.code, int):
+        return exc.code
+    return 1
+
+
+def prune_connections():
+    """
+    Drop pooled connections whose transport died while agent was idle.
+    """
+    from fabric.state import connections
+
+    for key, client in list(dict.items(connections)):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            client.close()
+            dict.__delitem__(connections, key)
+
+
+def close_connections():
+    from fabric.api import hide
+    from fabric.network import disconnect_all
+
+    with hide('everything'):
+        disconnect_all()
+
+
+class Agent(object):
+
+    def __init__(self, path, idle_timeout):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.started = time.time()
+        self.last_used = time.time()
+        self.served = 0
+        self.running = True
+
+    def serve(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path), 0o700)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        listener.listen(8)
+        listener.settimeout(min(self.idle_timeout, 30))
+        try:
+            while self.running:
+                try:
+                    connection, _ = listener.accept()
+                except socket.timeout:
+                    self.check_idle()
+                    continue
+                connection.settimeout(None)
+                try:
+                    self.handle(connection)
+                except (socket.error, KeyboardInterrupt):
+                    # client went away, interrupt of its command may arrive just after command ended
+                    pass
+                finally:
+                    connection.close()
+                self.last_used = time.time()
+        finally:
+            listener.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            close_connections()
+
+    def check_idle(self):
+        from fabric.state import connections
+
+        if dict.__len__(connections) and time.time() - self.last_used > self.idle_timeout:
+            close_connections()
+
+    def handle(self, connection):
+        message = next(read_messages(connection), None)
+        if message is None:
+            return
+        if message.get('command') == 'stop':
+            self.running = False
+            send_message(connection, {'stopped': os.getpid()})
+        elif message.get('command') == 'status':
+            from fabric.state import connections
+
+            send_message(connection, {
+                'pid': os.getpid(),
+                'uptime': time.time() - self.started,
+                'idle': time.time() - self.last_used,
+                'served': self.served,
+                'hosts': sorted(dict.keys(connections)),
+            })
+        elif 'argv' in message:
+            self.served += 1
+            send_message(connection, {'exit': self.run(connection, message['argv'], message.get('cwd'))})
+
+    def run(self, connection, argv, cwd):
+        from .hmara import main
+
+        prune_connections()
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = SocketStream(connection, 'out')
+        sys.stderr = SocketStream(connection, 'err')
+        done = threading.Event()
+        lock = threading.Lock()
+        wake_read, wake_write = os.pipe()
+        watcher = threading.Thread(target=watch_client, args=(connection, wake_read, done, lock))
+        watcher.daemon = True
+        watcher.start()
+        try:
+            if cwd:
+                os.chdir(cwd)
+            main(argv)
+            return 0
+        except SystemExit as e:
+            if not isinstance(e.code, (int, type(None))):
+                sys.stderr.write('{}\n'.format(e.code))
+            return exit_code(e)
+        except KeyboardInterrupt:
+            return 130
+        except Exception as e:
+            sys.stderr.write('hmara agent: {!r}\n'.format(e))
+            return 1
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            try:
+                with lock:
+                    done.set()
+                os.write(wake_write, b'.')
+                watcher.join()
+            finally:
+                os.close(wake_read)
+                os.close(wake_write)
+
+
+def watch_client(connection, wake, done, lock):
+    """
+    Interrupt command in main thread when its client disconnects, also while command writes nothing.
+    Client sends nothing after request, so readable connection is closed one. Wake becomes readable when
+    command ended; done is set under lock before, no interrupt comes after it.
+    """
+    readable = select.select([connection, wake], [], [])[0]
+    if connection not in readable:
+        return
+    try:
+        closed = not connection.recv(1, socket.MSG_PEEK)
+    except socket.error:
+        closed = True
+    with lock:
+        if closed and not done.is_set():
+            # signal, unlike interrupt_main, also wakes main thread blocked in system call
+            os.kill(os.getpid(), signal.SIGINT)
+
+
+def serve(path=SOCKET_PATH, idle_timeout=IDLE_TIMEOUT):
+    """
+    Serve hmara commands on unix socket one by one, keeping ssh connections open between them. Commands
+    share process-wide fabric env and output, so others wait; commands following output until interrupted
+    are not forwarded, and command of client which disconnects is interrupted.
+    Connections are closed after idle_timeout seconds without requests.
+    """
+    from fabric.state import env
+    from .hmara import setup_logging
+    # commands run in client's working folder, import everything before the first chdir
+    from . import project, config, domains, service, pg, pg_store, ports, parallel, status, logs, stats, rolling  # noqa
+
+    setup_logging()
+    env.abort_on_prompts = True
+    env.keepalive = 30
+    Agent(path, idle_timeout).serve()
+
+
+def start(path=SOCKET_PATH, idle_timeout=IDLE_TIMEOUT):
+    """
+    Start agent in background and wait until it accepts connections. Returns agent pid.
+    """
+    reply = request({'command': 'status'}, path)
+    if reply:
+        return reply[0]['pid']
+    pid = os.fork()
+    if pid == 0:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        try:
+            serve(path, idle_timeout)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    for _ in range(100):
+        reply = request({'command': 'status'}, path)
+        if reply:
+            return reply[0]['pid']
+        time.sleep(0.05)
+    raise OSError(errno.ETIMEDOUT, 'hmara agent did not start')
+
+
+def stop(path=SOCKET_PATH):
+    """
+    Stop running agent. Returns its pid or None when agent was not running.
+    """
+    reply = request({'command': 'stop'}, path)
+    if not reply:
+        return None
+    return reply[0]['stopped']
+
+
+def status(path=SOCKET_PATH):
+    """
+    Return status dict of running agent or None.
+    """
+    reply = request({'command': 'status'}, path)
+    return reply[0] if reply else None
@@ -0,0 +1,169 @@
+from __future__ import unicode_literals, print_function
+
+import time
+from collections import OrderedDict
+
+from fabric.api import settings, hide
+from fabric.colors import green, red
+from fabric.utils import puts
+
+from .transport import sudo
+from .readiness import wait_for_program, wait_for_programs, wait_for_port
+from .utils import run_script, take_snapshot, config_nginx, config_supervisor, write_supervisor_config, \
+    get_port_number, parse_environment, release_ports
+
+__all__ = ['DRAIN_SECONDS', 'load_states', 'store_state', 'enable', 'disable', 'cutover', 'restart_projects',
+           'stop_project', 'start_project']
+
+DRAIN_SECONDS = 10
+
+load_states_script = """for name in "$@"; do
+    [ -f /home/$name/.bluegreen ] || continue
+    echo "@@$name"; cat /home/$name/.bluegreen; echo
+done
+exit 0
+"""
+
+
+def other_color(color):
+    return 'green' if color == 'blue' else 'blue'
+
+
+def load_states(project_names):
+    """
+    Return dict project name -> blue/green state for projects running in blue/green mode, in one round trip.
+    """
+    states = {}
+    name = None
+    for line in run_script(load_states_script, *project_names).splitlines():
+        if line.startswith('@@'):
+            name = line[2:].strip()
+            states[name] = ''
+        elif name is not None:
+            states[name] += line + '\n'
+    return dict((name, parse_environment(content)) for name, content in states.items())
+
+
+def store_state(project_name, state):
+    if state is None:
+        sudo('rm -f /home/{}/.bluegreen'.format(project_name))
+        return
+    content = ''.join('{}={}\\n'.format(k, v) for k, v in state.items())
+    sudo("printf '{content}' > /home/{project_name}/.bluegreen".format(content=content, project_name=project_name))
+
+
+def enable(project_name):
+    """
+    Switch project to blue/green mode: current PORT becomes blue, green gets new port.
+    """
+    snapshot = take_snapshot(project_name)
+    if snapshot.bluegreen:
+        puts(green('{} already runs in blue/green mode, active {}'.format(project_name,
+                                                                         snapshot.bluegreen['ACTIVE'])))
+        return
+    state = OrderedDict([('ACTIVE', 'blue'), ('BLUE_PORT', snapshot.env['PORT']),
+                         ('GREEN_PORT', str(get_port_number(project_name, 'green')))])
+    store_state(project_name, state)
+    config_supervisor(project_name, bluegreen=state)
+
+
+def disable(project_name):
+    """
+    Return project to single supervisor program on PORT from .env.
+    """
+    snapshot = take_snapshot(project_name)
+    if not snapshot.bluegreen:
+        return
+    store_state(project_name, None)
+    config_supervisor(project_name)
+    snapshot.bluegreen = {}
+    config_nginx(project_name, snapshot=snapshot)
+    release_ports(project_name, 'green')
+
+
+def set_autostart(project_name, state, colors, program):
+    """
+    Rewrite supervisor config with colors started by supervisor and apply it to program only. Update restarts
+    program whose config changed, so program is always stopped color, never serving one.
+    """
+    write_supervisor_config(project_name, state, autostart=colors)
+    sudo('supervisorctl update {}'.format(program))
+
+
+def cutover(project_name, snapshot=None):
+    """
+    Start idle color, wait until it answers HTTP, point nginx to it, then drain and stop active color.
+    Any failure before the switch is complete stops idle color and restores nginx config.
+    Supervisor config follows every step, so supervisor reload or reboot starts colors nginx points to.
+    """
+    if snapshot is None:
+        snapshot = take_snapshot(project_name)
+    state = OrderedDict(snapshot.bluegreen)
+    active = state['ACTIVE']
+    idle = other_color(active)
+    idle_port = state['{}_PORT'.format(idle.upper())]
+    idle_program = '{}_{}'.format(project_name, idle)
+    active_program = '{}_{}'.format(project_name, active)
+    started = time.time()
+    nginx_switched = False
+    try:
+        with settings(warn_only=True):
+            sudo('supervisorctl stop {}'.format(idle_program))
+        # both colors start with supervisor while switch is under way
+        set_autostart(project_name, state, (active, idle), idle_program)
+        with settings(hide('warnings'), warn_only=True):
+            # update has started idle already unless its config was left on by interrupted cutover
+            sudo('supervisorctl start {}'.format(idle_program))
+        wait_for_program(idle_program)
+        wait_for_port(idle_port)
+        nginx_switched = True
+        config_nginx(project_name, snapshot=snapshot, port=idle_port)
+    except SystemExit:
+        puts(red('{}: switch to {} failed, rolling back to {}'.format(project_name, idle, active)))
+        with settings(warn_only=True):
+            if nginx_switched:
+                config_nginx(project_name, snapshot=snapshot)
+            sudo('supervisorctl stop {}'.format(idle_program))
+            set_autostart(project_name, state, (active,), idle_program)
+        raise
+    state['ACTIVE'] = idle
+    store_state(project_name, state)
+    snapshot.bluegreen = state
+    time.sleep(DRAIN_SECONDS)
+    sudo('supervisorctl stop {}'.format(active_program))
+    set_autostart(project_name, state, (idle,), active_program)
+    puts(green('{}: switched to {} on port {} in {:.1f}s'.format(project_name, idle, idle_port,
+                                                                  time.time() - started)))
+
+
+def restart_projects(project_names):
+    """
+    Restart projects: blue/green ones by cutover, others with one supervisorctl restart and one readiness wait.
+    """
+    states = load_states(project_names)
+    plain = [name for name in project_names if name not in states]
+    if plain:
+        sudo('supervisorctl restart {}'.format(' '.join(plain)))
+        wait_for_programs(plain)
+    for name in project_names:
+        if name in states:
+            cutover(name)
+
+
+def stop_project(project_name):
+    states = load_states([project_name])
+    if project_name in states:
+        with settings(warn_only=True):
+            sudo('supervisorctl stop {name}_blue {name}_green'.format(name=project_name))
+    else:
+        sudo('supervisorctl stop {}'.format(project_name))
+
+
+def start_project(project_name):
+    states = load_states([project_name])
+    if project_name in states:
+        program = '{}_{}'.format(project_name, states[project_name]['ACTIVE'])
+    else:
+        program = project_name
+    sudo('supervisorctl start {}'.format(program))
+    wait_for_program(program)
@@ -0,0 +1,103 @@
+from __future__ import unicode_literals, print_function
+
+import hashlib
+import sys
+import zlib
+
+# Source of this module is sent to hosts and run there by python of host, keep it standalone and
+# working on python 2 and 3.
+
+AVERAGE_SIZE = 64 * 1024
+MIN_SIZE = 16 * 1024
+MAX_SIZE = 1024 * 1024
+READ_SIZE = 256 * 1024
+COMPRESS_LEVEL = 3
+# past MIN_SIZE line ends chunk when crc32 of line is below its length times SCALE, so chunks average
+# AVERAGE_SIZE bytes whatever length of lines is
+SCALE = 2 ** 32 // (AVERAGE_SIZE - MIN_SIZE)
+
+try:
+    window = buffer  # python 2, zlib there takes no memoryview
+except NameError:
+    def window(data, start, size):
+        return memoryview(data)[start:start + size]
+
+
+def split(stream, read_size=READ_SIZE):
+    """
+    Yield content-defined chunks of stream. Chunks end after line whose hash selects it as boundary,
+    so rows inserted into or deleted from table data change only chunks around them. Lines longer than
+    MAX_SIZE are cut at MAX_SIZE. Boundaries depend only on content, not on how it was read.
+    """
+    pending = bytearray()
+    line_start = scan = 0
+    eof = False
+    while not eof:
+        data = stream.read(read_size)
+        eof = not data
+        pending += data
+        while True:
+            end = pending.find(b'\n', scan, MAX_SIZE)
+            if end < 0:
+                if len(pending) < MAX_SIZE:
+                    scan = len(pending)
+                    break
+                cut = MAX_SIZE
+            else:
+                end += 1
+                start, line_start, scan = line_start, end, end
+                if end < MIN_SIZE:
+                    continue
+                if zlib.crc32(window(pending, start, end - start)) & 0xffffffff >= (end - start) * SCALE:
+                    continue
+                cut = end
+            yield bytes(pending[:cut])
+            del pending[:cut]
+            line_start = max(line_start - cut, 0)
+            scan = max(scan - cut, 0)
+    if pending:
+        yield bytes(pending)
+
+
+def encode(stream, output, known, listing=None):
+    """
+    Write chunks of stream as frames: "= <sha256>" for chunks in known, "+ <sha256> <size>" followed by
+    zlib-compressed chunk for others, and ". <chunks> <bytes> <sha256 of stream>" at the end.
+    Hashes of all chunks go to listing, one per line.
+    """
+    digest = hashlib.sha256()
+    count = total = 0
+    for chunk in split(stream):
+        digest.update(chunk)
+        count += 1
+        total += len(chunk)
+        key = hashlib.sha256(chunk).hexdigest()
+        if listing is not None:
+            listing.write(key.encode('ascii') + b'\n')
+        if key in known:
+            output.write('= {}\n'.format(key).encode('ascii'))
+            continue
+        known.add(key)
+        data = zlib.compress(chunk, COMPRESS_LEVEL)
+        output.write('+ {} {}\n'.format(key, len(data)).encode('ascii'))
+        output.write(data)
+    output.write('. {} {} {}\n'.format(count, total, digest.hexdigest()).encode('ascii'))
+
+
+def main(known_path, listing_path, snapshot):
+    """
+    Chunk stdin to stdout. Chunks listed in known_path (after its first line, id of snapshot they belong to)
+    are not sent; chunks of stdin are listed in listing_path under snapshot.
+    """
+    with open(known_path, 'rb') as known_file:
+        known = set(line.strip().decode('ascii') for line in known_file.readlines()[1:])
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    with open(listing_path, 'wb') as listing:
+        listing.write(snapshot.encode('ascii') + b'\n')
+        encode(stdin, stdout, known, listing)
+    stdout.flush()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:4])
@@ -1,49 +1,153 @@
 from __future__ import unicode_literals, print_function
 
+from collections import OrderedDict
+
 import six
-from fabric.api import task, sudo
+from fabric.api import task
 from fabric.utils import puts
-from fabric.colors import green
+from fabric.colors import green, red
 
-from .utils import load_environment_dict, store_environment_dict, run_until_ok
+from .utils import load_environment_dict, store_environment_dict, load_environment_dicts, store_environment_dicts, \
+    render_environment, list_environment_versions, rollback_environment
+from .bluegreen import restart_projects
+from .tracing import traced
+from .redaction import revealing
 
 
 @task(default=True)
+@traced
 def list(username):
     """
     List environment variables of project. Usage: config list --name <username>
     """
-    env_dict = load_environment_dict(username=username)
-    for k, v in six.iteritems(env_dict):
-        puts(green('{}={}'.format(k, v)))
+    show_variables(load_environment_dict(username=username))
 
 
 @task()
+@traced
 def set(username, kwargs, do_reload=True):
     """
     Set environment variable of project. Usage config set --name <username> --vars [<key>=<value> ...]
     """
     env_dict = load_environment_dict(username=username)
-    env_dict.update(kwargs)
-    for k, v in six.iteritems(env_dict):
-        puts(green('{}={}'.format(k, v)))
-    store_environment_dict(username=username, env_dict=env_dict)
-    if do_reload:
-        sudo('supervisorctl restart {}'.format(username))
-        run_until_ok('supervisorctl status')
+    new_env_dict = env_dict.copy()
+    new_env_dict.update(kwargs)
+    show_variables(new_env_dict)
+    store_if_changed(username, env_dict, new_env_dict, do_reload)
 
 
 @task()
+@traced
 def unset(username, args, do_reload=True):
     """
     Unset environment variable of project. Usage config unset --name <username> [<key> ...]
     """
     env_dict = load_environment_dict(username=username)
+    new_env_dict = env_dict.copy()
     for key in args:
-        env_dict.pop(key, None)
-    for k, v in six.iteritems(env_dict):
-        puts(green('{}={}'.format(k, v)))
-    store_environment_dict(username=username, env_dict=env_dict)
+        new_env_dict.pop(key, None)
+    show_variables(new_env_dict)
+    store_if_changed(username, env_dict, new_env_dict, do_reload)
+
+
+def show_variables(env_dict, prefix=''):
+    """
+    Print variables with their values unmasked, showing them is what config commands are for.
+    """
+    with revealing():
+        for k, v in six.iteritems(env_dict):
+            puts(green('{}{}={}'.format(prefix, k, v)))
+
+
+def store_if_changed(username, env_dict, new_env_dict, do_reload=True):
+    """
+    Write .env and restart project only when content of .env changes.
+    """
+    if render_environment(new_env_dict) == render_environment(env_dict):
+        puts('{}: unchanged'.format(username))
+        return
+    store_environment_dict(username=username, env_dict=new_env_dict)
     if do_reload:
-        sudo('supervisorctl restart {}'.format(username))
-        run_until_ok('supervisorctl status')
\ No newline at end of file
+        restart_projects([username])
+
+
+@task()
+@traced
+def versions(username):
+    """
+    List saved versions of .env of project, newest first. Usage: config versions --name <username>
+    """
+    for version in list_environment_versions(username):
+        puts(green(version))
+
+
+@task()
+@traced
+def rollback(username, version=None, do_reload=True):
+    """
+    Restore saved version of .env, newest by default. Usage: config rollback --name <username> [--to <version>]
+    """
+    restored = rollback_environment(username, version)
+    if restored is None:
+        puts('{}: unchanged'.format(username))
+        return
+    puts(green('{}: .env restored from {}'.format(username, restored)))
+    if do_reload:
+        restart_projects([username])
+
+
+def update_many(project_names, update):
+    """
+    Apply update to env dicts of many projects, write and restart only projects whose env changed.
+    """
+    env_dicts = load_environment_dicts(project_names)
+    for project_name in project_names or []:
+        if project_name not in env_dicts:
+            puts(red('{}: .env not found'.format(project_name)))
+    changed = OrderedDict()
+    for project_name, env_dict in six.iteritems(env_dicts):
+        new_env_dict = env_dict.copy()
+        update(new_env_dict)
+        if render_environment(new_env_dict) == render_environment(env_dict):
+            puts('{}: unchanged'.format(project_name))
+        else:
+            puts(green('{}: changed'.format(project_name)))
+            changed[project_name] = new_env_dict
+    if not changed:
+        return
+    stored = store_environment_dicts(changed)
+    if stored:
+        restart_projects(stored)
+
+
+@task()
+@traced
+def list_many(project_names):
+    """
+    List environment variables of many projects. Usage: config list --name <username> [<username> ...] | --all
+    """
+    for project_name, env_dict in six.iteritems(load_environment_dicts(project_names)):
+        show_variables(env_dict, '{}: '.format(project_name))
+
+
+@task()
+@traced
+def set_many(project_names, kwargs):
+    """
+    Set environment variables of many projects. Usage: config set --name <username> [<username> ...] | --all
+    --vars [<key>=<value> ...]
+    """
+    update_many(project_names, lambda env_dict: env_dict.update(kwargs))
+
+
+@task()
+@traced
+def unset_many(project_names, args):
+    """
+    Unset environment variables of many projects. Usage: config unset --name <username> [<username> ...] | --all
+    --vars [<key> ...]
+    """
+    def update(env_dict):
+        for key in args:
+            env_dict.pop(key, None)
+    update_many(project_names, update)
@@ -1,25 +1,49 @@
 from __future__ import unicode_literals, print_function
 
+import six
 from fabric.decorators import task
 from fabric.utils import puts
 from fabric.colors import green
 
-from .utils import load_domain_list, add_domain, remove_domain, config_nginx
+from .utils import load_domain_list, add_domain, remove_domain, config_nginx, take_snapshot, nginx_batch
+
+
+def _names(project_names):
+    if isinstance(project_names, six.string_types):
+        return [project_names]
+    return project_names
 
 
 @task()
-def list(project_name):
-    for d in load_domain_list(project_name):
-        puts(green(d))
+def list(project_names):
+    project_names = _names(project_names)
+    for project_name in project_names:
+        for d in load_domain_list(project_name):
+            if len(project_names) > 1:
+                puts(green('{}: {}'.format(project_name, d)))
+            else:
+                puts(green(d))
 
 
 @task()
-def set(project_name, domains):
-    add_domain(project_name, domains)
-    config_nginx(project_name)
+def set(project_names, domains):
+    """
+    Add domains to projects, nginx is reloaded once for all changed configs.
+    """
+    with nginx_batch():
+        for project_name in _names(project_names):
+            snapshot = take_snapshot(project_name)
+            add_domain(project_name, domains, snapshot=snapshot)
+            config_nginx(project_name, snapshot=snapshot)
 
 
 @task()
-def unset(project_name, domains):
-    remove_domain(project_name, domains)
-    config_nginx(project_name)
\ No newline at end of file
+def unset(project_names, domains):
+    """
+    Remove domains from projects, nginx is reloaded once for all changed configs.
+    """
+    with nginx_batch():
+        for project_name in _names(project_names):
+            snapshot = take_snapshot(project_name)
+            remove_domain(project_name, domains, snapshot=snapshot)
+            config_nginx(project_name, snapshot=snapshot)
@@ -1,48 +1,41 @@
 from __future__ import unicode_literals, print_function
-from colorama import init
-from urlparse import urlparse
 import argparse
-import tempfile
 import os
 import sys
-import logging
-from fabric.api import execute, prompt, env, local
+import six
 from fabric.utils import puts
 from fabric.colors import green, red
-from storm import Storm
-from storm.parsers.ssh_uri_parser import parse
-
-try:
-    from configparser import RawConfigParser
-except ImportError:
-    from ConfigParser import RawConfigParser
-
-from .project import create, destroy, run, restart, list_projects, deploy
-from .config import list as config_list, set, unset
-from .service import nginx, postgresql
-from .pg import dump, restore
-from .domains import list as domain_list, set as domain_set, unset as domain_unset
-
-init()
-
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-                    datefmt='%m-%d %H:%M',
-                    filename=os.path.join(tempfile.gettempdir(), 'hmara.log'),
-                    filemode='w')
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
-
-env.use_ssh_config = True
+
+from . import agent, redaction
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
+def run_task(args, task, *task_args, **task_kwargs):
+    """
+    Run task on every host from --host, one by one or on --parallel hosts at once
+    """
+    from fabric.api import execute, env
+
+    env.use_ssh_config = True
+    hosts = args.host
+    if isinstance(hosts, six.string_types):
+        hosts = [hosts]
+    if getattr(args, 'parallel', None) and hosts:
+        from .parallel import execute_parallel, print_summary
+
+        results = execute_parallel(task, hosts, args.parallel, *task_args, **task_kwargs)
+        print_summary(results)
+        if not all(r.succeeded for r in results.values()):
+            sys.exit(1)
+        return dict((host, r.result) for host, r in results.items())
+    return execute(task, *task_args, hosts=hosts, **task_kwargs)
+
+
 def execute_project(args):
-    env.hosts = args.host
+    from fabric.api import prompt
+    from .project import create, destroy, run, restart, list_projects, deploy, bluegreen
+
     if not args.subcommand == 'list' and args.name is None:
         puts(red('--name is required'))
         return
@@ -59,58 +52,139 @@ def execute_project(args):
                     repo_url = repo.remotes.origin.url
             if not repo_url:
                 repo_url = prompt('Please, input repository url of project:')
-        execute(create, args.name, repo_url=repo_url, no_createdb=args.no_createdb,
-                no_migrations=args.no_migrations, base_domain=args.base_domain)
+        run_task(args, create, args.name, repo_url=repo_url, no_createdb=args.no_createdb,
+                 no_migrations=args.no_migrations, base_domain=args.base_domain)
     elif args.subcommand == 'destroy':
-        execute(destroy, args.name)
+        run_task(args, destroy, args.name)
     elif args.subcommand == 'run':
         if args.cmd is None:
             cmd = prompt('Please, input command:')
         else:
             cmd = ' '.join(args.cmd)
-        execute(run, args.name, cmd)
+        run_task(args, run, args.name, cmd)
     elif args.subcommand == 'restart':
-        execute(restart, args.name)
+        run_task(args, restart, args.name)
+    elif args.subcommand == 'deploy' and args.rolling:
+        from fabric.api import env
+        from .rolling import rolling_deploy
+
+        env.use_ssh_config = True
+        hosts = [args.host] if isinstance(args.host, six.string_types) else args.host
+        rolling_deploy(hosts, args.name, batch=args.batch, full=args.full, max_latency=args.max_latency / 1000.0)
     elif args.subcommand == 'deploy':
-        execute(deploy, args.name)
+        run_task(args, deploy, args.name, full=args.full)
+    elif args.subcommand == 'bluegreen':
+        run_task(args, bluegreen, args.name, off=args.off)
     else:
-        execute(list_projects)
+        run_task(args, list_projects)
 
 
 def execute_config(args):
-    env.hosts = args.host
-    if args.subcommand == 'list':
-        execute(config_list, args.name)
+    from .config import list as config_list, set as config_set, unset as config_unset, \
+        list_many as config_list_many, set_many, unset_many, versions as config_versions, rollback as config_rollback
+
+    if not args.name and not args.all:
+        puts(red('--name or --all is required'))
+        return
+    if args.subcommand in ('versions', 'rollback'):
+        if args.all or len(args.name) > 1:
+            puts(red('config {} takes one --name'.format(args.subcommand)))
+        elif args.subcommand == 'versions':
+            run_task(args, config_versions, args.name[0])
+        else:
+            run_task(args, config_rollback, args.name[0], args.to)
+    elif args.all or len(args.name) > 1:
+        project_names = None if args.all else args.name
+        if args.subcommand == 'list':
+            run_task(args, config_list_many, project_names)
+        elif args.subcommand == 'set':
+            kwars = dict(i.split('=', 1) for i in args.vars)
+            run_task(args, set_many, project_names, kwars)
+        elif args.subcommand == 'unset':
+            kwars = [i.split('=')[0] for i in args.vars]
+            run_task(args, unset_many, project_names, kwars)
+    elif args.subcommand == 'list':
+        run_task(args, config_list, args.name[0])
     elif args.subcommand == 'set':
-        kwars = dict((i.split('=')[0], i.split('=')[1]) for i in args.vars)
-        execute(set, args.name, kwars)
+        kwars = dict(i.split('=', 1) for i in args.vars)
+        run_task(args, config_set, args.name[0], kwars)
     elif args.subcommand == 'unset':
         kwars = [i.split('=')[0] for i in args.vars]
-        execute(unset, args.name, kwars)
+        run_task(args, config_unset, args.name[0], kwars)
 
 
 def execute_service(args):
     """
     Service commands
     """
-    if args.host:
-        env.hosts = args.host
+    from .service import nginx, postgresql
+
     if args.name == 'nginx':
-        execute(nginx, args.service_command)
+        run_task(args, nginx, args.service_command)
     elif args.name == 'postgresql':
-        execute(postgresql, args.service_command)
+        run_task(args, postgresql, args.service_command)
 
 
 def execute_pg(args):
     """Database commands."""
-    env.hosts = args.host
+    from fabric.api import env
+    from .pg import dump, restore, inspect, shadow_restore, rollback
+    from .pg_store import BACKUP_JOBS, StoreError, backup_all, snapshot_dump, list_snapshots
+
+    hosts = [args.host] if isinstance(args.host, six.string_types) else args.host
+    if args.subcommand == 'inspect':
+        inspect(args.dump, table=args.table, output=args.output)
+        return
+    if args.subcommand == 'snapshots':
+        list_snapshots([args.name] if args.name else None, store_path=args.store)
+        return
+    if args.subcommand == 'backup':
+        if args.name is None and not args.all:
+            puts(red('--name or --all is required'))
+            return
+        env.use_ssh_config = True
+        if backup_all(hosts, None if args.all else [args.name], jobs=args.jobs or BACKUP_JOBS,
+                      keep_daily=args.keep_daily, keep_weekly=args.keep_weekly, store_path=args.store):
+            sys.exit(1)
+        return
+    if args.name is None:
+        puts(red('--name is required'))
+        return
+    if args.cascade and not args.data_only:
+        puts(red('--cascade is only used with --data-only'))
+        return
+    if args.jobs and args.subcommand == 'restore' and (args.tables or args.exclude_tables or args.data_only):
+        puts(red('--jobs restores whole database only, partial restore runs in one transaction'))
+        return
+    if args.shadow and (args.tables or args.exclude_tables or args.data_only):
+        puts(red('--shadow restores whole database, it does not take --tables, --exclude-tables or --data-only'))
+        return
+    if args.shadow:
+        restore_task, restore_kwargs = shadow_restore, {'jobs': args.jobs}
+    else:
+        restore_task, restore_kwargs = restore, {'jobs': args.jobs, 'tables': args.tables,
+                                                 'exclude_tables': args.exclude_tables, 'data_only': args.data_only,
+                                                 'cascade': args.cascade}
     if args.subcommand == 'dump':
-        execute(dump, args.name, args.dump)
+        run_task(args, dump, args.name, args.dump, stream=args.stream, compress=args.compress, level=args.level,
+                 jobs=args.jobs)
+    elif args.subcommand == 'restore' and args.snapshot:
+        try:
+            with snapshot_dump(args.name, args.snapshot, hosts[0], store_path=args.store) as snapshot:
+                run_task(args, restore_task, args.name, snapshot, **restore_kwargs)
+        except StoreError as e:
+            puts(red(str(e)))
+            sys.exit(1)
     elif args.subcommand == 'restore':
-        execute(restore, args.name, args.dump)
+        run_task(args, restore_task, args.name, args.dump, **restore_kwargs)
+    elif args.subcommand == 'rollback':
+        run_task(args, rollback, args.name)
 
 
 def execute_host(args):
+    from storm import Storm
+    from storm.parsers.ssh_uri_parser import parse
+
     if not args.subcommand == 'list' and not args.host:
         puts(red('--host is required'))
         return
@@ -136,10 +210,12 @@ def execute_version(args):
     """
     with open(os.path.join(BASE_DIR, '__init__.py'), 'r') as version_file:
         _, version = version_file.read().split("=")
-    puts(green('hmara version: {}'.format(version[1:-1])))
+    print(green('hmara version: {}'.format(version[1:-1])))
 
 
 def execute_update(args):
+    from fabric.api import local
+
     if sys.platform == 'win32':
         puts(green('pip install --upgrade https://git.vomelchuk.com/vitaly4uk/vps-tools/archive/master.zip'))
     else:
@@ -147,38 +223,184 @@ def execute_update(args):
 
 
 def execute_domain(args):
-    env.hosts = args.host
+    from .domains import list as domain_list, set as domain_set, unset as domain_unset
+
     if args.subcommand == 'list':
-        execute(domain_list, args.name)
+        run_task(args, domain_list, args.name)
     elif args.subcommand == 'set':
-        execute(domain_set, args.name, args.domains)
+        run_task(args, domain_set, args.name, args.domains)
     elif args.subcommand == 'unset':
-        execute(domain_unset, args.name, args.domains)
+        run_task(args, domain_unset, args.name, args.domains)
+
+
+def execute_port(args):
+    from .ports import list as port_list, who as port_who, prune as port_prune
+
+    if args.subcommand == 'list':
+        run_task(args, port_list)
+    elif args.subcommand == 'who':
+        if args.port is None:
+            puts(red('--port is required'))
+            return
+        run_task(args, port_who, args.port)
+    elif args.subcommand == 'prune':
+        run_task(args, port_prune)
 
 
-def main():
+def execute_status(args):
+    """
+    Fleet status of all projects on hosts
+    """
+    from fabric.api import env
+    from .status import show, watch
+
+    env.use_ssh_config = True
+    hosts = [args.host] if isinstance(args.host, six.string_types) else args.host
+    if args.watch:
+        try:
+            watch(hosts, args.watch)
+        except KeyboardInterrupt:
+            pass
+    else:
+        show(hosts, args.ttl)
+
+
+def execute_logs(args):
+    """
+    Show or follow project logs on hosts
+    """
+    from fabric.api import env
+    from .logs import show_logs
+
+    env.use_ssh_config = True
+    hosts = [args.host] if isinstance(args.host, six.string_types) else args.host
+    if show_logs(hosts, args.name, files=args.file, pattern=args.grep, lines=args.lines, follow=args.follow,
+                 since_last=args.since_last):
+        sys.exit(1)
+
+
+def execute_stats(args):
+    """
+    Performance numbers of projects from nginx access logs on hosts
+    """
+    from fabric.api import env
+    from .stats import show_stats
+
+    env.use_ssh_config = True
+    hosts = [args.host] if isinstance(args.host, six.string_types) else args.host
+    if show_stats(hosts, args.name, top=args.top):
+        sys.exit(1)
+
+
+def execute_agent(args):
+    """
+    Manage local agent keeping ssh connections to hosts open between hmara commands
+    """
+    if args.subcommand == 'start':
+        print(green('hmara agent is running, pid {}'.format(agent.start(idle_timeout=args.idle_timeout))))
+    elif args.subcommand == 'stop':
+        pid = agent.stop()
+        if pid is None:
+            print(red('hmara agent is not running'))
+        else:
+            print(green('hmara agent {} stopped'.format(pid)))
+    else:
+        status = agent.status()
+        if status is None:
+            print(red('hmara agent is not running'))
+            return
+        print(green('hmara agent is running, pid {pid}, up {uptime:.0f}s, idle {idle:.0f}s, '
+                   '{served} commands served'.format(**status)))
+        for host in status['hosts']:
+            print(green('connected: {}'.format(host)))
+
+
+def setup_logging():
+    """
+    Log DEBUG to hmara.log in temp folder and INFO to console, once per process
+    """
+    import logging
+    import tempfile
+
+    if logging.getLogger('').handlers:
+        return
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                        datefmt='%m-%d %H:%M',
+                        filename=os.path.join(tempfile.gettempdir(), 'hmara.log'),
+                        filemode='w')
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
+    console.setFormatter(formatter)
+    logging.getLogger('').addHandler(console)
+
+
+def run_traced(args, argv):
+    """
+    Run command recording spans of tasks and remote operations
+    """
+    from fabric.state import env
+    from .tracing import Tracer
+
+    env.tracer = Tracer(argv)
+    try:
+        args.func(args)
+    finally:
+        tracer, env.tracer = env.tracer, None
+        if args.trace:
+            tracer.write(args.trace)
+            print(green('trace of {} spans written to {}'.format(len(tracer.events), args.trace)))
+        if args.profile:
+            tracer.print_profile(args.profile)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+        if not os.environ.get('HMARA_NO_AGENT'):
+            code = agent.forward(argv)
+            if code is not None:
+                sys.exit(code)
+
     parser = argparse.ArgumentParser(description='Configure projects on hmara servers.')
 
+    parser.add_argument('--trace', help='write Chrome trace JSON of tasks and remote operations to FILE',
+                        metavar='FILE')
+    parser.add_argument('--profile', help='print N slowest steps when command ends', type=int, metavar='N')
     subparser = parser.add_subparsers(title='Available commands', help='List of available comands.')
 
     parser_project = subparser.add_parser('project', help='#  Manage projects')
-    parser_project.add_argument('subcommand', choices=['create', 'deploy', 'destroy', 'run', 'restart', 'list'])
+    parser_project.add_argument('subcommand',
+                                choices=['create', 'deploy', 'destroy', 'run', 'restart', 'list', 'bluegreen'])
     parser_project.add_argument('--name', help='project name')
     parser_project.add_argument('--repo-url', help='git repository url with project')
     parser_project.add_argument('--cmd', help='', nargs=argparse.REMAINDER)
     parser_project.add_argument('--host', help='host name to run command on [default=hotels]', nargs='+',
                                 default='hotels')
+    parser_project.add_argument('--parallel', help='run on up to N hosts at once', type=int, metavar='N')
     parser_project.add_argument('--no-createdb', help='do not create new database', action='store_true')
     parser_project.add_argument('--no-migrations', help='do not apply migrations', action='store_true')
+    parser_project.add_argument('--off', help='bluegreen: return to single program', action='store_true')
+    parser_project.add_argument('--full', help='deploy: run every step regardless of changes', action='store_true')
+    parser_project.add_argument('--rolling', help='deploy: batch by batch, stop and roll back when a batch is not '
+                                                  'healthy', action='store_true')
+    parser_project.add_argument('--batch', help='deploy --rolling: hosts deployed at once [default=1]', type=int,
+                                default=1, metavar='N')
+    parser_project.add_argument('--max-latency', help='deploy --rolling: highest healthy median latency in ms '
+                                                      '[default=1000]', type=int, default=1000, metavar='MS')
     parser_project.add_argument('--base-domain', help='base domain. [default=nomax.com.ua]', default='nomax.com.ua')
     parser_project.set_defaults(func=execute_project)
 
     parser_config = subparser.add_parser('config', help='#  Manage projects config vars')
-    parser_config.add_argument('subcommand', choices=['list', 'set', 'unset'])
+    parser_config.add_argument('subcommand', choices=['list', 'set', 'unset', 'versions', 'rollback'])
     parser_config.add_argument('--vars', nargs='+', help='<key>=<value> pairs of vars')
+    parser_config.add_argument('--to', help='rollback: saved version to restore [default=newest]', metavar='VERSION')
     parser_config.add_argument('--host', help='host name to run command on [default=hotels]', nargs='+',
                                default='hotels')
-    parser_config.add_argument('--name', help='project name', required=True)
+    parser_config.add_argument('--parallel', help='run on up to N hosts at once', type=int, metavar='N')
+    parser_config.add_argument('--name', help='project name', nargs='+')
+    parser_config.add_argument('--all', help='apply to all projects on host', action='store_true')
     parser_config.set_defaults(func=execute_config)
 
     parser_domain = subparser.add_parser('domain', help='# Manage project domains')
@@ -186,7 +408,8 @@ def main():
     parser_domain.add_argument('--domains', nargs='+', help='list of domains')
     parser_domain.add_argument('--host', help='host name to run command on [default=hotels]', nargs='+',
                                default='hotels')
-    parser_domain.add_argument('--name', help='project name', required=True)
+    parser_domain.add_argument('--parallel', help='run on up to N hosts at once', type=int, metavar='N')
+    parser_domain.add_argument('--name', help='project name(s)', nargs='+', required=True)
     parser_domain.set_defaults(func=execute_domain)
 
     parser_service = subparser.add_parser('service', help='#  Manage services')
@@ -196,6 +419,7 @@ def main():
                                          'rotate', 'upgrade'])
     parser_service.add_argument('--host', help='host name to run command on  [default=hotels]', nargs='+',
                                 default='hotels')
+    parser_service.add_argument('--parallel', help='run on up to N hosts at once', type=int, metavar='N')
     parser_service.set_defaults(func=execute_service)
 
     parser_host = subparser.add_parser('host', help='#  Manage hosts')
@@ -205,6 +429,45 @@ def main():
     parser_host.add_argument('--id-file', help='identification file path')
     parser_host.set_defaults(func=execute_host)
 
+    parser_port = subparser.add_parser('port', help='#  Show port assignments')
+    parser_port.add_argument('subcommand', choices=['list', 'who', 'prune'])
+    parser_port.add_argument('--port', help='port number to look up', type=int)
+    parser_port.add_argument('--host', help='host name to run command on [default=hotels]', nargs='+',
+                             default='hotels')
+    parser_port.add_argument('--parallel', help='run on up to N hosts at once', type=int, metavar='N')
+    parser_port.set_defaults(func=execute_port)
+
+    parser_status = subparser.add_parser('status', help='#  Show state of all projects on hosts')
+    parser_status.add_argument('--host', help='host names to query [default=hotels]', nargs='+', default='hotels')
+    parser_status.add_argument('--ttl', help='use results cached less than N seconds ago, 0 to bypass cache '
+                                             '[default=30]', type=int, default=30, metavar='N')
+    parser_status.add_argument('--watch', help='refresh every N seconds, rewriting changed rows', type=int,
+                               metavar='N')
+    parser_status.set_defaults(func=execute_status)
+
+    parser_logs = subparser.add_parser('logs', help='#  Show project logs')
+    parser_logs.add_argument('--name', help='project name(s)', nargs='+', required=True)
+    parser_logs.add_argument('--host', help='host names to read logs on [default=hotels]', nargs='+',
+                             default='hotels')
+    parser_logs.add_argument('--file', help='log files [default=all]', nargs='+',
+                             choices=['stdout.log', 'stderr.log', 'access.log', 'error.log'])
+    parser_logs.add_argument('--grep', help='show only lines matching extended regular expression, filtered on host',
+                             default='', metavar='PATTERN')
+    parser_logs.add_argument('--lines', help='number of last lines of every file to show [default=20]', type=int,
+                             default=20, metavar='N')
+    parser_logs.add_argument('--since-last', help='show only lines written since previous hmara logs',
+                             action='store_true')
+    parser_logs.add_argument('--follow', help='keep streaming new lines', action='store_true')
+    parser_logs.set_defaults(func=execute_logs)
+
+    parser_stats = subparser.add_parser('stats', help='#  Show request rate, statuses and latency from access logs')
+    parser_stats.add_argument('--name', help='project name(s)', nargs='+', required=True)
+    parser_stats.add_argument('--host', help='host names to read logs on [default=hotels]', nargs='+',
+                              default='hotels')
+    parser_stats.add_argument('--top', help='number of slowest urls to show [default=10]', type=int, default=10,
+                              metavar='N')
+    parser_stats.set_defaults(func=execute_stats)
+
     parser_version = subparser.add_parser('version', help='#  Print hmara version')
     parser_version.set_defaults(func=execute_version)
 
@@ -212,14 +475,53 @@ def main():
     parser_update.set_defaults(func=execute_update)
 
     parser_pg = subparser.add_parser('pg', help='#  Manage database')
-    parser_pg.add_argument('subcommand', choices=['dump', 'restore'])
-    parser_pg.add_argument('--name', help='project name', required=True)
+    parser_pg.add_argument('subcommand', choices=['dump', 'restore', 'inspect', 'backup', 'snapshots', 'rollback'])
+    parser_pg.add_argument('--name', help='project name')
     parser_pg.add_argument('--host', help='host name to run command on  [default=hotels]', nargs='+', default='hotels')
+    parser_pg.add_argument('--parallel', help='run on up to N hosts at once', type=int, metavar='N')
     parser_pg.add_argument('--dump', help='dump file name [default=latest.dump]', default='latest.dump')
+    parser_pg.add_argument('--stream', help='stream dump over ssh without remote temp file', action='store_true')
+    parser_pg.add_argument('--compress', help='compress streamed dump', choices=['gzip', 'zstd'])
+    parser_pg.add_argument('--level', help='compression level', type=int)
+    parser_pg.add_argument('--jobs', help='dump in parallel directory format or restore with N jobs, backup: dump '
+                                          'N databases at once on each host [default=4]', type=int, metavar='N')
+    parser_pg.add_argument('--tables', nargs='+', help='restore only these tables')
+    parser_pg.add_argument('--exclude-tables', nargs='+', help='restore everything except these tables')
+    parser_pg.add_argument('--data-only', help='restore only data, keep schema', action='store_true')
+    parser_pg.add_argument('--cascade', help='data-only: also empty tables referencing restored ones',
+                           action='store_true')
+    parser_pg.add_argument('--shadow', help='restore into <database>_shadow while project runs, check it and swap it '
+                                            'in, keeping previous database for pg rollback', action='store_true')
+    parser_pg.add_argument('--table', help='inspect: extract data of this table')
+    parser_pg.add_argument('--output', help='inspect: write extracted table data to file')
+    parser_pg.add_argument('--all', help='backup: databases of all projects on host', action='store_true')
+    parser_pg.add_argument('--store', help='backup store folder [default=~/.hmara/pg-store]')
+    parser_pg.add_argument('--keep-daily', help='backup: keep last snapshot of N last days [default=7]', type=int,
+                           default=7, metavar='N')
+    parser_pg.add_argument('--keep-weekly', help='backup: keep last snapshot of N last weeks [default=4]', type=int,
+                           default=4, metavar='N')
+    parser_pg.add_argument('--snapshot', help='restore: snapshot from backup store, id or latest')
     parser_pg.set_defaults(func=execute_pg)
 
-    args = parser.parse_args()
-    args.func(args)
+    parser_agent = subparser.add_parser('agent', help='#  Keep ssh connections open between commands')
+    parser_agent.add_argument('subcommand', choices=['start', 'stop', 'status'])
+    parser_agent.add_argument('--idle-timeout', help='close connections after N idle seconds [default=600]',
+                              type=int, default=agent.IDLE_TIMEOUT, metavar='N')
+    parser_agent.set_defaults(func=execute_agent)
+
+    args = parser.parse_args(argv)
+    from colorama import init
+
+    init()
+    redaction.install()
+    setup_logging()
+    try:
+        if args.trace or args.profile:
+            run_traced(args, argv)
+        else:
+            args.func(args)
+    finally:
+        redaction.release()
 
 
 if __name__ == '__main__':
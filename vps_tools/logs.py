@@ -0,0 +1,219 @@
+from __future__ import unicode_literals, print_function
+
+import multiprocessing
+import os
+import sys
+
+from six.moves.queue import Empty
+from fabric.api import settings, hide
+from fabric.colors import green, red
+from fabric.state import env, connections
+from fabric.network import disconnect_all
+
+from .agent import AGENT_DIR
+from .status import load_cache, store_cache
+from .transport import script_command
+from .utils import stream_command
+
+__all__ = ['LOG_FILES', 'OFFSETS_PATH', 'DEFAULT_LINES', 'LogParser', 'logs_command', 'read_host', 'read_hosts',
+           'show_logs']
+
+LOG_FILES = ['stdout.log', 'stderr.log', 'access.log', 'error.log']
+ERROR_LOG_FILES = ['stderr.log', 'error.log']
+OFFSETS_PATH = os.path.join(AGENT_DIR, 'log-offsets.json')
+DEFAULT_LINES = 20
+
+# every output line is "<project>/<file>\t<offset after line>\t<line>", offsets let --since-last resume
+logs_script = """pattern=$1; lines=$2; follow=$3; shift 3
+export LC_ALL=C PATTERN="$pattern"
+# mawk reads input in blocks unless interactive, followed lines would wait for block to fill
+awk -W version 2>&1 | grep -q mawk && interactive='-W interactive'
+emit() {
+    awk $interactive -v tag="$1" -v offset="$2" '{
+        offset += length($0) + 1
+        if ($0 ~ ENVIRON["PATTERN"]) { printf "%s\\t%.0f\\t%s\\n", tag, offset, $0; fflush() }
+    }'
+}
+while [ $# -ge 4 ]; do
+    name=$1; file=$2; inode=$3; offset=$4; shift 4
+    path=/home/$name/logs/$file
+    [ -f $path ] || continue
+    current=$(stat -c %i $path); size=$(stat -c %s $path)
+    echo "@@file $name/$file $current $size"
+    if [ "$inode" = "$current" ] && [ $offset -le $size ]; then
+        start=$offset
+    elif [ "$inode" != "-" ]; then
+        if [ -f $path.1 ] && [ "$(stat -c %i $path.1)" = "$inode" ]; then
+            tail -c +$((offset + 1)) $path.1 | emit $name/$file.1 $offset
+        fi
+        start=0
+    else
+        start=$((size - $(tail -n $lines $path | wc -c)))
+        [ $start -lt 0 ] && start=0
+    fi
+    if [ "$follow" = 1 ]; then
+        tail -c +$((start + 1)) -F $path 2>/dev/null | emit $name/$file $start &
+    else
+        tail -c +$((start + 1)) $path | head -c $((size - start)) | emit $name/$file $start
+    fi
+done
+if [ "$follow" = 1 ]; then
+    # nothing tells tails that client is gone, heartbeat fails once connection is closed and stops them all
+    (trap '' PIPE; while sleep 5; do echo || break; done; kill 0) &
+fi
+wait
+exit 0
+"""
+
+
+class LogParser(object):
+    """
+    File-like object splitting output of logs_script into events, passed to deliver in batches, one per chunk:
+    ('file', tag, inode, size) when reading of file starts and ('line', tag, offset, text) for every line.
+    """
+
+    def __init__(self, deliver):
+        self.deliver = deliver
+        self.rest = b''
+
+    def write(self, data):
+        lines = (self.rest + data).split(b'\n')
+        self.rest = lines.pop()
+        events = []
+        for line in lines:
+            line = line.decode('utf-8', 'replace')
+            if line.startswith('@@file '):
+                _, tag, inode, size = line.split(' ')
+                events.append(('file', tag, inode, int(size)))
+                continue
+            parts = line.split('\t', 2)
+            if len(parts) == 3 and parts[1].isdigit():
+                events.append(('line', parts[0], int(parts[1]), parts[2]))
+        if events:
+            self.deliver(events)
+
+
+def logs_command(project_names, files, offsets, pattern='', lines=DEFAULT_LINES, follow=False, since_last=False):
+    """
+    Command running logs_script for files of projects; with since_last files are read from saved offsets.
+    """
+    args = [pattern or '', str(lines), '1' if follow else '0']
+    for project_name in project_names:
+        for file_name in files:
+            inode, offset = offsets.get('{}/{}'.format(project_name, file_name), ['-', 0]) if since_last \
+                else ['-', 0]
+            args += [project_name, file_name, str(inode), str(offset)]
+    return script_command(logs_script, args)
+
+
+def read_host(host, command, deliver):
+    """
+    Stream output of logs command on host over one channel into deliver.
+    """
+    with settings(host_string=host), hide('running'):
+        stream_command(command, LogParser(deliver))
+
+
+def _read_on_host(host, command, queue):
+    connections.clear()
+    env.abort_on_prompts = True
+    try:
+        read_host(host, command, lambda events: queue.put((host, events, None)))
+    except BaseException as e:
+        queue.put((host, None, '{}: {}'.format(type(e).__name__, e)))
+    else:
+        queue.put((host, None, None))
+    finally:
+        disconnect_all()
+
+
+def read_hosts(commands, deliver, finish):
+    """
+    Read logs of several hosts at once, one process and one connection per host. Events of host are passed
+    to deliver(host, events) as they arrive, finish(host, error) is called when host is done.
+    """
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_read_on_host, args=(host, command, queue))
+                 for host, command in commands.items()]
+    for process in processes:
+        process.daemon = True
+        process.start()
+    running = len(processes)
+    try:
+        while running:
+            try:
+                host, events, error = queue.get(timeout=1)
+            except Empty:
+                if not any(process.is_alive() for process in processes):
+                    break
+                continue
+            if events is not None:
+                deliver(host, events)
+            else:
+                running -= 1
+                finish(host, error)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+def show_logs(hosts, project_names, files=None, pattern='', lines=DEFAULT_LINES, follow=False, since_last=False):
+    """
+    Print lines of project logs from all hosts as they arrive, prefixed with host when there are several
+    and with project and log file. Offsets of read data are saved, so since_last shows only new lines.
+    Returns dict host -> error of hosts which failed.
+    """
+    files = files or LOG_FILES
+    saved = load_cache(OFFSETS_PATH)
+    # host -> tag -> [inode, offset after last received line, size when reading started]
+    offsets = dict((host, {}) for host in hosts)
+    commands = dict((host, logs_command(project_names, files, saved.get(host, {}), pattern, lines, follow,
+                                        since_last)) for host in hosts)
+    completed = set()
+    errors = {}
+
+    def deliver(host, events):
+        host_offsets = offsets[host]
+        out = []
+        for event in events:
+            if event[0] == 'file':
+                _, tag, inode, size = event
+                host_offsets[tag] = [inode, None, size]
+                continue
+            _, tag, offset, text = event
+            if tag in host_offsets:
+                host_offsets[tag][1] = max(host_offsets[tag][1] or 0, offset)
+            color = red if tag.split('/', 1)[-1] in ERROR_LOG_FILES else green
+            prefix = '[{}] {}'.format(host, tag) if len(hosts) > 1 else tag
+            out.append('{} {}\n'.format(color(prefix), text))
+        sys.stdout.write(''.join(out))
+        sys.stdout.flush()
+
+    def finish(host, error):
+        if error:
+            errors[host] = error
+        else:
+            completed.add(host)
+
+    try:
+        if len(hosts) == 1:
+            read_host(hosts[0], commands[hosts[0]], lambda events: deliver(hosts[0], events))
+            finish(hosts[0], None)
+        else:
+            read_hosts(commands, deliver, finish)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for host in hosts:
+            for tag, (inode, offset, size) in offsets[host].items():
+                # whole file up to size was scanned only when reading without follow completed
+                if host in completed and not follow:
+                    offset = size
+                if offset is not None:
+                    saved.setdefault(host, {})[tag] = [inode, offset]
+        store_cache(saved, OFFSETS_PATH)
+    for host, error in sorted(errors.items()):
+        sys.stdout.write(red('[{}] {}\n'.format(host, error)))
+    return errors
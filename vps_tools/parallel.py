@@ -0,0 +1,145 @@
+from __future__ import unicode_literals, print_function
+
+import multiprocessing
+import sys
+import tempfile
+import time
+
+import six
+from six.moves.queue import Empty
+from fabric.api import execute, env, hide
+from fabric.colors import green, red
+from fabric.network import disconnect_all
+from fabric.state import connections
+from fabric.utils import puts
+
+from .redaction import RedactingStream
+
+__all__ = ['HostResult', 'execute_parallel', 'execute_on_hosts', 'collect_from_hosts', 'print_summary']
+
+
+class HostResult(object):
+    def __init__(self, host, succeeded, duration, result=None, error=None):
+        self.host = host
+        self.succeeded = succeeded
+        self.duration = duration
+        self.result = result
+        self.error = error
+
+
+class BufferedOutput(object):
+    """
+    File-like object collecting everything a task prints on one host.
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+
+    def write(self, data):
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def isatty(self):
+        return False
+
+    def lines(self):
+        self.file.flush()
+        self.file.seek(0)
+        return self.file.read().decode('utf-8', 'replace').splitlines()
+
+
+def _run_on_host(task, host, args, kwargs, output, queue):
+    sys.stdout = sys.stderr = RedactingStream(output)
+    connections.clear()
+    env.output_prefix = False
+    env.abort_on_prompts = True
+    started = time.time()
+    tracer = env.get('tracer')
+    try:
+        result = execute(task, *args, hosts=[host], **kwargs)[host]
+    except BaseException as e:
+        queue.put((False, time.time() - started, None, '{}: {}'.format(type(e).__name__, e),
+                   tracer.events if tracer else []))
+    else:
+        queue.put((True, time.time() - started, result, None, tracer.events if tracer else []))
+    finally:
+        disconnect_all()
+        sys.stdout.release()
+
+
+def _emit(host, output):
+    for line in output.lines():
+        sys.stdout.write('[{}] {}\n'.format(host, line))
+    sys.stdout.flush()
+
+
+def execute_parallel(task, hosts, pool_size, *args, **kwargs):
+    """
+    Run fabric task on up to pool_size hosts at once. Output of every host is buffered and printed
+    prefixed with host name when the host finishes. Returns dict host -> HostResult.
+    """
+    pending = list(hosts)
+    running = {}
+    results = {}
+    while pending or running:
+        while pending and len(running) < max(pool_size, 1):
+            host = pending.pop(0)
+            output = BufferedOutput()
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_run_on_host, args=(task, host, args, kwargs, output, queue))
+            process.start()
+            running[host] = (process, output, queue, time.time())
+        for host, (process, output, queue, started) in list(running.items()):
+            try:
+                succeeded, duration, result, error, events = queue.get_nowait()
+            except Empty:
+                if process.is_alive():
+                    continue
+                succeeded, duration, result, events = False, time.time() - started, None, []
+                error = 'worker exited with code {}'.format(process.exitcode)
+            if env.get('tracer') is not None:
+                env.tracer.events.extend(events)
+            process.join()
+            del running[host]
+            _emit(host, output)
+            results[host] = HostResult(host, succeeded, duration, result=result, error=error)
+        time.sleep(0.05)
+    return results
+
+
+def execute_on_hosts(task, hosts, *args, **kwargs):
+    """
+    Run task on all hosts at once, a single host runs in this process. Returns dict host -> (result, error).
+    """
+    if len(hosts) == 1:
+        try:
+            return {hosts[0]: (execute(task, *args, hosts=hosts, **kwargs)[hosts[0]], None)}
+        except (Exception, SystemExit) as e:
+            return {hosts[0]: (None, '{}: {}'.format(type(e).__name__, e))}
+    results = execute_parallel(task, hosts, len(hosts), *args, **kwargs)
+    return dict((host, (result.result, result.error)) for host, result in results.items())
+
+
+def collect_from_hosts(task, hosts, *args, **kwargs):
+    """
+    Run task returning data on all hosts at once with output hidden. Returns dict host -> (result, error).
+    """
+    with hide('everything'):
+        return execute_on_hosts(task, hosts, *args, **kwargs)
+
+
+def print_summary(results):
+    width = max([len('host')] + [len(host) for host in results])
+    puts('{}  {:<7}  {:>9}'.format('host'.ljust(width), 'status', 'duration'), show_prefix=False)
+    for host in sorted(results):
+        result = results[host]
+        color = green if result.succeeded else red
+        line = '{}  {:<7}  {:>8.1f}s'.format(host.ljust(width), 'ok' if result.succeeded else 'failed',
+                                            result.duration)
+        if result.error:
+            line += '  {}'.format(result.error)
+        puts(color(line), show_prefix=False)
@@ -1,35 +1,500 @@
 from __future__ import unicode_literals, print_function
 
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from StringIO import StringIO
+
 import dj_database_url
+import six
 import sys
-from fabric.api import task, sudo, get, settings, shell_env, cd, hide
-from fabric.contrib.files import put
+from fabric.api import task, settings, shell_env, cd, hide
+from fabric.colors import green, red, yellow
+from fabric.utils import puts, abort
+
+from .utils import load_environment_dict, stream_command
+from .bluegreen import stop_project, start_project
+from .pg_archive import Archive
+from .transport import sudo, get, put, run_script
+from .tracing import traced
+from .redaction import redacting
+
+COMPRESSORS = {
+    'gzip': ('gzip -{level}', '.gz', 6),
+    'zstd': ('zstd -q -{level} -c', '.zst', 3),
+}
+
+TOC_DESCS = ['MATERIALIZED VIEW DATA', 'SEQUENCE OWNED BY', 'TABLE DATA', 'SEQUENCE SET', 'FK CONSTRAINT',
+             'CHECK CONSTRAINT', 'MATERIALIZED VIEW', 'FOREIGN TABLE', 'DEFAULT ACL', 'EVENT TRIGGER', 'LARGE OBJECT',
+             'PROCEDURAL LANGUAGE', 'SHELL TYPE', 'OPERATOR CLASS', 'OPERATOR FAMILY', 'USER MAPPING',
+             'FOREIGN DATA WRAPPER', 'TEXT SEARCH CONFIGURATION', 'TEXT SEARCH DICTIONARY', 'TEXT SEARCH PARSER',
+             'TEXT SEARCH TEMPLATE']
+TOC_TABLE_CHILD_DESCS = ['CONSTRAINT', 'FK CONSTRAINT', 'CHECK CONSTRAINT', 'DEFAULT', 'TRIGGER', 'RULE', 'POLICY']
+
+# row counts are planner estimates, exact after ANALYZE of shadow database, good enough to tell empty tables
+shadow_check_script = """live=$1; shadow=$2; archive=$3
+tables="SELECT n.nspname || '.' || c.relname, greatest(c.reltuples, 0)::bigint FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind IN ('r', 'p') AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+    AND n.nspname NOT LIKE 'pg_toast%'"
+tab=$(printf '\\t')
+psql -q -d $shadow -c ANALYZE || exit 1
+echo '@@toc'; pg_restore -l $archive || exit 1
+echo '@@shadow'; psql -tA -F "$tab" -d $shadow -c "$tables" || exit 1
+echo '@@live'; psql -tA -F "$tab" -d $live -c "$tables" 2>/dev/null
+exit 0
+"""
+
+# tables missing in database and other tables referencing them with foreign keys: TRUNCATE of data-only restore
+# fails on both unless it cascades, DROP of --clean fails on referenced ones
+truncate_check_script = """name=$1; shift
+tables=$(printf "'%s'," "$@")
+tables="SELECT to_regclass(t) AS oid, t FROM unnest(ARRAY[${tables%,}]) t"
+echo '@@missing'
+psql -tA -d $name -c "SELECT t FROM ($tables) tables WHERE oid IS NULL" || exit 1
+echo '@@referencing'
+psql -tA -d $name -c "SELECT DISTINCT conrelid::regclass FROM pg_constraint WHERE contype = 'f'
+    AND confrelid IN (SELECT oid FROM ($tables) tables WHERE oid IS NOT NULL)
+    AND conrelid NOT IN (SELECT oid FROM ($tables) tables WHERE oid IS NOT NULL)" || exit 1
+exit 0
+"""
+
+# data-only restore in one transaction: tables are emptied and filled again, or left as they were on any error.
+# pg_restore writes SQL instead of connecting, when it fails there is no COMMIT and psql rolls back at end of input
+data_restore_script = """name=$1; list=$2; archive=$3; tables=$4
+failed=$(mktemp)
+{
+    echo 'BEGIN;'
+    [ -z "$tables" ] || echo "TRUNCATE $tables;"
+    pg_restore --no-acl --no-owner --data-only --disable-triggers -L $list -f - $archive && echo 'COMMIT;' ||
+        echo failed > $failed
+} | psql -q -X -v ON_ERROR_STOP=1 -d $name
+status=$?
+[ -s $failed ] && status=1
+rm -f $failed
+exit $status
+"""
 
-from .utils import StreamFilter, load_environment_dict
+# other database becomes live one in one transaction, live one is kept as <live>_prev; new connections to live
+# database are refused while its sessions are terminated, so nothing holds it during rename
+swap_databases_script = """live=$1; other=$2
+sql() { psql -q -v ON_ERROR_STOP=1 -d postgres -tA -c "$1"; }
+sql "ALTER DATABASE \\"$live\\" WITH ALLOW_CONNECTIONS false" || exit 1
+sql "SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname IN ('$live', '$other')
+    AND pid <> pg_backend_pid()" > /dev/null
+for i in $(seq 50); do
+    [ "$(sql "SELECT count(*) FROM pg_stat_activity WHERE datname IN ('$live', '$other')")" = 0 ] && break
+    sleep 0.1
+done
+if ! psql -q -v ON_ERROR_STOP=1 -d postgres <<SQL
+BEGIN;
+ALTER DATABASE "$live" RENAME TO "${live}_swap";
+ALTER DATABASE "$other" RENAME TO "$live";
+ALTER DATABASE "${live}_swap" RENAME TO "${live}_prev";
+COMMIT;
+SQL
+then
+    sql "ALTER DATABASE \\"$live\\" WITH ALLOW_CONNECTIONS true"
+    exit 1
+fi
+sql "ALTER DATABASE \\"${live}_prev\\" WITH ALLOW_CONNECTIONS true"
+"""
+
+
+class HashingFile(object):
+    """
+    Write-only file wrapper computing sha256 of everything written.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.stream.write(data)
+
+
+def stream_dump(database, dump, compress=None, level=None, jobs=None):
+    """
+    Pipe pg_dump output straight over SSH into local file, optionally compressed with gzip or zstd.
+    With jobs database is dumped in parallel directory format and streamed as tar archive.
+    Writes <dump>.sha256 next to the dump and returns path of the dump.
+    """
+    if jobs:
+        command = ('dir=$(mktemp -d) && trap "rm -rf $dir" EXIT && '
+                   'pg_dump -Fd -j {jobs} {z} --no-acl --no-owner -f $dir/dump {NAME} && '
+                   'tar -C $dir -cf - dump').format(jobs=jobs, z='-Z0' if compress else '', **database)
+        dump += '.tar'
+    else:
+        command = 'pg_dump -Fc {z} --no-acl --no-owner {NAME}'.format(z='-Z0' if compress else '', **database)
+    if compress:
+        compressor, suffix, default_level = COMPRESSORS[compress]
+        command += ' | ' + compressor.format(level=level or default_level)
+        dump += suffix
+    partial = dump + '.part'
+    try:
+        with open(partial, 'wb') as dump_file:
+            output = HashingFile(dump_file)
+            stream_command(command, output, user='postgres', label=os.path.basename(dump))
+    except BaseException:
+        # failed pg_dump, ssh or compressor aborts, do not leave truncated dump behind
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.rename(partial, dump)
+    with open(dump + '.sha256', 'w') as checksum_file:
+        checksum_file.write('{}  {}\n'.format(output.sha256.hexdigest(), os.path.basename(dump)))
+    puts(green('{} sha256 {}'.format(dump, output.sha256.hexdigest())))
+    return dump
 
 
 @task
-def dump(project_name, dump):
+@traced
+def dump(project_name, dump, stream=False, compress=None, level=None, jobs=None):
+    """
+    Dump project database. Usage: pg dump --name <project_name> [--stream] [--compress gzip|zstd] [--level N]
+    [--jobs N]
+    """
     remote_env = load_environment_dict(project_name)
     database = dj_database_url.parse(remote_env['DATABASE_URL'])
+    if stream or compress or jobs:
+        return stream_dump(database, dump, compress=compress, level=level, jobs=jobs)
     home_folder = '/home/{project_name}'.format(project_name=project_name)
     with cd(home_folder), settings(sudo_user='postgres'), shell_env(HOME=home_folder), hide('output'):
-        with StreamFilter([database['PASSWORD']], sys.stdout):
+        with redacting([database['PASSWORD']]):
             sudo('PGPASSWORD={PASSWORD} pg_dump -Fc --no-acl --no-owner {NAME} > /tmp/{NAME}_latest.dump'.format(**database))
         get('/tmp/{NAME}_latest.dump'.format(**database), dump)
 
 
+def parse_toc_line(line):
+    """
+    Split line of pg_restore -l output into (desc, schema, tag, owner), None for comments.
+    """
+    if line.startswith(';') or ';' not in line:
+        return None
+    fields = line.split(';', 1)[1].split()[2:]
+    for desc in TOC_DESCS:
+        words = desc.split()
+        if fields[:len(words)] == words:
+            fields = fields[len(words):]
+            break
+    else:
+        desc, fields = fields[0], fields[1:]
+    return desc, fields[0], ' '.join(fields[1:-1]), fields[-1]
+
+
+def filter_toc(toc, tables=None, exclude_tables=None, data_only=False):
+    """
+    Filter pg_restore -l output down to entries of selected tables. Constraints, defaults and triggers
+    belong to table named first in their tag, indexes and sequences to the longest table name they start with.
+    """
+    entries = [(line, parse_toc_line(line)) for line in toc.splitlines()]
+    table_names = sorted([entry[2] for line, entry in entries if entry and entry[0] in ('TABLE', 'TABLE DATA')],
+                         key=len, reverse=True)
+
+    def table_of(entry):
+        desc, schema, tag, owner = entry
+        if desc in ('TABLE', 'TABLE DATA'):
+            return tag
+        if desc in TOC_TABLE_CHILD_DESCS:
+            return tag.split()[0]
+        if desc in ('INDEX', 'SEQUENCE', 'SEQUENCE SET', 'SEQUENCE OWNED BY'):
+            for table_name in table_names:
+                if tag.startswith(table_name + '_'):
+                    return table_name
+        return None
+
+    selected = []
+    for line, entry in entries:
+        if entry is None:
+            continue
+        table_name = table_of(entry)
+        if tables and table_name not in tables:
+            continue
+        if exclude_tables and table_name in exclude_tables:
+            continue
+        if data_only and entry[0] not in ('TABLE DATA', 'SEQUENCE SET'):
+            continue
+        selected.append((line, entry))
+    return selected
+
+
+def check_tables(database, tables):
+    """
+    Return (tables missing in database, other tables referencing them with foreign keys).
+    """
+    with settings(sudo_user='postgres'), hide('output'):
+        output = run_script(truncate_check_script, database['NAME'], *tables)
+    sections = {}
+    section = None
+    for line in output.splitlines():
+        if line.startswith('@@'):
+            section = sections.setdefault(line[2:].strip(), [])
+        elif section is not None and line.strip():
+            section.append(line.strip())
+    return sections.get('missing', []), sections.get('referencing', [])
+
+
+def check_truncate(database, data_tables, cascade=False):
+    """
+    Abort before project is stopped when TRUNCATE of data-only restore would fail: tables missing in database
+    or referenced by tables which are not restored. Those are emptied too only with cascade.
+    """
+    missing, referencing = check_tables(database, data_tables)
+    if missing:
+        abort('not in database {}: {}'.format(database['NAME'], ', '.join(missing)))
+    if referencing and not cascade:
+        abort('TRUNCATE would fail, these tables reference restored ones: {}; add them to --tables or pass '
+              '--cascade to empty them too'.format(', '.join(referencing)))
+    if referencing:
+        puts(yellow('emptied by cascade, not restored: {}'.format(', '.join(referencing))))
+
+
+def check_clean(database, restored_tables):
+    """
+    Abort before project is stopped when --clean of partial restore would fail: restored tables referenced by
+    tables which are not restored can not be dropped.
+    """
+    missing, referencing = check_tables(database, restored_tables)
+    if referencing:
+        abort('restored tables can not be dropped, these tables reference them: {}; add them to --tables or '
+              'restore with --data-only'.format(', '.join(referencing)))
+
+
+def upload_dump(database, dump):
+    """
+    Upload local dump and unpack it if it was streamed compressed or as directory format tar.
+    Returns remote path of the archive for pg_restore.
+    """
+    remote_path = '/tmp/{NAME}_latest.dump'.format(**database)
+    suffix = ''
+    for extension in ('.gz', '.zst'):
+        if dump.endswith(extension):
+            suffix = extension
+    put(dump, remote_path + suffix)
+    if suffix == '.gz':
+        sudo('gzip -df {}'.format(remote_path + suffix))
+    elif suffix == '.zst':
+        sudo('zstd -dfq --rm {}'.format(remote_path + suffix))
+    if dump[:len(dump) - len(suffix)].endswith('.tar'):
+        directory = '/tmp/{NAME}_latest'.format(**database)
+        sudo('rm -rf {dir} && mkdir {dir} && tar -xf {path} -C {dir} && rm {path} && chmod -R a+rX {dir}'.format(
+            dir=directory, path=remote_path))
+        return '{}/dump'.format(directory)
+    return remote_path
+
+
 @task
-def restore(project_name, dump):
+@traced
+def restore(project_name, dump, jobs=None, tables=None, exclude_tables=None, data_only=False, cascade=False):
+    """
+    Restore project database. Usage: pg restore --name <project_name> [--jobs N] [--tables <table> ...]
+    [--exclude-tables <table> ...] [--data-only [--cascade]]
+    """
     remote_env = load_environment_dict(project_name)
     database = dj_database_url.parse(remote_env['DATABASE_URL'])
     home_folder = '/home/{project_name}'.format(project_name=project_name)
-    sudo('supervisorctl stop {project_name}'.format(project_name=project_name))
-    with cd(home_folder), settings(sudo_user='postgres'), shell_env(HOME=home_folder):
-        put(dump, '/tmp/{NAME}_latest.dump'.format(**database))
-        with settings(sudo_user='postgres'):
-            sudo('dropdb --if-exists -h {HOST} -p {PORT} {NAME}'.format(**database))
-            sudo('createdb {NAME} -O {USER} -h {HOST} -p {PORT}'.format(**database))
-        with hide('output'), settings(warn_only=True), StreamFilter([database['PASSWORD']], sys.stdout):
-            sudo('PGPASSWORD={PASSWORD} pg_restore --clean --no-acl --no-owner -d {NAME} /tmp/{NAME}_latest.dump'.format(**database))
-    sudo('supervisorctl start {project_name}'.format(project_name=project_name))
\ No newline at end of file
+    timings = OrderedDict()
+
+    started = time.time()
+    archive = upload_dump(database, dump)
+    options = '--no-acl --no-owner'
+    if jobs:
+        options += ' -j {}'.format(jobs)
+    partial = tables or exclude_tables or data_only
+    if partial:
+        with hide('output'):
+            toc = sudo('pg_restore -l {}'.format(archive), pty=False, combine_stderr=False)
+        selected = filter_toc(toc, tables=tables, exclude_tables=exclude_tables, data_only=data_only)
+        list_path = '/tmp/{NAME}_restore.list'.format(**database)
+        put(StringIO('\n'.join(line for line, entry in selected) + '\n'), list_path)
+        options += ' -L {}'.format(list_path)
+    data_tables = []
+    if data_only:
+        data_tables = ['"{}"."{}"'.format(schema, tag) for desc, schema, tag, owner in
+                       (entry for line, entry in selected) if desc == 'TABLE DATA']
+        if data_tables:
+            check_truncate(database, data_tables, cascade=cascade)
+    elif partial:
+        # first error rolls back whole restore instead of leaving some tables dropped
+        options += ' --clean --if-exists --single-transaction'
+        check_clean(database, ['"{}"."{}"'.format(schema, tag) for desc, schema, tag, owner in
+                               (entry for line, entry in selected) if desc == 'TABLE'])
+    else:
+        options += ' --clean --if-exists'
+    timings['upload'] = time.time() - started
+
+    stop_project(project_name)
+    try:
+        with cd(home_folder), settings(sudo_user='postgres'), shell_env(HOME=home_folder):
+            started = time.time()
+            if not partial:
+                sudo('dropdb --if-exists -h {HOST} -p {PORT} {NAME}'.format(**database))
+                sudo('createdb {NAME} -O {USER} -h {HOST} -p {PORT}'.format(**database))
+                timings['drop/create'] = time.time() - started
+
+            started = time.time()
+            with hide('output'), settings(warn_only=True):
+                if data_only:
+                    # restored data is not mixed with rows left, nothing is emptied unless all of it is restored
+                    truncate = ', '.join(data_tables) + (' CASCADE' if cascade and data_tables else '')
+                    result = run_script(data_restore_script, database['NAME'], list_path, archive, truncate)
+                else:
+                    with redacting([database['PASSWORD']]):
+                        result = sudo('PGPASSWORD={PASSWORD} pg_restore {options} -d {NAME} {archive}'.format(
+                            options=options, archive=archive, **database), combine_stderr=False)
+        sudo('rm -rf /tmp/{NAME}_latest.dump /tmp/{NAME}_latest /tmp/{NAME}_restore.list'.format(**database))
+        timings['restore'] = time.time() - started
+    finally:
+        started = time.time()
+        start_project(project_name)
+        timings['restart'] = time.time() - started
+    if result.failed:
+        abort('pg_restore exited with code {}, database {}:\n{}'.format(
+            result.return_code, 'is left as it was' if partial else 'may be restored partially', result.stderr))
+
+    for phase, elapsed in six.iteritems(timings):
+        puts(green('{:<12} {:>8.1f}s'.format(phase, elapsed)))
+
+
+def check_shadow(database, shadow, archive):
+    """
+    Compare shadow database with archive it was restored from and with live database. Returns list of problems:
+    tables of archive missing in shadow and tables with rows in live database which are empty in shadow.
+    """
+    sections = {}
+    section = None
+    output = run_script(shadow_check_script, database['NAME'], shadow, archive)
+    for line in output.splitlines():
+        if line.startswith('@@'):
+            section = sections.setdefault(line[2:].strip(), [])
+        elif section is not None:
+            section.append(line)
+    expected = set('{}.{}'.format(schema, tag) for desc, schema, tag, owner in
+                   filter(None, (parse_toc_line(line) for line in sections.get('toc', []))) if desc == 'TABLE')
+    shadow_rows = dict(line.rsplit('\t', 1) for line in sections.get('shadow', []) if '\t' in line)
+    live_rows = dict(line.rsplit('\t', 1) for line in sections.get('live', []) if '\t' in line)
+    puts('shadow: {} tables, {} rows; live: {} tables, {} rows'.format(
+        len(shadow_rows), sum(int(rows) for rows in shadow_rows.values()), len(live_rows),
+        sum(int(rows) for rows in live_rows.values())))
+    dropped = sorted(set(live_rows) - set(shadow_rows))
+    if dropped:
+        puts(yellow('not in dump, gone after swap: {}'.format(', '.join(dropped))))
+    problems = ['{} is missing'.format(table) for table in sorted(expected - set(shadow_rows))]
+    problems += ['{} is empty, live database has {} rows'.format(table, live_rows[table]) for table in
+                 sorted(shadow_rows) if shadow_rows[table] == '0' and live_rows.get(table, '0') != '0']
+    return problems
+
+
+def swap_databases(project_name, live, other):
+    """
+    Make database other the live one and keep live one as <live>_prev, project is stopped only meanwhile.
+    Returns downtime in seconds.
+    """
+    started = time.time()
+    stop_project(project_name)
+    try:
+        with settings(sudo_user='postgres'), hide('output'):
+            run_script(swap_databases_script, live, other)
+    finally:
+        start_project(project_name)
+    return time.time() - started
+
+
+@task
+@traced
+def shadow_restore(project_name, dump, jobs=None):
+    """
+    Restore project database into <name>_shadow while project keeps running, check it and swap it in,
+    previous database is kept as <name>_prev. Usage: pg restore --name <project_name> --shadow [--jobs N]
+    """
+    remote_env = load_environment_dict(project_name)
+    database = dj_database_url.parse(remote_env['DATABASE_URL'])
+    shadow = '{NAME}_shadow'.format(**database)
+    home_folder = '/home/{project_name}'.format(project_name=project_name)
+    timings = OrderedDict()
+
+    started = time.time()
+    archive = upload_dump(database, dump)
+    timings['upload'] = time.time() - started
+
+    try:
+        with cd(home_folder), settings(sudo_user='postgres'), shell_env(HOME=home_folder):
+            try:
+                started = time.time()
+                sudo('dropdb --if-exists -h {HOST} -p {PORT} {shadow}'.format(shadow=shadow, **database))
+                sudo('createdb {shadow} -O {USER} -h {HOST} -p {PORT}'.format(shadow=shadow, **database))
+                with hide('output'), redacting([database['PASSWORD']]):
+                    sudo('PGPASSWORD={PASSWORD} pg_restore --no-acl --no-owner --exit-on-error {jobs}-d {shadow} '
+                         '{archive}'.format(jobs='-j {} '.format(jobs) if jobs else '', shadow=shadow,
+                                            archive=archive, **database))
+                timings['restore'] = time.time() - started
+
+                started = time.time()
+                problems = check_shadow(database, shadow, archive)
+                timings['check'] = time.time() - started
+                for problem in problems:
+                    puts(red(problem))
+                if problems:
+                    abort('{} failed checks, live database {} is untouched'.format(shadow, database['NAME']))
+                sudo('dropdb --if-exists -h {HOST} -p {PORT} {NAME}_prev'.format(**database))
+            except SystemExit:
+                with settings(warn_only=True):
+                    sudo('dropdb --if-exists -h {HOST} -p {PORT} {shadow}'.format(shadow=shadow, **database))
+                raise
+    finally:
+        sudo('rm -rf /tmp/{NAME}_latest.dump /tmp/{NAME}_latest'.format(**database))
+
+    timings['swap'] = swap_databases(project_name, database['NAME'], shadow)
+
+    for phase, elapsed in six.iteritems(timings):
+        puts(green('{:<12} {:>8.1f}s'.format(phase, elapsed)))
+    puts(green('previous database is kept as {NAME}_prev, pg rollback --name {project} swaps it back'.format(
+        project=project_name, **database)))
+
+
+@task
+@traced
+def rollback(project_name):
+    """
+    Swap database with the one kept by last shadow restore or rollback. Usage: pg rollback --name <project_name>
+    """
+    remote_env = load_environment_dict(project_name)
+    database = dj_database_url.parse(remote_env['DATABASE_URL'])
+    with settings(sudo_user='postgres'), hide('output'):
+        found = sudo('psql -tAc "SELECT 1 FROM pg_database WHERE datname = \'{NAME}_prev\'"'.format(**database),
+                     pty=False, combine_stderr=False)
+    if found.strip() != '1':
+        abort('{}: there is no {NAME}_prev database to roll back to'.format(project_name, **database))
+    downtime = swap_databases(project_name, database['NAME'], '{NAME}_prev'.format(**database))
+    puts(green('{project}: swapped {NAME} with {NAME}_prev, downtime {downtime:.1f}s'.format(
+        project=project_name, downtime=downtime, **database)))
+
+
+def inspect(dump, table=None, output=None):
+    """
+    List objects of local custom format dump or extract data of one table. Usage: pg inspect --dump <file>
+    [--table <table> [--output <file>]]
+    """
+    archive = Archive.open(dump)
+    if table is None:
+        puts(green('{}: database {}, pg_dump {}, created {}'.format(dump, archive.dbname, archive.dump_version,
+                                                                    archive.created)))
+        puts('{:>6}  {:<20} {:<50} {:<16} {:>10} {:>12}'.format('id', 'type', 'name', 'owner', 'offset', 'size'))
+        for entry in archive.entries:
+            puts('{:>6}  {:<20} {:<50} {:<16} {:>10} {:>12}'.format(
+                entry.dump_id, entry.desc, entry.name, entry.owner or '',
+                '' if entry.data_offset is None else entry.data_offset,
+                '' if entry.compressed_size is None else entry.compressed_size))
+        return
+    entry = archive.table_data(table)
+    stream = open(output, 'wb') if output else getattr(sys.stdout, 'buffer', sys.stdout)
+    try:
+        stream.write(entry.copy_stmt.encode('utf-8'))
+        for data in archive.iter_data(entry):
+            stream.write(data)
+    finally:
+        if output:
+            stream.close()
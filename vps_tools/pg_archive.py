@@ -0,0 +1,299 @@
+from __future__ import unicode_literals, print_function
+
+import datetime
+import json
+import os
+import struct
+import zlib
+
+__all__ = ['ArchiveError', 'TocEntry', 'Archive']
+
+MAGIC = b'PGDMP'
+FORMAT_CUSTOM = 1
+MIN_VERSION = (1, 10)
+MAX_VERSION = (1, 16)
+
+OFFSET_POS_NOT_SET = 1
+OFFSET_POS_SET = 2
+OFFSET_NO_DATA = 3
+
+BLOCK_DATA = 1
+BLOCK_BLOBS = 3
+
+COMPRESSION_NONE = 0
+COMPRESSION_GZIP = 1
+
+INDEX_VERSION = 2
+INDEX_FIELDS = ['dump_id', 'had_dumper', 'table_oid', 'oid', 'tag', 'desc', 'section', 'copy_stmt', 'namespace',
+                'owner', 'dependencies', 'data_state', 'data_offset', 'compressed_size']
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class TocEntry(object):
+    """
+    One object of archive table of contents. Data block position and size on disk are filled
+    for entries with data, defn is not kept in sidecar index.
+    """
+
+    def __init__(self, **kwargs):
+        self.defn = None
+        self.data_offset = None
+        self.compressed_size = None
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    @property
+    def name(self):
+        if self.namespace:
+            return '{}.{}'.format(self.namespace, self.tag)
+        return self.tag
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in INDEX_FIELDS)
+
+
+class Reader(object):
+    """
+    Reads primitive values of pg_dump archive: sign-prefixed little-endian ints, length-prefixed strings
+    and offsets.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.int_size = 4
+        self.off_size = 8
+
+    def read(self, size):
+        data = self.stream.read(size)
+        if len(data) != size:
+            raise ArchiveError('unexpected end of archive')
+        return data
+
+    def read_byte(self):
+        return struct.unpack(b'B', self.read(1))[0]
+
+    def read_uint(self, size):
+        value = 0
+        for shift, byte in enumerate(bytearray(self.read(size))):
+            value |= byte << (shift * 8)
+        return value
+
+    def read_int(self):
+        sign = self.read_byte()
+        value = self.read_uint(self.int_size)
+        return -value if sign else value
+
+    def read_str(self):
+        length = self.read_int()
+        if length < 0:
+            return None
+        return self.read(length).decode('utf-8', 'replace')
+
+    def read_offset(self):
+        flag = self.read_byte()
+        return flag, self.read_uint(self.off_size)
+
+
+class Archive(object):
+    """
+    Custom format (pg_dump -Fc) archive. Only header and table of contents are parsed, data blocks
+    are found by offset and read on demand.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+
+    @classmethod
+    def open(cls, path, use_index=True):
+        """
+        Parse archive or load its cached index from <path>.idx when archive has not changed since.
+        """
+        archive = cls(path)
+        index_path = path + '.idx'
+        stat = os.stat(path)
+        if use_index and os.path.exists(index_path):
+            with open(index_path, 'r') as index_file:
+                try:
+                    index = json.load(index_file)
+                except ValueError:
+                    index = {}
+            if (index.get('index_version') == INDEX_VERSION and index.get('size') == stat.st_size and
+                    index.get('mtime') == stat.st_mtime):
+                archive.load_index(index)
+                return archive
+        archive.parse()
+        if use_index:
+            try:
+                with open(index_path, 'w') as index_file:
+                    json.dump(archive.to_index(size=stat.st_size, mtime=stat.st_mtime), index_file)
+            except (IOError, OSError):
+                pass
+        return archive
+
+    def parse(self):
+        with open(self.path, 'rb') as stream:
+            reader = Reader(stream)
+            self.read_header(reader)
+            self.read_toc(reader)
+            if any(entry.data_state == OFFSET_POS_NOT_SET for entry in self.entries):
+                self.scan_data(reader)
+            else:
+                self.size_blocks(os.fstat(stream.fileno()).st_size)
+
+    def read_header(self, reader):
+        if reader.read(5) != MAGIC:
+            raise ArchiveError('{} is not a pg_dump archive'.format(self.path))
+        self.version = (reader.read_byte(), reader.read_byte(), reader.read_byte())
+        if not MIN_VERSION <= self.version[:2] <= MAX_VERSION:
+            raise ArchiveError('unsupported archive version {}.{}.{}'.format(*self.version))
+        reader.int_size = self.int_size = reader.read_byte()
+        reader.off_size = self.off_size = reader.read_byte()
+        self.format = reader.read_byte()
+        if self.format != FORMAT_CUSTOM:
+            raise ArchiveError('only custom format archives are supported, got format {}'.format(self.format))
+        if self.version[:2] >= (1, 15):
+            self.compression = reader.read_byte()
+        else:
+            self.compression = COMPRESSION_NONE if reader.read_int() == 0 else COMPRESSION_GZIP
+        second, minute, hour, day, month, year, _ = [reader.read_int() for _ in range(7)]
+        self.created = datetime.datetime(year + 1900, month + 1, day, hour, minute, second)
+        self.dbname = reader.read_str()
+        self.server_version = reader.read_str()
+        self.dump_version = reader.read_str()
+
+    def read_toc(self, reader):
+        self.entries = []
+        for _ in range(reader.read_int()):
+            entry = TocEntry(dump_id=reader.read_int(), had_dumper=reader.read_int(), table_oid=reader.read_str(),
+                             oid=reader.read_str(), tag=reader.read_str(), desc=reader.read_str())
+            # section is written from 1.11 only
+            entry.section = reader.read_int() if self.version[:2] >= (1, 11) else None
+            entry.defn = reader.read_str()
+            reader.read_str()  # drop statement
+            entry.copy_stmt = reader.read_str()
+            entry.namespace = reader.read_str()
+            reader.read_str()  # tablespace
+            if self.version[:2] >= (1, 14):
+                reader.read_str()  # table access method
+            if self.version[:2] >= (1, 16):
+                reader.read_int()  # relkind
+            entry.owner = reader.read_str()
+            reader.read_str()  # with oids
+            entry.dependencies = []
+            dependency = reader.read_str()
+            while dependency is not None:
+                entry.dependencies.append(int(dependency))
+                dependency = reader.read_str()
+            entry.data_state, offset = reader.read_offset()
+            if entry.data_state == OFFSET_POS_SET:
+                entry.data_offset = offset
+            self.entries.append(entry)
+
+    def scan_data(self, reader):
+        """
+        Walk data blocks following the table of contents, seeking over chunk payloads, to find offset and
+        size of every block. Needed for archives written to a pipe, where offsets are not set.
+        """
+        entries = dict((entry.dump_id, entry) for entry in self.entries)
+        stream = reader.stream
+        while True:
+            offset = stream.tell()
+            block_type = stream.read(1)
+            if not block_type:
+                break
+            block_type = struct.unpack(b'B', block_type)[0]
+            dump_id = reader.read_int()
+            if block_type == BLOCK_DATA:
+                self.skip_chunks(reader)
+            elif block_type == BLOCK_BLOBS:
+                while reader.read_int() != 0:
+                    self.skip_chunks(reader)
+            else:
+                raise ArchiveError('unknown block type {} at offset {}'.format(block_type, offset))
+            if dump_id in entries:
+                entries[dump_id].data_offset = offset
+                entries[dump_id].compressed_size = stream.tell() - offset
+
+    @staticmethod
+    def skip_chunks(reader):
+        length = reader.read_int()
+        while length != 0:
+            reader.stream.seek(length, os.SEEK_CUR)
+            length = reader.read_int()
+
+    def size_blocks(self, archive_size):
+        """
+        Take size of every block from offsets set in table of contents, blocks follow each other up to end
+        of archive.
+        """
+        entries = sorted((entry for entry in self.entries if entry.data_offset is not None),
+                         key=lambda entry: entry.data_offset)
+        ends = [entry.data_offset for entry in entries[1:]] + [archive_size]
+        for entry, end in zip(entries, ends):
+            entry.compressed_size = end - entry.data_offset
+
+    def to_index(self, **extra):
+        index = {
+            'index_version': INDEX_VERSION,
+            'version': self.version,
+            'int_size': self.int_size,
+            'off_size': self.off_size,
+            'compression': self.compression,
+            'created': self.created.isoformat(),
+            'dbname': self.dbname,
+            'server_version': self.server_version,
+            'dump_version': self.dump_version,
+            'entries': [entry.to_dict() for entry in self.entries],
+        }
+        index.update(extra)
+        return index
+
+    def load_index(self, index):
+        self.version = tuple(index['version'])
+        self.int_size = index['int_size']
+        self.off_size = index['off_size']
+        self.compression = index['compression']
+        self.created = datetime.datetime.strptime(index['created'], '%Y-%m-%dT%H:%M:%S')
+        self.dbname = index['dbname']
+        self.server_version = index['server_version']
+        self.dump_version = index['dump_version']
+        self.entries = [TocEntry(**entry) for entry in index['entries']]
+
+    def table_data(self, table):
+        """
+        Return TABLE DATA entry of table, given as name or schema.name.
+        """
+        for entry in self.entries:
+            if entry.desc == 'TABLE DATA' and table in (entry.tag, entry.name):
+                return entry
+        raise ArchiveError('no data for table {} in archive'.format(table))
+
+    def iter_data(self, entry):
+        """
+        Seek to data block of entry and yield its decompressed content chunk by chunk.
+        """
+        if entry.data_offset is None:
+            raise ArchiveError('{} has no data in archive'.format(entry.name))
+        if self.compression not in (COMPRESSION_NONE, COMPRESSION_GZIP):
+            raise ArchiveError('compression method {} is not supported'.format(self.compression))
+        with open(self.path, 'rb') as stream:
+            reader = Reader(stream)
+            reader.int_size = self.int_size
+            reader.off_size = self.off_size
+            stream.seek(entry.data_offset)
+            block_type = reader.read_byte()
+            dump_id = reader.read_int()
+            if block_type != BLOCK_DATA or dump_id != entry.dump_id:
+                raise ArchiveError('unexpected block at offset {}'.format(entry.data_offset))
+            decompressor = zlib.decompressobj() if self.compression == COMPRESSION_GZIP else None
+            length = reader.read_int()
+            while length != 0:
+                data = reader.read(length)
+                yield decompressor.decompress(data) if decompressor else data
+                length = reader.read_int()
+            if decompressor:
+                yield decompressor.flush()
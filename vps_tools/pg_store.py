@@ -0,0 +1,378 @@
+from __future__ import unicode_literals, print_function
+
+import base64
+import datetime
+import errno
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+import dj_database_url
+from fabric.api import hide
+from fabric.decorators import task
+from fabric.state import env
+from fabric.utils import puts
+from fabric.colors import green, red
+
+from . import chunker
+from .agent import AGENT_DIR
+from .parallel import execute_on_hosts
+from .status import format_size
+from .tracing import traced
+from .transport import script_command
+from .utils import load_environment_dicts, stream_command
+
+__all__ = ['STORE_PATH', 'KEEP_DAILY', 'KEEP_WEEKLY', 'BACKUP_JOBS', 'StoreError', 'ChunkStore', 'ChunkReceiver',
+           'backup', 'backup_all', 'snapshot_dump', 'list_snapshots']
+
+STORE_PATH = os.path.join(AGENT_DIR, 'pg-store')
+KEEP_DAILY = 7
+KEEP_WEEKLY = 4
+BACKUP_JOBS = 4
+
+# host keeps hashes of chunks of last snapshot, chunks client got with snapshot "since" are not sent again
+backup_script = """name=$1; database=$2; since=$3; snapshot=$4; chunker=$5
+state=$HOME/.hmara-backup
+mkdir -p $state && chmod 0700 $state || exit 1
+known=/dev/null
+[ -f $state/$name.chunks ] && [ "$(head -n 1 $state/$name.chunks)" = "$since" ] && known=$state/$name.chunks
+python=$(command -v python3 || command -v python) || { echo 'python is not installed' >&2; exit 1; }
+rm -f $state/$name.status
+{ pg_dump -Fc -Z0 --no-acl --no-owner $database; echo $? > $state/$name.status; } |
+    $python -c "$(echo $chunker | base64 -d)" $known $state/$name.chunks.tmp $snapshot || exit 1
+[ "$(cat $state/$name.status 2>/dev/null)" = 0 ] || { echo "pg_dump of $database failed" >&2; exit 1; }
+mv $state/$name.chunks.tmp $state/$name.chunks
+"""
+
+# source of chunker is sent to host with every backup, path is resolved before anything changes directory
+CHUNKER_PATH = os.path.abspath(os.path.splitext(chunker.__file__)[0] + '.py')
+_chunker_source = []
+
+
+class StoreError(Exception):
+    pass
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _host_folder(host):
+    return host.replace('/', '_')
+
+
+class ChunkStore(object):
+    """
+    Local content-addressed store of database snapshots. Chunks are kept zlib-compressed under their sha256
+    in chunks/, snapshots are json manifests listing their chunks in snapshots/<host>/<project>/<id>.json.
+    A chunk shared by many snapshots, of one database or of several, is stored once.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or STORE_PATH
+
+    def chunk_path(self, key):
+        return os.path.join(self.path, 'chunks', key[:2], key)
+
+    def has(self, key):
+        return os.path.exists(self.chunk_path(key))
+
+    def add(self, key, data):
+        """
+        Store compressed chunk after checking it decompresses to content with sha256 key.
+        """
+        if hashlib.sha256(zlib.decompress(data)).hexdigest() != key:
+            raise StoreError('chunk {} is corrupted'.format(key))
+        path = self.chunk_path(key)
+        if os.path.exists(path):
+            return
+        _makedirs(os.path.dirname(path))
+        # backups of several databases at once may store the same chunk, every writer needs its own partial file
+        descriptor, partial = tempfile.mkstemp(suffix='.part', prefix=key + '.', dir=os.path.dirname(path))
+        with os.fdopen(descriptor, 'wb') as chunk_file:
+            chunk_file.write(data)
+        os.rename(partial, path)
+
+    def read(self, key):
+        try:
+            with open(self.chunk_path(key), 'rb') as chunk_file:
+                return zlib.decompress(chunk_file.read())
+        except (IOError, OSError):
+            raise StoreError('chunk {} is missing from store'.format(key))
+
+    def snapshot_path(self, host, project_name, snapshot_id):
+        return os.path.join(self.path, 'snapshots', _host_folder(host), project_name, snapshot_id + '.json')
+
+    def save(self, manifest):
+        path = self.snapshot_path(manifest['host'], manifest['project'], manifest['id'])
+        _makedirs(os.path.dirname(path))
+        with open(path + '.part', 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.rename(path + '.part', path)
+
+    def snapshots(self, host=None, project_name=None):
+        """
+        Manifests of snapshots, oldest first, optionally only of host and project.
+        """
+        pattern = os.path.join(self.path, 'snapshots', _host_folder(host) if host else '*', project_name or '*',
+                               '*.json')
+        manifests = []
+        for path in glob.glob(pattern):
+            with open(path) as manifest_file:
+                manifests.append(json.load(manifest_file))
+        return sorted(manifests, key=lambda manifest: (manifest['id'], manifest['host'], manifest['project']))
+
+    def latest(self, host, project_name):
+        manifests = self.snapshots(host, project_name)
+        return manifests[-1] if manifests else None
+
+    def find(self, project_name, snapshot_id='latest', host=None):
+        """
+        Snapshot of project by id, 'latest' for newest one. Snapshots taken on host are preferred.
+        """
+        for manifests in (self.snapshots(host, project_name) if host else [], self.snapshots(None, project_name)):
+            if snapshot_id != 'latest':
+                manifests = [manifest for manifest in manifests if manifest['id'] == snapshot_id]
+            if manifests:
+                return manifests[-1]
+        raise StoreError('no snapshot {} of {} in {}'.format(snapshot_id, project_name, self.path))
+
+    def materialize(self, manifest, path):
+        """
+        Join chunks of snapshot into dump file at path, checking size and sha256 of the whole dump.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        with open(path + '.part', 'wb') as dump_file:
+            for key in manifest['chunks']:
+                data = self.read(key)
+                digest.update(data)
+                size += len(data)
+                dump_file.write(data)
+        if size != manifest['size'] or digest.hexdigest() != manifest['sha256']:
+            os.remove(path + '.part')
+            raise StoreError('snapshot {} of {} does not match its checksum'.format(manifest['id'],
+                                                                                    manifest['project']))
+        os.rename(path + '.part', path)
+        return path
+
+    def prune(self, host, project_name, keep_daily=KEEP_DAILY, keep_weekly=KEEP_WEEKLY):
+        """
+        Remove snapshots of project taken on host except newest one of each of last keep_daily days and of
+        each of last keep_weekly weeks which have snapshots. Newest snapshot is always kept. Returns removed ids.
+        """
+        manifests = list(reversed(self.snapshots(host, project_name)))
+        keep = set(manifest['id'] for manifest in manifests[:1])
+        for limit, period in ((keep_daily, lambda day: day), (keep_weekly, lambda day: day.isocalendar()[:2])):
+            seen = []
+            for manifest in manifests:
+                key = period(datetime.datetime.strptime(manifest['id'], '%Y%m%d-%H%M%S').date())
+                if key not in seen and len(seen) < limit:
+                    seen.append(key)
+                    keep.add(manifest['id'])
+        removed = []
+        for manifest in manifests:
+            if manifest['id'] not in keep:
+                os.remove(self.snapshot_path(host, project_name, manifest['id']))
+                removed.append(manifest['id'])
+        return removed
+
+    def collect_garbage(self, before):
+        """
+        Remove chunks written before time before which no snapshot uses. Returns number and size of removed chunks.
+        """
+        used = set()
+        for manifest in self.snapshots():
+            used.update(manifest['chunks'])
+        count = size = 0
+        for path in glob.glob(os.path.join(self.path, 'chunks', '*', '*')):
+            if os.path.basename(path) in used or os.path.getmtime(path) >= before:
+                continue
+            size += os.path.getsize(path)
+            os.remove(path)
+            count += 1
+        return count, size
+
+
+class ChunkReceiver(object):
+    """
+    File-like object reading frames of chunker output: new chunks go to store, known ones must be in it.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.buffer = b''
+        self.pending = None
+        self.chunks = []
+        self.new = 0
+        self.received = 0
+        self.end = None
+
+    def write(self, data):
+        self.received += len(data)
+        buffer = self.buffer + data
+        position = 0
+        while True:
+            if self.pending is not None:
+                key, size = self.pending
+                if len(buffer) - position < size:
+                    break
+                self.store.add(key, buffer[position:position + size])
+                position += size
+                self.pending = None
+                self.chunks.append(key)
+                self.new += 1
+                continue
+            end = buffer.find(b'\n', position)
+            if end < 0:
+                break
+            fields = buffer[position:end].decode('ascii', 'replace').split(' ')
+            position = end + 1
+            if fields[0] == '+' and len(fields) == 3:
+                self.pending = (fields[1], int(fields[2]))
+            elif fields[0] == '=' and len(fields) == 2:
+                if not self.store.has(fields[1]):
+                    raise StoreError('host skipped chunk {} which is missing from store'.format(fields[1]))
+                self.chunks.append(fields[1])
+            elif fields[0] == '.' and len(fields) == 4:
+                self.end = (int(fields[1]), int(fields[2]), fields[3])
+            else:
+                raise StoreError('unexpected backup stream line {!r}'.format(' '.join(fields)[:100]))
+        self.buffer = buffer[position:]
+
+    def manifest(self, **fields):
+        if self.end is None or self.pending is not None or self.end[0] != len(self.chunks):
+            raise StoreError('backup stream ended early')
+        return dict(fields, chunks=self.chunks, size=self.end[1], sha256=self.end[2], new=self.new,
+                    received=self.received)
+
+
+def backup_command(project_name, database, since, snapshot_id):
+    if not _chunker_source:
+        with open(CHUNKER_PATH, 'rb') as source_file:
+            _chunker_source.append(base64.b64encode(source_file.read()).decode('ascii'))
+    return script_command(backup_script, [project_name, database, since, snapshot_id, _chunker_source[0]])
+
+
+def backup_database(store, host, project_name, database, snapshot_id):
+    """
+    Stream dump of database through chunker on host into store, save and return manifest of snapshot.
+    Runs in worker threads of backup, so it only reads fabric env: settings and hide are not thread-safe.
+    """
+    latest = store.latest(host, project_name)
+    receiver = ChunkReceiver(store)
+    started = time.time()
+    stream_command(backup_command(project_name, database, latest['id'] if latest else '-', snapshot_id),
+                   receiver, user='postgres')
+    manifest = receiver.manifest(id=snapshot_id, host=host, project=project_name, database=database,
+                                 created=time.time(), duration=time.time() - started)
+    store.save(manifest)
+    return manifest
+
+
+@task()
+@traced
+def backup(project_names, snapshot_id, store_path=None, jobs=BACKUP_JOBS):
+    """
+    Back up databases of projects on host (all projects when project_names is None), up to jobs at once,
+    into local chunk store. Returns list of (project, error), error is None for succeeded backups.
+    """
+    store = ChunkStore(store_path)
+    host = env.host_string
+    databases = []
+    for project_name, env_dict in load_environment_dicts(project_names).items():
+        if 'postgres' in env_dict.get('DATABASE_URL', '').split(':', 1)[0]:
+            databases.append((project_name, dj_database_url.parse(env_dict['DATABASE_URL'])['NAME']))
+
+    def run(item):
+        project_name, database = item
+        try:
+            return project_name, backup_database(store, host, project_name, database, snapshot_id), None
+        except (Exception, SystemExit) as e:
+            return project_name, None, '{}: {}'.format(type(e).__name__, e)
+
+    results = []
+    # fabric env and output are shared by threads, they are set up once here and only read by workers; connection
+    # and transport are already there after load_environment_dicts
+    pool = ThreadPool(max(min(jobs, len(databases)), 1))
+    with hide('running'):
+        try:
+            for project_name, manifest, error in pool.imap_unordered(run, databases):
+                if error:
+                    puts(red('{}: {}'.format(project_name, error)), show_prefix=False)
+                else:
+                    puts(green('{}: {} dump in {} chunks, {} new, {} received in {:.1f}s'.format(
+                        project_name, format_size(manifest['size'] / 1024.0), len(manifest['chunks']),
+                        manifest['new'], format_size(manifest['received'] / 1024.0), manifest['duration'])),
+                        show_prefix=False)
+                results.append((project_name, error))
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+
+def backup_all(hosts, project_names=None, jobs=BACKUP_JOBS, keep_daily=KEEP_DAILY, keep_weekly=KEEP_WEEKLY,
+               store_path=None):
+    """
+    Back up databases on all hosts at once, then apply retention to snapshots of backed up projects and
+    remove chunks no snapshot uses any more. Returns dict host or host/project -> error of failures.
+    """
+    started = time.time()
+    snapshot_id = time.strftime('%Y%m%d-%H%M%S', time.gmtime(started))
+    store = ChunkStore(store_path)
+    errors = {}
+    pruned = 0
+    for host, (results, error) in sorted(execute_on_hosts(backup, hosts, project_names, snapshot_id, store.path,
+                                                          jobs).items()):
+        if error:
+            errors[host] = error
+            continue
+        for project_name, project_error in results:
+            if project_error:
+                errors['{}/{}'.format(host, project_name)] = project_error
+            else:
+                pruned += len(store.prune(host, project_name, keep_daily, keep_weekly))
+    count, size = store.collect_garbage(started)
+    puts('{} snapshots pruned, {} chunks ({}) removed from {}'.format(pruned, count, format_size(size / 1024.0),
+                                                                      store.path), show_prefix=False)
+    for name, error in sorted(errors.items()):
+        puts(red('[{}] {}'.format(name, error)), show_prefix=False)
+    return errors
+
+
+@contextmanager
+def snapshot_dump(project_name, snapshot_id='latest', host=None, store_path=None):
+    """
+    Write snapshot of project to temporary dump file, yield its path and remove it afterwards.
+    """
+    store = ChunkStore(store_path)
+    manifest = store.find(project_name, snapshot_id, host)
+    folder = tempfile.mkdtemp()
+    try:
+        puts(green('{}: snapshot {} of {} taken on {}'.format(project_name, manifest['id'], manifest['database'],
+                                                              manifest['host'])), show_prefix=False)
+        yield store.materialize(manifest, os.path.join(folder, '{}.dump'.format(manifest['id'])))
+    finally:
+        shutil.rmtree(folder)
+
+
+def list_snapshots(project_names=None, store_path=None):
+    store = ChunkStore(store_path)
+    for manifest in store.snapshots():
+        if project_names and manifest['project'] not in project_names:
+            continue
+        puts('{}  {}  {}  {:>8}  {} chunks'.format(manifest['id'], manifest['host'], manifest['project'],
+                                                    format_size(manifest['size'] / 1024.0),
+                                                    len(manifest['chunks'])), show_prefix=False)
@@ -0,0 +1,34 @@
+from __future__ import unicode_literals, print_function
+
+from fabric.decorators import task
+from fabric.utils import puts
+from fabric.colors import green, red
+
+from .utils import list_ports, port_owner, prune_ports
+
+
+@task()
+def list():
+    for port, owner in list_ports():
+        puts(green('{} {}'.format(port, owner)))
+
+
+@task()
+def who(port):
+    owner = port_owner(port)
+    if owner:
+        puts(green('{} {}'.format(port, owner)))
+    else:
+        puts(red('{} is free'.format(port)))
+
+
+@task()
+def prune():
+    """
+    Release ports of projects which no longer have home folder.
+    """
+    released = prune_ports()
+    for port, owner in released:
+        puts(green('{} {} released'.format(port, owner)))
+    if not released:
+        puts(green('no stale ports'))
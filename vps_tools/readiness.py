@@ -0,0 +1,170 @@
+from __future__ import unicode_literals, print_function
+
+import time
+
+from fabric.api import settings, hide
+from fabric.colors import green
+from fabric.utils import puts, abort
+
+from .transport import sudo
+from .tracing import span
+
+__all__ = ['DEFAULT_TIMEOUT', 'backoff', 'wait_until', 'program_states', 'wait_for_program', 'wait_for_programs',
+           'wait_for_supervisor', 'nginx_state', 'reload_nginx', 'http_status', 'wait_for_port', 'http_probe',
+           'wait_for_health']
+
+DEFAULT_TIMEOUT = 120
+
+
+def backoff(initial=0.05, maximum=2.0, factor=2):
+    """
+    Exponentially growing delays between attempts, starting at 50ms.
+    """
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * factor, maximum)
+
+
+def wait_until(check, description, timeout=DEFAULT_TIMEOUT):
+    """
+    Call check until it returns True, first attempt without delay. Aborts when timeout expires,
+    otherwise reports and returns time to ready in seconds.
+    """
+    started = time.time()
+    with span('wait for {}'.format(description), 'wait'):
+        for delay in backoff():
+            if check():
+                elapsed = time.time() - started
+                puts(green('{} ready in {:.2f}s'.format(description, elapsed)))
+                return elapsed
+            if time.time() - started + delay > timeout:
+                abort('{} is not ready after {}s'.format(description, timeout))
+            time.sleep(delay)
+
+
+def _quiet(cmd):
+    with settings(hide('everything'), warn_only=True):
+        return sudo(cmd, pty=False, combine_stderr=False)
+
+
+def program_states(program_names):
+    """
+    Return dict program name -> (supervisor state, full status line), state is RUNNING, STARTING,
+    BACKOFF, FATAL, ... or None when supervisor does not know the program.
+    """
+    result = _quiet('supervisorctl status {}'.format(' '.join(program_names)))
+    states = dict((name, (None, '')) for name in program_names)
+    for line in result.splitlines():
+        fields = line.split()
+        if len(fields) > 1 and fields[0] in states:
+            states[fields[0]] = (fields[1], line.strip())
+    return states
+
+
+def wait_for_programs(program_names, timeout=DEFAULT_TIMEOUT):
+    """
+    Wait until supervisor reports all programs as RUNNING, with one status call per attempt.
+    Aborts at once if any program is FATAL.
+    """
+    def check():
+        states = program_states(program_names)
+        for name, (state, line) in states.items():
+            if state == 'FATAL':
+                abort('program {} failed to start: {}'.format(name, line))
+        return all(state == 'RUNNING' for state, line in states.values())
+    return wait_until(check, 'program {}'.format(', '.join(program_names)), timeout)
+
+
+def wait_for_program(program_name, timeout=DEFAULT_TIMEOUT):
+    """
+    Wait until supervisor reports program as RUNNING. Aborts at once if program is FATAL.
+    """
+    return wait_for_programs([program_name], timeout)
+
+
+def wait_for_supervisor(timeout=DEFAULT_TIMEOUT):
+    """
+    Wait until supervisord answers after reload.
+    """
+    return wait_until(lambda: _quiet('supervisorctl pid').return_code == 0, 'supervisor', timeout)
+
+
+def nginx_state():
+    """
+    Return nginx master pid and set of its worker pids.
+    """
+    result = _quiet('pid=$(cat /run/nginx.pid 2>/dev/null || cat /var/run/nginx.pid) && kill -0 $pid && '
+                    'echo $pid && pgrep -P $pid')
+    pids = result.split() if result.return_code == 0 else []
+    if not pids:
+        return None, frozenset()
+    return pids[0], frozenset(pids[1:])
+
+
+def reload_nginx(timeout=DEFAULT_TIMEOUT):
+    """
+    Reload nginx and wait until master pid changes or new generation of workers is started.
+    """
+    master, workers = nginx_state()
+    sudo('service nginx reload')
+
+    def check():
+        new_master, new_workers = nginx_state()
+        if new_master is None:
+            return False
+        return new_master != master or bool(new_workers - workers)
+    return wait_until(check, 'nginx', timeout)
+
+
+def http_status(port):
+    """
+    Return HTTP status code of 127.0.0.1:port, 0 when port does not answer.
+    """
+    result = _quiet("curl -s -o /dev/null --max-time 5 -w '%{{http_code}}' http://127.0.0.1:{}/".format(port))
+    try:
+        return int(result.strip())
+    except ValueError:
+        return 0
+
+
+def wait_for_port(port, timeout=DEFAULT_TIMEOUT):
+    """
+    Wait until something answers HTTP on 127.0.0.1:port, whatever the status code is.
+    """
+    return wait_until(lambda: http_status(port) > 0, 'port {}'.format(port), timeout)
+
+
+def http_probe(port, samples=3):
+    """
+    Request 127.0.0.1:port samples times in one round trip. Returns list of (status code, seconds),
+    status 0 when port does not answer.
+    """
+    url = 'http://127.0.0.1:{}/'.format(port)
+    result = _quiet("curl -s --max-time 5 -w '%{{http_code}} %{{time_total}}\\n' {}".format(
+        ' '.join(['-o /dev/null {}'.format(url)] * samples)))
+    probes = []
+    for line in result.splitlines():
+        fields = line.split()
+        try:
+            probes.append((int(fields[0]), float(fields[1]) if len(fields) > 1 else 0.0))
+        except (ValueError, IndexError):
+            probes.append((0, 0.0))
+    return probes or [(0, 0.0)]
+
+
+def wait_for_health(port, max_latency, samples=3, timeout=DEFAULT_TIMEOUT):
+    """
+    Wait until every request of a probe gets an answer below 500 and median latency is within max_latency
+    seconds. Returns median latency of the passing probe.
+    """
+    latency = []
+
+    def check():
+        probes = http_probe(port, samples)
+        if not all(0 < status < 500 for status, _ in probes):
+            return False
+        latency[:] = [sorted(seconds for _, seconds in probes)[len(probes) // 2]]
+        return latency[0] <= max_latency
+    wait_until(check, 'health of port {}'.format(port), timeout)
+    return latency[0]
@@ -0,0 +1,221 @@
+from __future__ import unicode_literals, print_function
+
+import re
+import sys
+import threading
+from contextlib import contextmanager
+
+import six
+from six.moves.urllib.parse import urlparse, unquote
+
+__all__ = ['MASK', 'MIN_SECRET_LENGTH', 'SECRET_KEY_PATTERN', 'register_secret', 'register_environment', 'secrets',
+           'redact', 'RedactingStream', 'install', 'release', 'redacting', 'revealing']
+
+MASK = '********'
+# shorter values (ports, flags, ids) would mask unrelated output
+MIN_SECRET_LENGTH = 4
+SECRET_KEY_PATTERN = re.compile(r'PASSWORD|PASSWD|SECRET|TOKEN|API_KEY|PRIVATE_KEY|ACCESS_KEY', re.I)
+
+# replaced on registration rather than changed, so lookups of its matcher need not copy it
+_registered = frozenset()
+_scopes = threading.local()
+_lock = threading.Lock()
+_matchers = {}
+
+
+def register_secret(value):
+    """
+    Mask value in all output of this process from now on.
+    """
+    global _registered
+    if value and len(value) >= MIN_SECRET_LENGTH and value not in _registered:
+        with _lock:
+            _registered = _registered.union([value])
+
+
+def register_environment(env_dict):
+    """
+    Register values of secret-looking variables of .env and passwords of URLs in it, like DATABASE_URL.
+    """
+    for key, value in six.iteritems(env_dict):
+        if SECRET_KEY_PATTERN.search(key):
+            register_secret(value)
+        elif '://' in value:
+            try:
+                password = urlparse(value).password
+            except ValueError:
+                password = None
+            if password:
+                register_secret(password)
+                register_secret(unquote(password))
+
+
+def secrets():
+    """
+    Secrets registered for process plus those of redacting() scopes of current thread.
+    """
+    scoped = getattr(_scopes, 'stack', None)
+    if not scoped:
+        return _registered
+    return _registered.union(*scoped)
+
+
+class Matcher(object):
+    """
+    Secrets, longest first, as text and bytes, plus set of their proper prefixes to find output tail which
+    may continue as a secret in next write.
+    """
+
+    def __init__(self, values):
+        self.text_values = sorted(values, key=len, reverse=True)
+        self.bytes_values = [value.encode('utf-8') for value in self.text_values]
+        self.text_prefixes = set(value[:i] for value in self.text_values for i in range(1, len(value)))
+        self.bytes_prefixes = set(value[:i] for value in self.bytes_values for i in range(1, len(value)))
+        self.longest = max(len(value) for value in self.bytes_values)
+
+    def sub(self, data):
+        """
+        Mask secrets in data, longest first. Every secret costs one scan of data in C, replace returns data
+        itself when secret is not there, so no regex or python loop runs over output.
+        """
+        values, mask = (self.bytes_values, MASK.encode('ascii')) if isinstance(data, bytes) else \
+            (self.text_values, MASK)
+        for value in values:
+            data = data.replace(value, mask)
+        return data
+
+    def hold(self, data):
+        """
+        Length of longest tail of data which is the beginning of some secret.
+        """
+        prefixes = self.bytes_prefixes if isinstance(data, bytes) else self.text_prefixes
+        for size in range(min(self.longest - 1, len(data)), 0, -1):
+            if data[-size:] in prefixes:
+                return size
+        return 0
+
+
+def matcher():
+    """
+    Matcher of secrets(), None when there are none. Cached by registered secrets and scopes, which are never
+    changed in place, so nothing is rebuilt on every write.
+    """
+    scoped = getattr(_scopes, 'stack', None)
+    key = (_registered,) + tuple(scoped) if scoped else _registered
+    found = _matchers.get(key, False)
+    if found is False:
+        values = secrets()
+        found = _matchers[key] = Matcher(values) if values else None
+    return found
+
+
+def redact(text):
+    current = matcher()
+    return current.sub(text) if current else text
+
+
+class RedactingStream(object):
+    """
+    File-like wrapper masking secrets in output. Output is written through at once, only tail
+    that may be the start of a secret is held back until next write, so secrets split between writes are
+    masked too and prompts are shown before input is read. Held tail is kept per thread.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def write(self, data):
+        if not data:
+            return
+        state = self._local
+        held = getattr(state, 'held', None)
+        if held is not None:
+            state.held = None
+            # tail goes in front of next write even when it switches between text and bytes, so secret cut
+            # there is still found whole
+            if isinstance(data, bytes) and not isinstance(held, bytes):
+                held = held.encode('utf-8')
+            elif not isinstance(data, bytes) and isinstance(held, bytes):
+                held = held.decode('utf-8', 'replace')
+            data = held + data
+        current = None if getattr(_scopes, 'revealing', 0) else matcher()
+        if current is not None:
+            data = current.sub(data)
+            hold = current.hold(data)
+            if hold:
+                state.held = data[-hold:]
+                data = data[:-hold]
+        if data:
+            self._write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _write(self, data):
+        with self._lock:
+            self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def release(self):
+        """
+        Write held tail too, it is not a secret as output ended before secret did.
+        """
+        held = getattr(self._local, 'held', None)
+        if held is not None:
+            self._local.held = None
+            self._write(held)
+        self.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def install():
+    """
+    Wrap sys.stdout and sys.stderr in RedactingStream, unless already wrapped.
+    """
+    if not isinstance(sys.stdout, RedactingStream):
+        sys.stdout = RedactingStream(sys.stdout)
+    if not isinstance(sys.stderr, RedactingStream):
+        sys.stderr = RedactingStream(sys.stderr)
+
+
+def release():
+    for stream in (sys.stdout, sys.stderr):
+        if isinstance(stream, RedactingStream):
+            stream.release()
+
+
+@contextmanager
+def redacting(values):
+    """
+    Mask values in output written by current thread inside the block, in addition to registered secrets.
+    """
+    install()
+    stack = getattr(_scopes, 'stack', None)
+    if stack is None:
+        stack = _scopes.stack = []
+    stack.append(frozenset(value for value in values if value and len(value) >= MIN_SECRET_LENGTH))
+    try:
+        yield
+    finally:
+        release()
+        stack.pop()
+
+
+@contextmanager
+def revealing():
+    """
+    Write output of current thread inside the block unmasked, for commands whose purpose is to show secrets,
+    like config list. Traces are still redacted.
+    """
+    _scopes.revealing = getattr(_scopes, 'revealing', 0) + 1
+    try:
+        yield
+    finally:
+        _scopes.revealing -= 1
@@ -0,0 +1,117 @@
+from __future__ import unicode_literals, print_function
+
+import time
+from collections import OrderedDict
+
+from fabric.api import settings, cd, hide
+from fabric.decorators import task
+from fabric.utils import puts, abort
+from fabric.colors import green, red
+
+from .transport import sudo
+from .readiness import wait_for_health
+from .utils import take_snapshot
+from .bluegreen import restart_projects
+from .parallel import execute_on_hosts
+from .tracing import traced
+
+__all__ = ['MAX_LATENCY', 'HEALTH_TIMEOUT', 'batches', 'current_revision', 'deploy_and_check', 'rollback',
+           'rolling_deploy']
+
+MAX_LATENCY = 1.0
+HEALTH_TIMEOUT = 60
+
+
+def batches(hosts, size):
+    size = max(size or 1, 1)
+    return [hosts[i:i + size] for i in range(0, len(hosts), size)]
+
+
+def current_revision(project_name):
+    project_folder = '/home/{project_name}/{project_name}'.format(project_name=project_name)
+    with cd(project_folder), settings(sudo_user=project_name), hide('output'):
+        return sudo('git rev-parse HEAD').strip()
+
+
+@task()
+@traced
+def deploy_and_check(project_name, full=False, max_latency=MAX_LATENCY):
+    """
+    Deploy project and wait until it answers HTTP on its port with median latency within max_latency seconds.
+    Returns dict with revision of last successful deploy, latency and error when deploy or health check failed.
+    """
+    from .project import deploy, deployed_revision
+
+    previous = deployed_revision(project_name)
+    try:
+        deploy(project_name, full=full)
+        # blue/green restart moves project to other port
+        latency = wait_for_health(take_snapshot(project_name).port, max_latency, timeout=HEALTH_TIMEOUT)
+    except (Exception, SystemExit) as e:
+        return {'previous': previous, 'latency': None, 'error': '{}: {}'.format(type(e).__name__, e)}
+    return {'previous': previous, 'latency': latency, 'error': None}
+
+
+@task()
+@traced
+def rollback(project_name, revision):
+    """
+    Reset project to revision, run deploy steps needed for files changed since, so dependencies and static
+    files match it again, and restart it. Migrations are not reversed: when deploy being rolled back had new ones,
+    rollback aborts once project runs revision, database schema is ahead of it then.
+    """
+    from .project import deploy_plan, run_deploy_plan, mark_deployed
+
+    project_folder = '/home/{project_name}/{project_name}'.format(project_name=project_name)
+    failed = current_revision(project_name)
+    with cd(project_folder), settings(sudo_user=project_name):
+        with hide('output'):
+            changed_files = sudo('git diff --name-only {} {}'.format(revision, failed)).split()
+        sudo('git reset --hard {}'.format(revision))
+    snapshot = take_snapshot(project_name)
+    plan = deploy_plan(changed_files, snapshot)
+    migrated = plan['migrate']
+    plan['migrate'] = False
+    run_deploy_plan(project_name, plan, snapshot)
+    restart_projects([project_name])
+    mark_deployed(project_name, revision)
+    if migrated:
+        abort('{} has migrations not in {}, they were not reversed: roll them back with manage.py migrate'.format(
+            failed[:8], revision[:8]))
+
+
+def rolling_deploy(hosts, project_name, batch=1, full=False, max_latency=MAX_LATENCY):
+    """
+    Deploy project to hosts batch by batch, hosts of a batch at once, so time grows with number of batches.
+    Next batch starts only when every host of current one is healthy. When a batch fails, deploy stops and
+    every host deployed so far, failed batch included, is rolled back to its previous revision.
+    """
+    started = time.time()
+    groups = batches(hosts, batch)
+    deployed = OrderedDict()
+    for number, group in enumerate(groups, 1):
+        puts(green('batch {}/{}: {}'.format(number, len(groups), ', '.join(group))))
+        failed = {}
+        for host, (result, error) in execute_on_hosts(deploy_and_check, group, project_name, full=full,
+                                                      max_latency=max_latency).items():
+            if result:
+                deployed[host] = result['previous']
+                error = error or result['error']
+            if error:
+                failed[host] = error
+            else:
+                puts(green('[{}] healthy, median latency {:.0f}ms'.format(host, result['latency'] * 1000)))
+        if failed:
+            for host in sorted(failed):
+                puts(red('[{}] {}'.format(host, failed[host])))
+            revisions = OrderedDict()
+            for host, revision in deployed.items():
+                revisions.setdefault(revision, []).append(host)
+            for revision, revision_hosts in revisions.items():
+                puts(red('rolling back {} to {}'.format(', '.join(revision_hosts), revision[:8])))
+                for host, (_, error) in execute_on_hosts(rollback, revision_hosts, project_name, revision).items():
+                    if error:
+                        puts(red('[{}] rollback failed: {}'.format(host, error)))
+            abort('rolling deploy of {} stopped at batch {} of {}'.format(project_name, number, len(groups)))
+    puts(green('{} deployed to {} hosts in {} batches, {:.1f}s'.format(project_name, len(hosts), len(groups),
+                                                                      time.time() - started)))
@@ -1,5 +1,7 @@
 from __future__ import unicode_literals
-from fabric.api import task, sudo
+from fabric.api import task
+
+from .transport import sudo
 
 
 @task
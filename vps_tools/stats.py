@@ -0,0 +1,206 @@
+from __future__ import unicode_literals, print_function
+
+import math
+
+from fabric.api import hide
+from fabric.decorators import task
+from fabric.utils import puts
+from fabric.colors import green, red, yellow
+
+from .transport import run_script
+from .parallel import collect_from_hosts
+
+__all__ = ['HISTOGRAM_BASE', 'TOP_URLS', 'AccessStats', 'parse_stats', 'collect', 'fleet_stats', 'show_stats']
+
+# upstream times go to buckets growing by 10%, so percentiles are within 10% and histograms of hosts just add up
+HISTOGRAM_BASE = 1.1
+TOP_URLS = 10
+
+# "<ip> - <user> [<time>] "<request>" <status> <bytes> "<referer>" "<agent>" <request_time> <upstream_time>"
+stats_script = """top=$1; shift
+for name in "$@"; do
+    echo "@@project $name"
+    for path in $(ls -tr /home/$name/logs/access.log* 2>/dev/null); do
+        case $path in
+            *.gz) gzip -dc $path ;;
+            *) cat $path ;;
+        esac
+    done | LC_ALL=C awk -F'"' -v base={base} -v top=$top '
+    function epoch(s,    d, m, y) {{
+        d = substr(s, 1, 2) + 0; y = substr(s, 8, 4) + 0
+        m = (index("JanFebMarAprMayJunJulAugSepOctNovDec", substr(s, 4, 3)) + 2) / 3
+        if (m <= 2) {{ y -= 1; m += 9 }} else {{ m -= 3 }}
+        d += 365 * y + int(y / 4) - int(y / 100) + int(y / 400) + int((153 * m + 2) / 5) - 719469
+        return d * 86400 + substr(s, 13, 2) * 3600 + substr(s, 16, 2) * 60 + substr(s, 19, 2)
+    }}
+    NF >= 7 {{
+        t = epoch(substr($1, index($1, "[") + 1))
+        if (count == 0 || t < first) first = t
+        if (t > last) last = t
+        count++
+        split($3, result, " "); status[result[1]]++
+        split($7, timing, " ")
+        upstream = 0
+        for (i = 2; i in timing; i++) {{ gsub(",", "", timing[i]); if (timing[i] != "-") upstream += timing[i] }}
+        if (timing[2] == "" || timing[2] == "-") next
+        ms = upstream * 1000
+        bucket = ms <= 1 ? 0 : int(log(ms) / log(base)) + 1
+        hist[bucket]++
+        timed++
+        split($2, request, " "); sub(/\\?.*/, "", request[2])
+        n = split(request[2], parts, "/"); url = parts[1]
+        for (i = 2; i <= n; i++) url = url "/" (parts[i] ~ /^[0-9]+$/ ? ":id" : parts[i])
+        total[url] += ms; hits[url]++
+        if (ms > slowest[url]) slowest[url] = ms
+    }}
+    END {{
+        printf "count %d\\nfirst %d\\nlast %d\\ntimed %d\\n", count, first, last, timed
+        for (code in status) printf "status %s %d\\n", code, status[code]
+        for (bucket in hist) printf "hist %d %d\\n", bucket, hist[bucket]
+        sort = "sort -k2,2nr | head -n " top
+        for (url in total) printf "url %.0f %d %.0f %s\\n", total[url], hits[url], slowest[url], url | sort
+        close(sort)
+    }}'
+done
+exit 0
+""".format(base=HISTOGRAM_BASE)
+
+
+class AccessStats(object):
+    """
+    Aggregates of access log: request count and time span, status counts, histogram of upstream time in ms
+    and total ms, hits and slowest ms per url. Stats of several hosts merge by adding up.
+    """
+
+    def __init__(self, count=0, first=0, last=0, timed=0, statuses=None, histogram=None, urls=None):
+        self.count = count
+        self.first = first
+        self.last = last
+        self.timed = timed
+        self.statuses = statuses or {}
+        self.histogram = histogram or {}
+        self.urls = urls or {}
+
+    def merge(self, other):
+        if other.count and (not self.count or other.first < self.first):
+            self.first = other.first
+        self.last = max(self.last, other.last)
+        self.count += other.count
+        self.timed += other.timed
+        for code, count in other.statuses.items():
+            self.statuses[code] = self.statuses.get(code, 0) + count
+        for bucket, count in other.histogram.items():
+            self.histogram[bucket] = self.histogram.get(bucket, 0) + count
+        for url, (total, hits, slowest) in other.urls.items():
+            current = self.urls.get(url, (0, 0, 0))
+            self.urls[url] = (current[0] + total, current[1] + hits, max(current[2], slowest))
+        return self
+
+    @property
+    def rate(self):
+        return self.count / float(max(self.last - self.first, 1))
+
+    def percentile(self, fraction):
+        """
+        Upstream time in ms, upper bound of histogram bucket holding given fraction of timed requests.
+        """
+        if not self.timed:
+            return None
+        rank = fraction * self.timed
+        seen = 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= rank:
+                return math.pow(HISTOGRAM_BASE, bucket) if bucket else 1.0
+        return math.pow(HISTOGRAM_BASE, max(self.histogram))
+
+    def slow_urls(self, count=TOP_URLS):
+        return sorted(self.urls.items(), key=lambda item: item[1][0], reverse=True)[:count]
+
+    def to_dict(self):
+        return {'count': self.count, 'first': self.first, 'last': self.last, 'timed': self.timed,
+                'statuses': self.statuses, 'histogram': self.histogram, 'urls': self.urls}
+
+
+def parse_stats(text):
+    """
+    Parse output of stats_script into dict project name -> AccessStats.
+    """
+    stats = {}
+    current = None
+    for line in text.splitlines():
+        if line.startswith('@@project '):
+            current = stats[line.split(' ', 1)[1]] = AccessStats()
+            continue
+        fields = line.split(' ')
+        if current is None or len(fields) < 2:
+            continue
+        if fields[0] in ('count', 'first', 'last', 'timed'):
+            setattr(current, fields[0], int(fields[1]))
+        elif fields[0] == 'status' and len(fields) == 3:
+            current.statuses[fields[1]] = int(fields[2])
+        elif fields[0] == 'hist' and len(fields) == 3:
+            current.histogram[int(fields[1])] = int(fields[2])
+        elif fields[0] == 'url' and len(fields) == 5:
+            current.urls[fields[4]] = (int(fields[1]), int(fields[2]), int(fields[3]))
+    return stats
+
+
+@task()
+def collect(project_names, top=TOP_URLS):
+    """
+    Aggregate access logs of projects on host, rotated and gzipped ones included, in one round trip.
+    Returns dict project name -> AccessStats as dict.
+    """
+    with hide('output'):
+        output = run_script(stats_script, str(top), *project_names)
+    return dict((name, stats.to_dict()) for name, stats in parse_stats(output).items())
+
+
+def fleet_stats(hosts, project_names, top=TOP_URLS):
+    """
+    Collect stats on all hosts at once and merge them per project. Returns dict project name -> AccessStats
+    and dict host -> error of hosts which failed.
+    """
+    merged = dict((name, AccessStats()) for name in project_names)
+    errors = {}
+    for host, (result, error) in collect_from_hosts(collect, hosts, project_names, top=top).items():
+        if error:
+            errors[host] = error
+            continue
+        for name, stats in result.items():
+            stats['histogram'] = dict((int(bucket), count) for bucket, count in stats['histogram'].items())
+            merged[name].merge(AccessStats(**stats))
+    return merged, errors
+
+
+def format_ms(ms):
+    if ms is None:
+        return '-'
+    return '{:.0f}ms'.format(ms) if ms < 1000 else '{:.2f}s'.format(ms / 1000.0)
+
+
+def show_stats(hosts, project_names, top=TOP_URLS):
+    merged, errors = fleet_stats(hosts, project_names, top)
+    for host, error in sorted(errors.items()):
+        puts(red('[{}] {}'.format(host, error)), show_prefix=False)
+    for name in project_names:
+        stats = merged[name]
+        puts(green('{}: {} requests, {:.2f} req/s'.format(name, stats.count, stats.rate)), show_prefix=False)
+        if not stats.count:
+            continue
+        mix = sorted(stats.statuses.items(), key=lambda item: item[1], reverse=True)
+        puts('  status: {}'.format(', '.join('{} {:.1f}%'.format(code, 100.0 * count / stats.count)
+                                             for code, count in mix)), show_prefix=False)
+        if not stats.timed:
+            puts(yellow('  no upstream times, is access log written in {}_timed format?'.format(name)),
+                 show_prefix=False)
+            continue
+        puts('  upstream: p50 {}  p95 {}  p99 {}  ({} timed requests)'.format(
+            format_ms(stats.percentile(0.5)), format_ms(stats.percentile(0.95)), format_ms(stats.percentile(0.99)),
+            stats.timed), show_prefix=False)
+        puts('  slowest urls by total upstream time:', show_prefix=False)
+        for url, (total, hits, slowest) in stats.slow_urls(top):
+            puts('  {:>9} total {:>7} avg {:>7} max {:>6} hits  {}'.format(
+                format_ms(total), format_ms(total / float(hits)), format_ms(slowest), hits, url), show_prefix=False)
+    return errors
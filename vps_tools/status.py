@@ -0,0 +1,224 @@
+from __future__ import unicode_literals, print_function
+
+import json
+import os
+import sys
+import time
+
+from fabric.api import hide
+from fabric.decorators import task
+from fabric.utils import puts
+from fabric.colors import green, red, yellow
+
+from .agent import AGENT_DIR
+from .transport import run_script
+from .parallel import collect_from_hosts
+
+__all__ = ['CACHE_PATH', 'CACHE_TTL', 'COLUMNS', 'collect', 'parse_status', 'load_cache', 'store_cache',
+           'fleet_status', 'render', 'show', 'watch']
+
+CACHE_PATH = os.path.join(AGENT_DIR, 'status.json')
+CACHE_TTL = 30
+COLUMNS = ['host', 'project', 'state', 'uptime', 'port', 'domains', 'disk', 'venv age', 'commit']
+
+status_script = """now=$(date +%s)
+echo '@@supervisor'; supervisorctl status 2>/dev/null
+cd /home || exit 1
+for name in */; do
+    name=${name%/}
+    [ "$name" = ubuntu ] && continue
+    echo "@@project $name"
+    grep -E '^PORT=' $name/$name/.env 2>/dev/null
+    echo "DOMAINS=$(cat $name/.domains 2>/dev/null | tr '\\n' ' ')"
+    echo "DISK_KB=$(du -sk $name 2>/dev/null | cut -f1)"
+    [ -d $name/venv ] && echo "VENV_AGE=$((now - $(stat -c %Y $name/venv)))"
+    [ -d $name/$name/.git ] && echo "COMMIT=$(git -c safe.directory='*' -C $name/$name log -1 --format='%h %ct %s')"
+done
+exit 0
+"""
+
+
+@task()
+def collect():
+    """
+    Return status rows of all projects on host in one round trip.
+    """
+    with hide('output'):
+        return parse_status(run_script(status_script))
+
+
+def parse_uptime(description):
+    """
+    Seconds from supervisor description like "pid 1000, uptime 2 days, 3:04:05", None when not running.
+    """
+    if 'uptime ' not in description:
+        return None
+    uptime = description.rsplit('uptime ', 1)[1]
+    days = 0
+    if 'day' in uptime:
+        days, uptime = uptime.split(' ', 1)[0], uptime.rsplit(' ', 1)[1]
+    try:
+        hours, minutes, seconds = [int(part) for part in uptime.split(':')]
+        return int(days) * 86400 + hours * 3600 + minutes * 60 + seconds
+    except ValueError:
+        return None
+
+
+def parse_status(text):
+    """
+    Parse output of status_script into list of dicts, one per project.
+    """
+    programs = {}
+    rows = []
+    section = None
+    for line in text.splitlines():
+        if line == '@@supervisor':
+            section = 'supervisor'
+        elif line.startswith('@@project '):
+            section = 'project'
+            rows.append({'project': line.split(' ', 1)[1], 'port': '', 'domains': '', 'disk_kb': 0,
+                         'venv_age': None, 'commit': ''})
+        elif section == 'supervisor' and line.strip():
+            fields = line.split(None, 2)
+            uptime = parse_uptime(fields[2]) if len(fields) > 2 else None
+            programs[fields[0]] = (fields[1] if len(fields) > 1 else '', uptime)
+        elif section == 'project' and '=' in line:
+            key, value = line.split('=', 1)
+            row = rows[-1]
+            if key == 'PORT':
+                row['port'] = value.strip()
+            elif key == 'DOMAINS':
+                row['domains'] = ' '.join(value.split())
+            elif key == 'DISK_KB' and value.strip().isdigit():
+                row['disk_kb'] = int(value)
+            elif key == 'VENV_AGE' and value.strip().lstrip('-').isdigit():
+                row['venv_age'] = int(value)
+            elif key == 'COMMIT':
+                row['commit'] = value.strip()
+    for row in rows:
+        names = [row['project']] + ['{}_{}'.format(row['project'], color) for color in ('blue', 'green')]
+        found = [(name, programs[name]) for name in names if name in programs]
+        if not found:
+            row['state'], row['uptime'] = 'NO PROGRAM', None
+        elif len(found) == 1:
+            row['state'], row['uptime'] = found[0][1]
+        else:
+            row['state'] = ' '.join('{}:{}'.format(name.rsplit('_', 1)[1], state) for name, (state, _) in found)
+            row['uptime'] = max([uptime for _, (state, uptime) in found if state == 'RUNNING' and uptime is not None]
+                                or [None])
+    return rows
+
+
+def load_cache(path=None):
+    try:
+        with open(path or CACHE_PATH) as cache_file:
+            return json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def store_cache(cache, path=None):
+    path = path or CACHE_PATH
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), 0o700)
+    with open(path + '.tmp', 'w') as cache_file:
+        json.dump(cache, cache_file)
+    os.rename(path + '.tmp', path)
+
+
+def fleet_status(hosts, ttl=CACHE_TTL):
+    """
+    Return dict host -> {'time', 'rows', 'error'}. Hosts cached less than ttl seconds ago are not queried,
+    others are queried all at once. ttl 0 bypasses cache.
+    """
+    cache = load_cache() if ttl else {}
+    now = time.time()
+    stale = [host for host in hosts if host not in cache or now - cache[host]['time'] >= ttl]
+    if stale:
+        for host, (rows, error) in collect_from_hosts(collect, stale).items():
+            cache[host] = {'time': time.time(), 'rows': rows or [], 'error': error}
+        if ttl:
+            store_cache(cache)
+    return dict((host, cache[host]) for host in hosts)
+
+
+def format_size(kb):
+    for unit in ('K', 'M', 'G'):
+        if kb < 1024:
+            return '{:.0f}{}'.format(kb, unit)
+        kb /= 1024.0
+    return '{:.1f}T'.format(kb)
+
+
+def format_age(seconds):
+    if seconds is None:
+        return '-'
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= size:
+            return '{}{}'.format(seconds // size, unit)
+    return '{}s'.format(seconds)
+
+
+def format_commit(commit, now):
+    parts = commit.split(' ', 2)
+    if len(parts) < 2 or not parts[1].isdigit():
+        return commit or '-'
+    return ' '.join([parts[0], '({} ago)'.format(format_age(int(now - int(parts[1]))))] + parts[2:])
+
+
+def render(status):
+    """
+    Return table lines: header and one line per project as (key, text, color).
+    """
+    now = time.time()
+    cells = []
+    for host in sorted(status):
+        entry = status[host]
+        if entry['error']:
+            cells.append(((host, None), [host, '-', entry['error']], red))
+            continue
+        for row in sorted(entry['rows'], key=lambda r: r['project']):
+            color = green if row['state'] == 'RUNNING' else red if 'RUNNING' not in row['state'] else yellow
+            cells.append(((host, row['project']), [
+                host, row['project'], row['state'], format_age(row['uptime']), row['port'] or '-',
+                row['domains'] or '-', format_size(row['disk_kb']), format_age(row['venv_age']), format_commit(row['commit'], now)], color))
+    widths = [max([len(COLUMNS[i])] + [len(values[i]) for _, values, _ in cells if len(values) > i + 1])
+              for i in range(len(COLUMNS))]
+
+    def line(values):
+        return '  '.join([value.ljust(width) for value, width in zip(values[:-1], widths)] + [values[-1]])[:200]
+
+    return [(None, line(COLUMNS), None)] + [(key, line(values), color) for key, values, color in cells]
+
+
+def show(hosts, ttl=CACHE_TTL):
+    for _, text, color in render(fleet_status(hosts, ttl)):
+        puts(color(text) if color else text, show_prefix=False)
+
+
+def watch(hosts, interval):
+    """
+    Redraw status every interval seconds. On terminal only changed lines are rewritten in place,
+    otherwise changed lines are printed with time of change. Ages are shown in whole units, so running
+    projects do not change every refresh.
+    """
+    shown = []
+    while True:
+        lines = render(fleet_status(hosts, interval))
+        tty = sys.stdout.isatty()
+        if not shown or (tty and [key for key, _, _ in lines] != [key for key, _, _ in shown]):
+            for _, text, color in lines:
+                sys.stdout.write((color(text) if color else text) + '\n')
+        else:
+            previous = dict((key, text) for key, text, _ in shown)
+            for index, (key, text, color) in enumerate(lines):
+                if previous.get(key) == text:
+                    continue
+                if tty:
+                    up = len(lines) - index
+                    sys.stdout.write('\x1b[{}A\r\x1b[K{}\x1b[{}B\r'.format(up, color(text) if color else text, up))
+                else:
+                    sys.stdout.write('{} {}\n'.format(time.strftime('%H:%M:%S'), color(text) if color else text))
+        sys.stdout.flush()
+        shown = lines
+        time.sleep(interval)
@@ -0,0 +1,133 @@
+from __future__ import unicode_literals, print_function
+
+import functools
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+
+import six
+from fabric.state import env
+from fabric.utils import puts
+
+from .redaction import MASK, redact as redact_secrets
+
+__all__ = ['SECRET_PATTERNS', 'Tracer', 'redact', 'record', 'span', 'traced']
+
+SECRET_PATTERNS = [
+    re.compile(r'(PASSWORD=)[^\s;&|]+'),
+    re.compile(r"(password ')[^']*"),
+    re.compile(r'(://[^:/@\s]+:)[^@\s]+(?=@)'),
+    re.compile(r'((?:SECRET|TOKEN)[A-Z_]*=)[^\s;&|]+'),
+]
+MAX_NAME_LENGTH = 200
+
+
+def redact(text):
+    """
+    Mask registered secrets and secret-looking assignments in command.
+    """
+    text = redact_secrets(text)
+    for pattern in SECRET_PATTERNS:
+        text = pattern.sub(r'\1' + MASK, text)
+    return text
+
+
+class Tracer(object):
+    """
+    Collects timed spans of tasks and remote operations, exports them as Chrome trace JSON
+    (chrome://tracing, Perfetto) and prints slowest ones.
+    """
+
+    def __init__(self, argv=None):
+        self.argv = argv or []
+        self.events = []
+
+    def add(self, name, category, started, duration, **args):
+        self.events.append({
+            'name': redact(name)[:MAX_NAME_LENGTH],
+            'cat': category,
+            'ts': started,
+            'dur': duration,
+            'host': env.host_string or 'local',
+            'args': args,
+        })
+
+    def chrome_trace(self):
+        start = min([event['ts'] for event in self.events] or [0])
+        hosts = {}
+        trace_events = []
+        for event in sorted(self.events, key=lambda e: (e['ts'], -e['dur'])):
+            tid = hosts.setdefault(event['host'], len(hosts) + 1)
+            trace_events.append({
+                'name': event['name'],
+                'cat': event['cat'],
+                'ph': 'X',
+                'ts': int((event['ts'] - start) * 1000000),
+                'dur': int(event['dur'] * 1000000),
+                'pid': 1,
+                'tid': tid,
+                'args': dict(event['args'], host=event['host']),
+            })
+        for host, tid in hosts.items():
+            trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': host}})
+        return {
+            'traceEvents': trace_events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'command': redact(' '.join(['hmara'] + self.argv))},
+        }
+
+    def write(self, path):
+        with open(path, 'w') as trace_file:
+            json.dump(self.chrome_trace(), trace_file)
+
+    def slowest(self, count):
+        return sorted(self.events, key=lambda e: e['dur'], reverse=True)[:count]
+
+    def print_profile(self, count):
+        events = self.slowest(count)
+        if not events:
+            return
+        width = max(len(event['host']) for event in events)
+        puts('slowest {} steps:'.format(len(events)), show_prefix=False)
+        for event in events:
+            puts('{:>9.2f}s  {}  {:<6}  {}'.format(event['dur'], event['host'].ljust(width), event['cat'],
+                                                    event['name'][:100]), show_prefix=False)
+
+
+def record(category, name, started, **args):
+    """
+    Add span which started at started and ends now to tracer of current run, if tracing is on.
+    """
+    tracer = env.get('tracer')
+    if tracer is not None:
+        tracer.add(name, category, started, time.time() - started, **args)
+
+
+@contextmanager
+def span(name, category='step'):
+    started = time.time()
+    try:
+        yield
+    except BaseException as e:
+        record(category, name, started, error=type(e).__name__)
+        raise
+    record(category, name, started)
+
+
+def traced(func):
+    """
+    Record every call of task as span named after module, function and its string arguments.
+    """
+    module = func.__module__.rsplit('.', 1)[-1]
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if env.get('tracer') is None:
+            return func(*args, **kwargs)
+        name = ' '.join(['{}.{}'.format(module, func.__name__)] +
+                        [arg for arg in args if isinstance(arg, six.string_types)])
+        with span(name, 'task'):
+            return func(*args, **kwargs)
+    return wrapper
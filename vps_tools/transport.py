@@ -0,0 +1,580 @@
+from __future__ import unicode_literals, print_function
+
+import base64
+import os
+import re
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+import six
+from six.moves import shlex_quote
+from fabric import operations
+from fabric.context_managers import settings, hide
+from fabric.state import env, connections, output
+from fabric.utils import abort
+
+from . import tracing
+
+__all__ = ['CommandResult', 'TransportStats', 'Transport', 'FabricTransport', 'LocalTransport', 'FakeCall',
+           'FakeHost', 'get_transport', 'use_transport', 'script_command', 'sudo', 'get', 'put', 'exists', 'append',
+           'run_script', 'stream']
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+# sudo prompt and line printed to stderr once command started, so password is sent only when sudo asks for it
+SUDO_PROMPT = '@@hmara-sudo-password@@'
+STARTED_MARKER = '@@hmara-started@@'
+
+_script_names = {}
+
+
+class CommandResult(six.text_type):
+    """
+    Output of remote command with return code and stderr, like result of fabric sudo.
+    """
+
+    def __new__(cls, stdout='', return_code=0, stderr='', command=''):
+        data = None
+        if isinstance(stdout, bytes):
+            data, stdout = stdout, stdout.decode('utf-8', 'replace')
+        result = super(CommandResult, cls).__new__(cls, stdout)
+        # raw output when it was given as bytes, streamed as is
+        result.data = data
+        result.return_code = return_code
+        result.stderr = stderr
+        result.command = command
+        return result
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+
+    @property
+    def failed(self):
+        return not self.succeeded
+
+
+class TransportStats(object):
+    """
+    Remote round trips, bytes and time spent by transport operations.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.elapsed = 0.0
+        self.operations = []
+
+    def record(self, kind, detail, sent, received, elapsed):
+        self.round_trips += 1
+        self.bytes_sent += sent
+        self.bytes_received += received
+        self.elapsed += elapsed
+        self.operations.append((kind, detail))
+
+
+def script_command(script, args, stdin=False):
+    """
+    Command running multiline script with sh, script is sent base64-encoded so no quoting is needed.
+    With stdin script is passed to sh -c, leaving stdin of script free for data.
+    """
+    encoded = base64.b64encode(script.encode('utf-8')).decode('ascii')
+    if stdin:
+        template = 'sh -c "$(echo {encoded} | base64 -d)" sh {args}'
+    else:
+        template = 'echo {encoded} | base64 -d | sh -s -- {args}'
+    return template.format(encoded=encoded, args=' '.join(shlex_quote(arg) for arg in args))
+
+
+def script_label(script, args):
+    """
+    Readable name of script call: name of module constant holding the script and its arguments.
+    """
+    name = _script_names.get(script)
+    if name is None:
+        name = 'script'
+        for module_name, module in list(sys.modules.items()):
+            if module is None or not module_name.startswith('vps_tools.'):
+                continue
+            for attr, value in list(vars(module).items()):
+                if attr.endswith('_script') and isinstance(value, six.string_types) and value == script:
+                    name = attr
+        _script_names[script] = name
+    return ' '.join([name] + [shlex_quote(arg) for arg in args])
+
+
+def context_command(command):
+    """
+    Prefix command with cd and export from fabric env.cwd and env.shell_env, like fabric does.
+    """
+    parts = []
+    if env.cwd:
+        parts.append('cd {}'.format(shlex_quote(env.cwd)))
+    if env.shell_env:
+        parts.append('export {}'.format(' '.join('{}={}'.format(k, shlex_quote(v))
+                                                 for k, v in sorted(env.shell_env.items()))))
+    parts.append(command)
+    return ' && '.join(parts)
+
+
+def check_result(result, operation='sudo'):
+    if result.failed and not env.warn_only:
+        abort('{}() received nonzero return code {} while executing!\n\nRequested: {}\n\n{}{}'.format(
+            operation, result.return_code, result.command, result, result.stderr))
+    return result
+
+
+def read_local(local_path):
+    if hasattr(local_path, 'read'):
+        data = local_path.read()
+    else:
+        with open(local_path, 'rb') as local_file:
+            data = local_file.read()
+    if isinstance(data, six.text_type):
+        data = data.encode('utf-8')
+    return data
+
+
+def write_local(local_path, data):
+    if hasattr(local_path, 'write'):
+        local_path.write(data)
+    else:
+        with open(local_path, 'wb') as local_file:
+            local_file.write(data)
+
+
+class Transport(object):
+    """
+    Remote operations used by hmara tasks. Subclasses implement _sudo, _put, _get and _stream,
+    public methods keep statistics. Commands run in fabric env context: cwd, sudo_user, shell_env, warn_only.
+    """
+    name = None
+
+    def __init__(self):
+        self.stats = TransportStats()
+
+    def record(self, kind, detail, sent, received, started, return_code=None):
+        self.stats.record(kind, detail, sent, received, time.time() - started)
+        tracing.record(kind, detail, started, return_code=return_code, bytes_sent=sent, bytes_received=received)
+
+    def sudo(self, command, **kwargs):
+        return self.call(command, command, **kwargs)
+
+    def call(self, command, label, **kwargs):
+        """
+        Run command with _sudo and record it under label. Aborted commands are recorded without output.
+        """
+        started = time.time()
+        result = None
+        try:
+            result = self._sudo(command, **kwargs)
+        finally:
+            if result is None:
+                self.record('sudo', label, len(command), 0, started, 'aborted')
+            else:
+                self.record('sudo', label, len(command), len(result) + len(result.stderr or ''), started,
+                            result.return_code)
+        return result
+
+    def run_script(self, script, *args, **kwargs):
+        """
+        Run multiline shell script with one sudo call and return its output. Call is recorded under label,
+        by default name of script and its arguments; pass label when arguments should not reach traces.
+        Secrets go in stdin: unlike arguments it does not show in process list or sudo logs.
+        """
+        label = kwargs.get('label') or script_label(script, args)
+        stdin = kwargs.get('stdin')
+        if stdin is None:
+            with hide('running', 'output'):
+                return self.call(script_command(script, args), label, pty=False, combine_stderr=False)
+        if isinstance(stdin, six.text_type):
+            stdin = stdin.encode('utf-8')
+        command = script_command(script, args, stdin=True)
+        started = time.time()
+        chunks = []
+        return_code = 'aborted'
+        try:
+            return_code, errors = self._stream(command, chunks.append, env.sudo_user, STREAM_CHUNK_SIZE, stdin)
+        finally:
+            self.record('sudo', label, len(command) + len(stdin), sum(len(chunk) for chunk in chunks), started,
+                        return_code)
+        return check_result(CommandResult(b''.join(chunks).rstrip(b'\n'), return_code, errors.rstrip('\n'), command))
+
+    def put(self, local_path, remote_path, use_sudo=False, mode=None):
+        started = time.time()
+        data = read_local(local_path)
+        try:
+            return self._put(data, remote_path, use_sudo=use_sudo, mode=mode)
+        finally:
+            self.record('put', remote_path, len(data), 0, started)
+
+    def get(self, remote_path, local_path):
+        started = time.time()
+        size = [0]
+        try:
+            self._get(remote_path, local_path, size)
+        finally:
+            self.record('get', remote_path, 0, size[0], started)
+
+    def exists(self, path):
+        started = time.time()
+        command = 'test -e {}'.format(shlex_quote(path))
+        with settings(hide('everything'), warn_only=True):
+            result = self._sudo(command)
+        self.record('sudo', command, len(command), 0, started, result.return_code)
+        return result.succeeded
+
+    def append(self, filename, text):
+        """
+        Append lines not yet present in file, with one call whatever number of lines is.
+        """
+        lines = [text] if isinstance(text, six.string_types) else text
+        command = ' && '.join("{{ grep -qxF -- {line} {path} 2>/dev/null || echo {line} >> {path}; }}".format(
+            line=shlex_quote(line), path=shlex_quote(filename)) for line in lines)
+        return self.sudo(command)
+
+    def stream(self, command, write, user=None, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Run command with sudo and pass its stdout to write chunk by chunk. Returns exit code and stderr.
+        """
+        started = time.time()
+        size = [0]
+
+        def counting_write(data):
+            size[0] += len(data)
+            write(data)
+        return_code = 'aborted'
+        try:
+            return_code, errors = self._stream(command, counting_write, user, chunk_size)
+            return return_code, errors
+        finally:
+            self.record('stream', command, len(command), size[0], started, return_code)
+
+    def _sudo(self, command, **kwargs):
+        raise NotImplementedError
+
+    def _put(self, data, remote_path, use_sudo, mode):
+        raise NotImplementedError
+
+    def _get(self, remote_path, local_path, size):
+        raise NotImplementedError
+
+    def _stream(self, command, write, user, chunk_size, stdin=None):
+        raise NotImplementedError
+
+
+class FabricTransport(Transport):
+    """
+    Operations over SSH with fabric.
+    """
+    name = 'fabric'
+
+    def _sudo(self, command, **kwargs):
+        return operations.sudo(command, **kwargs)
+
+    def _put(self, data, remote_path, use_sudo, mode):
+        return operations.put(six.BytesIO(data), remote_path, use_sudo=use_sudo, mode=mode)
+
+    def _get(self, remote_path, local_path, size):
+        if hasattr(local_path, 'write'):
+            position = local_path.tell()
+            operations.get(remote_path, local_path)
+            size[0] = local_path.tell() - position
+        else:
+            operations.get(remote_path, local_path)
+            size[0] = os.path.getsize(local_path)
+
+    def _stream(self, command, write, user, chunk_size, stdin=None):
+        channel = connections[env.host_string].get_transport().open_session()
+        channel.exec_command('sudo -S -p {prompt} {user}bash -o pipefail -c {command}'.format(
+            prompt=shlex_quote(SUDO_PROMPT), user='-u {} -H '.format(user) if user else '',
+            command=shlex_quote('echo {} >&2; {}'.format(STARTED_MARKER, context_command(command)))))
+        started, errors = self._authenticate(channel, chunk_size)
+        errors = [errors]
+        if started and stdin:
+            channel.sendall(stdin)
+        channel.shutdown_write()
+        while True:
+            data = channel.recv(chunk_size)
+            while channel.recv_stderr_ready():
+                errors.append(channel.recv_stderr(chunk_size))
+            if not data:
+                break
+            write(data)
+        while channel.recv_stderr_ready():
+            errors.append(channel.recv_stderr(chunk_size))
+        return_code = channel.recv_exit_status()
+        channel.close()
+        return return_code, b''.join(errors).decode('utf-8', 'replace')
+
+    def _authenticate(self, channel, chunk_size):
+        """
+        Read stderr until command started, answering sudo password prompt if there is one; with NOPASSWD sudo
+        nothing is sent, so password never reaches stdin of command. Returns whether command started and stderr
+        written before it did.
+        """
+        prompt, started = SUDO_PROMPT.encode('ascii'), STARTED_MARKER.encode('ascii') + b'\n'
+        errors = b''
+        answered = False
+        while started not in errors:
+            data = channel.recv_stderr(chunk_size)
+            if not data:
+                break
+            errors += data
+            if prompt in errors:
+                errors = errors.replace(prompt, b'')
+                if answered or not env.password:
+                    # wrong or no password, sudo fails once it reads end of input
+                    channel.shutdown_write()
+                else:
+                    channel.sendall('{}\n'.format(env.password).encode('utf-8'))
+                    answered = True
+        return started in errors, errors.replace(started, b'')
+
+
+class LocalTransport(Transport):
+    """
+    Operations on this machine with subprocess, for running hmara on the server itself.
+    """
+    name = 'local'
+
+    def command_args(self, command, user=None):
+        user = user or env.sudo_user
+        if user:
+            return ['sudo', '-n', '-u', user, '-H', 'bash', '-c', command]
+        if os.geteuid() == 0:
+            return ['bash', '-c', command]
+        return ['sudo', '-n', 'bash', '-c', command]
+
+    def _sudo(self, command, pty=True, combine_stderr=None, user=None, warn_only=False, **kwargs):
+        if combine_stderr is None:
+            combine_stderr = env.combine_stderr
+        if output.running:
+            print('[localhost] sudo: {}'.format(command))
+        process = subprocess.Popen(self.command_args(context_command(command), user),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT if combine_stderr else subprocess.PIPE)
+        out, err = process.communicate()
+        out = out.decode('utf-8', 'replace')
+        err = (err or b'').decode('utf-8', 'replace')
+        if output.stdout and out:
+            sys.stdout.write(out)
+        if output.stderr and err:
+            sys.stderr.write(err)
+        result = CommandResult(out.rstrip('\n'), process.returncode, err.rstrip('\n'), command)
+        with settings(warn_only=warn_only or env.warn_only):
+            return check_result(result)
+
+    def _put(self, data, remote_path, use_sudo, mode):
+        process = subprocess.Popen(self.command_args('cat > {}'.format(shlex_quote(remote_path))),
+                                   stdin=subprocess.PIPE)
+        process.communicate(data)
+        if process.returncode != 0:
+            abort('put() failed to write {}'.format(remote_path))
+        if mode is not None:
+            subprocess.check_call(self.command_args('chmod {:o} {}'.format(mode, shlex_quote(remote_path))))
+        return [remote_path]
+
+    def _get(self, remote_path, local_path, size):
+        process = subprocess.Popen(self.command_args('cat {}'.format(shlex_quote(remote_path))),
+                                   stdout=subprocess.PIPE)
+        data, _ = process.communicate()
+        if process.returncode != 0:
+            abort('get() failed to read {}'.format(remote_path))
+        write_local(local_path, data)
+        size[0] = len(data)
+
+    def _stream(self, command, write, user, chunk_size, stdin=None):
+        process = subprocess.Popen(self.command_args('set -o pipefail; ' + context_command(command), user),
+                                   stdin=subprocess.PIPE if stdin else None,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if stdin:
+            process.stdin.write(stdin)
+            process.stdin.close()
+        try:
+            while True:
+                # os.read returns what is available, so output of long running commands is passed on as it comes
+                data = os.read(process.stdout.fileno(), chunk_size)
+                if not data:
+                    break
+                write(data)
+        finally:
+            if process.poll() is None:
+                process.terminate()
+        err = process.stderr.read()
+        return process.wait(), err.decode('utf-8', 'replace')
+
+
+class FakeCall(object):
+    """
+    Command received by fake host with env context it ran in; match is regex match of responder,
+    stdin is data sent to script.
+    """
+
+    def __init__(self, command, args=(), match=None, stdin=None):
+        self.command = command
+        self.args = args
+        self.match = match
+        self.stdin = stdin
+        self.cwd = env.cwd
+        self.user = env.sudo_user
+        self.shell_env = dict(env.shell_env)
+
+
+class FakeHost(Transport):
+    """
+    In-memory host: files live in a dict, commands and scripts are answered by registered responders.
+    Responder is a string, (stdout, return_code) tuple or callable taking FakeCall and returning one of them.
+    Commands and scripts without responder are answered by fallback, by default they succeed with empty output.
+    """
+    name = 'fake'
+
+    def __init__(self, files=None, fallback=''):
+        super(FakeHost, self).__init__()
+        self.files = dict(files or {})
+        self.modes = {}
+        self.responders = []
+        self.scripts = {}
+        self.calls = []
+        self.fallback = fallback
+
+    def on(self, pattern, response):
+        self.responders.append((re.compile(pattern), response))
+        return self
+
+    def on_script(self, script, response):
+        self.scripts[script] = response
+        return self
+
+    def respond(self, response, call):
+        if callable(response):
+            response = response(call)
+        if response is None:
+            response = ''
+        if isinstance(response, tuple):
+            stdout, return_code = response
+        else:
+            stdout, return_code = response, 0
+        return CommandResult(stdout, return_code, '', call.command)
+
+    def _sudo(self, command, warn_only=False, **kwargs):
+        call = FakeCall(command)
+        self.calls.append(call)
+        for pattern, response in self.responders:
+            call.match = pattern.search(command)
+            if call.match:
+                result = self.respond(response, call)
+                break
+        else:
+            result = self.builtin(call)
+        with settings(warn_only=warn_only or env.warn_only):
+            return check_result(result)
+
+    def builtin(self, call):
+        match = re.match(r'test -e (\S+)$', call.command)
+        if match:
+            return CommandResult('', 0 if self.path(match.group(1)) in self.files else 1, '', call.command)
+        match = re.match(r'cat (\S+)( 2>/dev/null \|\| true)?$', call.command)
+        if match:
+            path = self.path(match.group(1))
+            if path in self.files:
+                return CommandResult(self.files[path].rstrip(b'\n'), 0, '', call.command)
+            return CommandResult('', 0 if match.group(2) else 1, '', call.command)
+        return self.respond(self.fallback, call)
+
+    @staticmethod
+    def path(quoted):
+        return quoted.strip("'")
+
+    def run_script(self, script, *args, **kwargs):
+        started = time.time()
+        stdin = kwargs.get('stdin')
+        if isinstance(stdin, six.text_type):
+            stdin = stdin.encode('utf-8')
+        call = FakeCall(script, args, stdin=stdin)
+        self.calls.append(call)
+        result = self.respond(self.scripts.get(script, self.fallback), call)
+        result.command = script_command(script, args, stdin=stdin is not None)
+        self.record('sudo', kwargs.get('label') or script_label(script, args),
+                    len(result.command) + len(stdin or b''), len(result), started, result.return_code)
+        return check_result(result)
+
+    def _put(self, data, remote_path, use_sudo, mode):
+        self.files[remote_path] = data
+        if mode is not None:
+            self.modes[remote_path] = mode
+        return [remote_path]
+
+    def _get(self, remote_path, local_path, size):
+        if remote_path not in self.files:
+            abort('get() failed: {} does not exist'.format(remote_path))
+        write_local(local_path, self.files[remote_path])
+        size[0] = len(self.files[remote_path])
+
+    def append(self, filename, text):
+        started = time.time()
+        lines = [text] if isinstance(text, six.string_types) else text
+        content = self.files.get(filename, b'').decode('utf-8')
+        present = set(content.splitlines())
+        for line in lines:
+            if line not in present:
+                if content and not content.endswith('\n'):
+                    content += '\n'
+                content += line + '\n'
+        self.files[filename] = content.encode('utf-8')
+        self.record('sudo', 'append {}'.format(filename), sum(len(line) for line in lines), 0, started, 0)
+
+    def _stream(self, command, write, user, chunk_size, stdin=None):
+        result = self._sudo(command, warn_only=True)
+        data = result.data if result.data is not None else result.encode('utf-8')
+        for position in range(0, len(data), chunk_size):
+            write(data[position:position + chunk_size])
+        return result.return_code, result.stderr
+
+
+def get_transport():
+    """
+    Transport of current fabric env, fabric over SSH unless set by use_transport.
+    """
+    if env.get('transport') is None:
+        env.transport = FabricTransport()
+    return env.transport
+
+
+@contextmanager
+def use_transport(transport):
+    with settings(transport=transport):
+        yield transport
+
+
+def sudo(command, **kwargs):
+    return get_transport().sudo(command, **kwargs)
+
+
+def run_script(script, *args, **kwargs):
+    return get_transport().run_script(script, *args, **kwargs)
+
+
+def put(local_path, remote_path, use_sudo=False, mode=None):
+    return get_transport().put(local_path, remote_path, use_sudo=use_sudo, mode=mode)
+
+
+def get(remote_path, local_path):
+    return get_transport().get(remote_path, local_path)
+
+
+def exists(path):
+    return get_transport().exists(path)
+
+
+def append(filename, text):
+    return get_transport().append(filename, text)
+
+
+def stream(command, write, user=None, chunk_size=STREAM_CHUNK_SIZE):
+    return get_transport().stream(command, write, user=user, chunk_size=chunk_size)
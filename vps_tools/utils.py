@@ -1,20 +1,37 @@
 from __future__ import unicode_literals, print_function
+import base64
+import hashlib
 import random
+import re
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 import string
 from StringIO import StringIO
-from time import sleep
-
 import sys
-from fabric.context_managers import settings, cd, shell_env
-from fabric.contrib.files import exists
-from fabric.operations import sudo, get, put
+from fabric.context_managers import settings, cd, shell_env, hide
+from fabric.state import env
+from fabric.utils import abort, puts
+from fabric.colors import red
 import six
 
-__all__ = ['config_nginx', 'id_generator', 'add_domain', 'remove_domain', 'get_port_number', 'StreamFilter',
+from .readiness import wait_until, wait_for_program, reload_nginx, DEFAULT_TIMEOUT
+from .transport import sudo, put, run_script, stream
+from .redaction import register_environment
+
+__all__ = ['config_nginx', 'nginx_batch', 'id_generator', 'add_domain', 'remove_domain', 'get_port_number',
            'run_until_ok', 'load_environment_dict', 'store_environment_dict', 'create_home_folder',
-           'create_logs_folder', 'get_project_type']
+           'create_logs_folder', 'get_project_type', 'run_script', 'ProjectSnapshot', 'take_snapshot',
+           'load_environment_dicts', 'store_environment_dicts', 'Environment', 'list_environment_versions',
+           'rollback_environment', 'stream_command', 'pip_install', 'precompress_static',
+           'release_ports',
+           'prune_ports', 'port_owner', 'list_ports']
+
+nginx_config = """log_format {project_name}_timed '$remote_addr - $remote_user [$time_local] "$request" $status '
+    '$body_bytes_sent "$http_referer" "$http_user_agent" '
+    '$request_time $upstream_response_time';
 
-nginx_config = """server {{
+server {{
     listen 80;
     server_name {domain_list};
     
@@ -23,7 +40,7 @@ nginx_config = """server {{
     location / {{
         include /etc/nginx/proxy_params;
         proxy_pass http://127.0.0.1:{port};
-        access_log /home/{project_name}/logs/access.log;
+        access_log /home/{project_name}/logs/access.log {project_name}_timed;
         error_log /home/{project_name}/logs/error.log error;        
     }}
 }}
@@ -31,15 +48,15 @@ nginx_config = """server {{
 
 nginx_config_static = """
     location /static {{
-        gzip_static on;
+        gzip_static on;{brotli_static}
         root /home/{project_name}/{project_name};
         add_header Cache-Control "public, max-age=31536000, immutable";            
     }}
 """
 
-supervisor_config = """[program:{project_name}]
-command=forego start
-autostart=true
+supervisor_config = """[program:{program_name}]
+command=forego start{port_option}
+autostart={autostart}
 autorestart=true
 stopasgroup=true
 stdout_logfile=/home/{project_name}/logs/stdout.log
@@ -48,133 +65,698 @@ user={project_name}
 directory=/home/{project_name}/{project_name}
 """
 
+snapshot_script = """home=/home/$1
+project=$home/$1
+echo '@@env'; cat $project/.env 2>/dev/null; echo
+echo '@@domains'; cat $home/.domains 2>/dev/null; echo
+echo '@@requirements'; cat $project/requirements.txt 2>/dev/null; echo
+echo '@@runtime'; cat $project/runtime.txt 2>/dev/null; echo
+echo '@@bluegreen'; cat $home/.bluegreen 2>/dev/null; echo
+echo '@@nginx'; sha256sum /etc/nginx/sites-available/$1 2>/dev/null | cut -c1-64
+echo '@@features'
+command -v brotli >/dev/null && echo brotli
+{ nginx -V 2>&1; cat /etc/nginx/modules-enabled/*.conf 2>/dev/null; } | grep -q brotli && echo nginx_brotli
+echo '@@exists'
+for path in $home $home/venv $home/logs $project $project/static $project/manage.py $project/requirements.txt \\
+        $project/package.json $project/yarn.lock $project/runtime.txt \\
+        /etc/nginx/sites-enabled/$1 /etc/supervisor/conf.d/$1.conf /var/log/$1; do
+    [ -e $path ] && echo $path
+done
+echo '@@hashes'
+cd $project 2>/dev/null && sha256sum requirements.txt package.json yarn.lock runtime.txt 2>/dev/null
+exit 0
+"""
+
+ENV_VERSIONS = 10
+
+load_environments_script = """[ $# -eq 0 ] && set -- $(cd /home && for name in *; do [ -f $name/$name/.env ] && echo $name; done)
+for name in "$@"; do
+    [ -f /home/$name/$name/.env ] || continue
+    echo "@@$name $(sha256sum < /home/$name/$name/.env | cut -c1-64)"; cat /home/$name/$name/.env; echo
+done
+exit 0
+"""
+
+# .env is replaced only if it is still the one read (digest), previous one is kept as hard link in .env-versions;
+# contents come base64-encoded one per line on stdin, so they never show in process list or sudo logs
+store_environments_script = """versions=$1; shift
+while [ $# -ge 3 ]; do
+    name=$1; expected=$2; digest=$3; shift 3
+    read -r content
+    dir=/home/$name/$name; history=/home/$name/.env-versions
+    (
+        flock 9
+        current=-
+        [ -f $dir/.env ] && current=$(sha256sum < $dir/.env | cut -c1-64)
+        if [ "$current" != "$expected" ]; then
+            echo "@@conflict $name"; exit 0
+        fi
+        tmp=$(mktemp $dir/.env.XXXXXX) || exit 1
+        echo "$content" | base64 -d > $tmp && chown $name:$name $tmp && chmod 0600 $tmp &&
+            [ "$(sha256sum < $tmp | cut -c1-64)" = "$digest" ] || { rm -f $tmp; exit 1; }
+        if [ -f $dir/.env ]; then
+            mkdir -p $history && chown $name:$name $history && chmod 0700 $history
+            saved=$history/$(date +%Y%m%d-%H%M%S.%N)
+            ln $dir/.env $saved 2>/dev/null || cp -p $dir/.env $saved
+            ls -1 $history | sort -r | tail -n +$((versions + 1)) | sed "s|^|$history/|" | xargs -r rm -f
+        fi
+        mv -f $tmp $dir/.env && echo "@@stored $name"
+    ) 9>/home/$name/.env.lock || echo "@@failed $name"
+done
+exit 0
+"""
+
+env_versions_script = """command=$1; name=$2; version=$3; versions=$4
+dir=/home/$name/$name; history=/home/$name/.env-versions
+if [ "$command" = list ]; then
+    ls -1 $history 2>/dev/null | sort -r
+    exit 0
+fi
+exec 9>/home/$name/.env.lock
+flock 9
+[ -n "$version" ] || version=$(ls -1 $history 2>/dev/null | sort -r | head -n 1)
+if [ -z "$version" ] || [ ! -f $history/$version ]; then
+    echo "@@missing $version"; exit 0
+fi
+if [ -f $dir/.env ] && cmp -s $history/$version $dir/.env; then
+    echo "@@unchanged $version"; exit 0
+fi
+tmp=$(mktemp $dir/.env.XXXXXX) || exit 1
+cp $history/$version $tmp && chown $name:$name $tmp && chmod 0600 $tmp || { rm -f $tmp; exit 1; }
+if [ -f $dir/.env ]; then
+    saved=$history/$(date +%Y%m%d-%H%M%S.%N)
+    ln $dir/.env $saved 2>/dev/null || cp -p $dir/.env $saved
+    ls -1 $history | sort -r | tail -n +$((versions + 1)) | sed "s|^|$history/|" | xargs -r rm -f
+fi
+mv -f $tmp $dir/.env && echo "@@restored $version"
+"""
+
+WHEEL_CACHE_FOLDER = '/var/cache/hmara/pip'
+WHEEL_CACHE_SIZE_MB = 2048
+
+pip_install_script = """venv=$1; requirements=$2; cache=$3; cap_kb=$4; owner=$5
+python_version=$($venv/bin/python -c 'import sys; print("py%d.%d" % sys.version_info[:2])') || exit 1
+key=$python_version-$(sha256sum $requirements | cut -c1-64)
+mkdir -p $cache/wheels $cache/keys
+# installs of several projects share cache, adding wheels and eviction take it alone
+exec 9>>$cache/lock
+flock -s 9
+if [ -f $cache/keys/$key ]; then
+    echo "wheel cache hit: $key"
+else
+    build=$(mktemp -d)
+    if $venv/bin/pip wheel -q -r $requirements -w $build --find-links $cache/wheels; then
+        flock 9
+        ls $build > $cache/keys/$key.tmp
+        find $build -type f -exec mv -f {} $cache/wheels/ \\;
+        mv $cache/keys/$key.tmp $cache/keys/$key
+        flock -s 9
+        echo "wheel cache filled: $key"
+    else
+        echo "wheel build failed, installing from cached wheels only"
+    fi
+    rm -rf $build
+fi
+[ -f $cache/keys/$key ] && touch $cache/keys/$key
+$venv/bin/pip install -q --no-index --find-links $cache/wheels -r $requirements || exit 1
+[ -n "$owner" ] && chown -R $owner:$owner $venv
+flock 9
+while [ $(du -sk $cache | cut -f1) -gt $cap_kb ]; do
+    oldest=$(ls -tr $cache/keys | grep -v '[.]tmp$' | head -1)
+    [ -z "$oldest" ] || [ "$oldest" = "$key" ] && break
+    rm -f $cache/keys/$oldest
+    echo "wheel cache evicted: $oldest"
+    cat $cache/keys/* 2>/dev/null | sort -u > $cache/referenced
+    for wheel in $(ls $cache/wheels); do
+        grep -qxF $wheel $cache/referenced || rm -f $cache/wheels/$wheel
+    done
+done
+exit 0
+"""
+
+PRECOMPRESS_EXTENSIONS = ['css', 'js', 'mjs', 'map', 'json', 'svg', 'html', 'txt', 'xml', 'ico', 'ttf', 'otf', 'eot',
+                          'webmanifest']
+# hashes of precompressed files, in project home so nginx does not serve it with static
+PRECOMPRESS_MANIFEST = '.precompress-manifest'
+
+precompress_script = """static=$1; manifest=$2; brotli=$3; shift 3
+export LC_ALL=C
+cd $static 2>/dev/null || { echo '@@precompress 0 0 0 0 0 0'; exit 0; }
+[ ! -f .precompress-manifest ] || mv -f .precompress-manifest $manifest
+command -v brotli >/dev/null || brotli=0
+pattern="[.]($(echo "$@" | tr ' ' '|'))\\$"
+jobs=$(nproc 2>/dev/null || echo 2)
+work=$(mktemp -d)
+touch $manifest
+find . -type f | grep -E "$pattern" | xargs -r -d '\\n' -P $jobs -n 64 sha256sum | sort > $work/new
+sort $manifest | comm -13 - $work/new | cut -c67- > $work/changed
+xargs -r -d '\\n' -P $jobs -n 16 sh -c '
+    for path; do
+        gzip -9 -k -f -n "$path" && [ $(stat -c %s "$path.gz") -lt $(stat -c %s "$path") ] || rm -f "$path.gz"
+        if [ "$0" = 1 ]; then
+            brotli -k -f -q 11 "$path" && [ $(stat -c %s "$path.br") -lt $(stat -c %s "$path") ] || rm -f "$path.br"
+        fi
+    done' $brotli < $work/changed
+cut -c67- $manifest | sort > $work/old_paths
+cut -c67- $work/new | sort | comm -23 $work/old_paths - | while read path; do
+    rm -f "$path.gz" "$path.br"
+done
+mv $work/new $manifest
+changed=$(wc -l < $work/changed)
+rm -rf $work
+find . -type f -printf '%s %p\\n' | awk -v pattern="$pattern" -v changed=$changed '
+    { size = $1; sub(/^[0-9]+ /, ""); sizes[$0] = size }
+    END {
+        for (path in sizes) {
+            if (path !~ pattern) continue
+            files++
+            if ((path ".gz") in sizes) { gzip_original += sizes[path]; gzip += sizes[path ".gz"] }
+            if ((path ".br") in sizes) { brotli_original += sizes[path]; brotli += sizes[path ".br"] }
+        }
+        printf "@@precompress %d %d %.0f %.0f", files, changed, gzip_original, gzip
+        printf " %.0f %.0f\\n", brotli_original, brotli
+    }'
+"""
+
+PORT_REGISTRY = '/etc/hmara/ports'
+FIRST_PORT = 8011
+
+port_registry_script = """command=$1; registry=$2; first_port=$3; shift 3
+mkdir -p $(dirname $registry)
+exec 9>>$registry.lock
+flock 9
+if [ ! -f $registry ]; then
+    touch $registry
+    for env in /home/*/*/.env; do
+        name=$(basename $(dirname $env))
+        [ $env = /home/$name/$name/.env ] || continue
+        port=$(grep -m1 '^PORT=' $env | cut -d= -f2)
+        [ -n "$port" ] && echo "$port $name" >> $registry
+    done
+    for state in /home/*/.bluegreen; do
+        [ -f $state ] || continue
+        name=$(basename $(dirname $state))
+        port=$(grep -m1 '^GREEN_PORT=' $state | cut -d= -f2)
+        [ -n "$port" ] && echo "$port $name:green" >> $registry
+    done
+fi
+update() {
+    awk "$@" $registry > $registry.tmp && mv -f $registry.tmp $registry
+}
+case $command in
+allocate)
+    port=$(awk -v key=$1 '$2 == key { print $1 }' $registry)
+    if [ -z "$port" ]; then
+        port=$( (cat $registry; ss -Htln 2>/dev/null | awk '{ n = split($4, a, ":"); print a[n], "-" }') |
+            awk -v port=$first_port '{ used[$1] = 1 } END { while (port in used) port++; print port }')
+        echo "$port $1" >> $registry
+    fi
+    echo $port
+    ;;
+release)
+    update -v name=$1 '$2 != name && index($2, name ":") != 1'
+    ;;
+who)
+    awk -v port=$1 '$1 == port { print $2 }' $registry
+    ;;
+list)
+    sort -n $registry
+    ;;
+prune)
+    # only explicit prune reclaims ports of projects without home, allocation may come before home is created
+    home='split($2, key, ":"); found = system("test -d /home/" key[1]) == 0'
+    awk "{ $home; if (!found) print }" $registry
+    update "{ $home; if (found) print }"
+    ;;
+esac
+"""
+
+nginx_apply_script = """available=/etc/nginx/sites-available/$1
+enabled=/etc/nginx/sites-enabled/$1
+[ -f $available ] && cp -p $available $available.hmara-prev
+echo $2 | base64 -d > $available.hmara-new && mv -f $available.hmara-new $available || exit 1
+created_link=
+[ -e $enabled ] || { ln -s $available $enabled; created_link=1; }
+if ! nginx -t 2>&1; then
+    if [ -f $available.hmara-prev ]; then mv -f $available.hmara-prev $available; else rm -f $available; fi
+    [ -n "$created_link" ] && rm -f $enabled
+    echo "nginx config of $1 is invalid, previous config restored"
+    exit 1
+fi
+rm -f $available.hmara-prev
+"""
+
+
+class ProjectSnapshot(object):
+    """
+    Remote state of project, collected with one round trip by take_snapshot.
+    """
+
+    def __init__(self, project_name, output):
+        self.project_name = project_name
+        self.home_folder = '/home/{project_name}'.format(project_name=project_name)
+        self.project_folder = '/home/{project_name}/{project_name}'.format(project_name=project_name)
+        sections = {}
+        section = None
+        for line in output.splitlines():
+            if line.startswith('@@'):
+                section = sections.setdefault(line[2:].strip(), [])
+            elif section is not None:
+                section.append(line)
+        self.env = parse_environment('\n'.join(sections.get('env', [])))
+        self.domains = '\n'.join(sections.get('domains', [])).split()
+        self.requirements = '\n'.join(sections.get('requirements', [])).strip()
+        self.runtime = '\n'.join(sections.get('runtime', [])).strip()
+        self.bluegreen = parse_environment('\n'.join(sections.get('bluegreen', [])))
+        self.nginx_hash = '\n'.join(sections.get('nginx', [])).strip()
+        self.features = set(line.strip() for line in sections.get('features', []) if line.strip())
+        self.paths = set(line.strip() for line in sections.get('exists', []) if line.strip())
+        self.hashes = {}
+        for line in sections.get('hashes', []):
+            if line.strip():
+                file_hash, file_name = line.split(None, 1)
+                self.hashes[file_name.strip()] = file_hash
+
+        self.has_home = self.home_folder in self.paths
+        self.has_venv = '{}/venv'.format(self.home_folder) in self.paths
+        self.has_logs = '{}/logs'.format(self.home_folder) in self.paths
+        self.has_project = self.project_folder in self.paths
+        self.has_static = self.project_path('static') in self.paths
+        self.has_manage_py = self.project_path('manage.py') in self.paths
+        self.has_requirements = self.project_path('requirements.txt') in self.paths
+        self.has_package_json = self.project_path('package.json') in self.paths
+        self.has_yarn_lock = self.project_path('yarn.lock') in self.paths
+        self.has_runtime = self.project_path('runtime.txt') in self.paths
+        self.nginx_enabled = '/etc/nginx/sites-enabled/{}'.format(project_name) in self.paths
+        self.has_supervisor_config = '/etc/supervisor/conf.d/{}.conf'.format(project_name) in self.paths
+        self.has_var_log = '/var/log/{}'.format(project_name) in self.paths
+        self.has_brotli = 'brotli' in self.features
+        self.nginx_brotli = 'nginx_brotli' in self.features
+
+    def project_path(self, name):
+        return '{}/{}'.format(self.project_folder, name)
+
+    @property
+    def port(self):
+        """
+        Port nginx should proxy to: port of active color in blue/green mode, PORT from .env otherwise.
+        """
+        if self.bluegreen:
+            return self.bluegreen['{}_PORT'.format(self.bluegreen['ACTIVE'].upper())]
+        return self.env['PORT']
+
+    @property
+    def programs(self):
+        """
+        Supervisor programs of project.
+        """
+        if self.bluegreen:
+            return ['{}_blue'.format(self.project_name), '{}_green'.format(self.project_name)]
+        return [self.project_name]
+
+
+def stream_command(command, output, user=None, label=None, chunk_size=1024 * 1024):
+    """
+    Run command with sudo over raw channel of transport and copy its stdout into output file object chunk by chunk,
+    so binary output of any size never touches remote disk or local memory. Reports throughput under label.
+    Returns number of bytes copied, aborts when command fails.
+    """
+    state = {'total': 0, 'reported': time.time()}
+    started = time.time()
+
+    def write(data):
+        output.write(data)
+        state['total'] += len(data)
+        if label and time.time() - state['reported'] > 0.5:
+            state['reported'] = time.time()
+            sys.stdout.write('\r{}: {:.1f} MB, {:.1f} MB/s'.format(
+                label, state['total'] / 1048576.0, state['total'] / 1048576.0 / (state['reported'] - started)))
+            sys.stdout.flush()
+    return_code, errors = stream(command, write, user=user, chunk_size=chunk_size)
+    total = state['total']
+    if label:
+        elapsed = max(time.time() - started, 0.001)
+        sys.stdout.write('\r{}: {:.1f} MB in {:.1f}s, {:.1f} MB/s\n'.format(
+            label, total / 1048576.0, elapsed, total / 1048576.0 / elapsed))
+        sys.stdout.flush()
+    if return_code != 0:
+        abort('{} failed with code {}: {}'.format(label or 'command', return_code, errors.strip()))
+    return total
+
+
+def pip_install(project_name):
+    """
+    Install project requirements into its venv through host-wide wheel cache. Wheels are built once per
+    interpreter version and requirements hash and shared by all projects, least recently used sets are
+    evicted when cache grows over WHEEL_CACHE_SIZE_MB. When index is unreachable requirements are installed
+    from cached wheels.
+    """
+    home_folder = '/home/{project_name}'.format(project_name=project_name)
+    with settings(sudo_user=None):
+        output = run_script(pip_install_script, '{}/venv'.format(home_folder),
+                            '{}/{}/requirements.txt'.format(home_folder, project_name), WHEEL_CACHE_FOLDER,
+                            str(WHEEL_CACHE_SIZE_MB * 1024), project_name)
+    for line in output.splitlines():
+        puts(line)
+
+
+def precompress_static(project_name, snapshot=None):
+    """
+    Write .gz and, when brotli is installed, .br copies of text assets next to collected static files, in
+    parallel on the host. Only files whose hash differs from manifest of previous run are compressed, copies
+    not smaller than original and copies of removed files are deleted. Returns dict of file counts and sizes.
+    """
+    static_folder = '/home/{project_name}/{project_name}/static'.format(project_name=project_name)
+    manifest = '/home/{}/{}'.format(project_name, PRECOMPRESS_MANIFEST)
+    with settings(sudo_user=project_name), hide('output'):
+        output = run_script(precompress_script, static_folder, manifest,
+                            '1' if snapshot is None or snapshot.has_brotli else '0', *PRECOMPRESS_EXTENSIONS)
+    line = [line for line in output.splitlines() if line.startswith('@@precompress ')][-1]
+    keys = ['files', 'changed', 'gzip_original', 'gzip', 'brotli_original', 'brotli']
+    result = dict(zip(keys, [int(value) for value in line.split()[1:]]))
+    saved = ['gzip saves {:.1f} KB'.format((result['gzip_original'] - result['gzip']) / 1024.0)]
+    if result['brotli_original']:
+        saved.append('brotli saves {:.1f} KB'.format((result['brotli_original'] - result['brotli']) / 1024.0))
+    puts('precompressed {changed} of {files} static files, '.format(**result) + ', '.join(saved))
+    return result
+
+
+def take_snapshot(project_name):
+    """
+    Read env, domains and existence/hashes of project files in one round trip.
+    """
+    return ProjectSnapshot(project_name, run_script(snapshot_script, project_name))
+
 
 def create_home_folder(project_name):
     home_folder = '/home/{project_name}'.format(project_name=project_name)
     sudo('id -u {project_name} &>/dev/null || useradd --shell /bin/false {project_name}'.format(
         project_name=project_name))
-    if not exists(home_folder):
-        sudo('mkhomedir_helper {project_name}'.format(project_name=project_name))
+    sudo('[ -d {home_folder} ] || mkhomedir_helper {project_name}'.format(home_folder=home_folder,
+                                                                            project_name=project_name))
 
 
 def create_logs_folder(project_name):
     home_folder = '/home/{project_name}'.format(project_name=project_name)
     with cd(home_folder), settings(sudo_user=project_name), shell_env(HOME=home_folder):
-        if not exists('logs'):
-            sudo('mkdir logs')
+        sudo('mkdir -p logs')
 
 ########################
 
 
-def config_nginx(project_name):
-    env_config = load_environment_dict(project_name)
-    domain_list = load_domain_list(project_name)
+@contextmanager
+def nginx_batch():
+    """
+    Collect nginx reloads requested by config_nginx inside the block into one reload at exit.
+    """
+    if env.get('nginx_batch'):
+        yield
+        return
+    env.nginx_batch = True
+    env.nginx_reload_pending = False
+    try:
+        yield
+    finally:
+        pending = env.nginx_reload_pending
+        env.nginx_batch = False
+        env.nginx_reload_pending = False
+        if pending:
+            reload_nginx()
+
+
+def config_nginx(project_name, snapshot=None, port=None):
+    """
+    Render nginx config of project and apply it only if it differs from remote one. New config is checked
+    with nginx -t and previous one is restored when check fails. Returns True when config was changed.
+    """
+    if snapshot is None:
+        snapshot = take_snapshot(project_name)
     kwargs = {
-        'domain_list': ' '.join(domain_list),
-        'port': env_config['PORT'],
+        'domain_list': ' '.join(snapshot.domains),
+        'port': port or snapshot.port,
         'project_name': project_name,
         'with_static': '',
     }
-    if exists('/home/{project_name}/{project_name}/static'.format(project_name=project_name)):
-        kwargs['with_static'] = nginx_config_static.format(project_name=project_name)
-
-    nginx_content = nginx_config.format(**kwargs)
-    put(local_path=StringIO(nginx_content),
-        remote_path='/etc/nginx/sites-available/{project_name}'.format(project_name=project_name), use_sudo=True)
-    if not exists('/etc/nginx/sites-enabled/{project_name}'.format(project_name=project_name)):
-        sudo('ln -s /etc/nginx/sites-available/{project_name} /etc/nginx/sites-enabled/'.format(
-            project_name=project_name))
-    sudo('service nginx reload')
-    run_until_ok('service nginx status')
+    if snapshot.has_static:
+        kwargs['with_static'] = nginx_config_static.format(
+            project_name=project_name, brotli_static='\n        brotli_static on;' if snapshot.nginx_brotli else '')
+
+    nginx_content = nginx_config.format(**kwargs).encode('utf-8')
+    nginx_hash = hashlib.sha256(nginx_content).hexdigest()
+    if snapshot.nginx_enabled and snapshot.nginx_hash == nginx_hash:
+        puts('nginx config of {} is up to date'.format(project_name))
+        return False
+    run_script(nginx_apply_script, project_name, base64.b64encode(nginx_content).decode('ascii'))
+    snapshot.nginx_hash = nginx_hash
+    snapshot.nginx_enabled = True
+    if env.get('nginx_batch'):
+        env.nginx_reload_pending = True
+    else:
+        reload_nginx()
+    return True
+
+
+def write_supervisor_config(project_name, bluegreen=None, autostart=None):
+    """
+    Write supervisor config of project without applying it: one program, or blue and green programs for
+    blue/green state. Colors in autostart start with supervisor, by default only active one.
+    """
+    if bluegreen:
+        autostart = autostart or (bluegreen['ACTIVE'],)
+        supervisor_content = '\n'.join(supervisor_config.format(
+            project_name=project_name, program_name='{}_{}'.format(project_name, color),
+            port_option=' -p {}'.format(bluegreen['{}_PORT'.format(color.upper())]),
+            autostart='true' if color in autostart else 'false') for color in ('blue', 'green'))
+    else:
+        supervisor_content = supervisor_config.format(project_name=project_name, program_name=project_name,
+                                                      port_option='', autostart='true')
+    put(local_path=StringIO(supervisor_content), remote_path='/etc/supervisor/conf.d/{}.conf'.format(project_name),
+        use_sudo=True)
 
 
-def config_supervisor(project_name):
-    kwargs = {
-        'project_name': project_name,
-    }
-    supervisor_content = supervisor_config.format(**kwargs)
-    put(local_path=StringIO(supervisor_content),
-        remote_path='/etc/supervisor/conf.d/{project_name}.conf'.format(project_name=project_name), use_sudo=True)
-    sudo('supervisorctl reload')
-    run_until_ok('supervisorctl status')
+def config_supervisor(project_name, bluegreen=None):
+    """
+    Write supervisor config of project, one program or blue and green programs for blue/green state,
+    and apply it with reread/update so other programs on host keep running.
+    """
+    write_supervisor_config(project_name, bluegreen)
+    sudo('supervisorctl reread && supervisorctl update')
+    wait_for_program('{}_{}'.format(project_name, bluegreen['ACTIVE']) if bluegreen else project_name)
 
 
 def id_generator(size=6, chars=string.ascii_lowercase):
     return ''.join(random.sample(chars, size))
 
 
-def run_until_ok(cmd):
-    return_code = 1
-    with settings(warn_only=True):
-        while not return_code == 0:
-            sleep(3)
-            result = sudo(cmd)
-            return_code = result.return_code
-
-
-def get_port_number():
-    if exists('.port_number'):
-        port_number_file = StringIO()
-        get('.port_number', port_number_file)
-        port_number = port_number_file.getvalue()
-    else:
-        port_number = "8010"
-    port_number = int(port_number) + 1
-    put(StringIO(str(port_number)), '.port_number')
-    return port_number
-
-
-class StreamFilter(object):
-    def __init__(self, filters, stream):
-        self.stream = stream
-        self.filters = filters
+def run_until_ok(cmd, timeout=DEFAULT_TIMEOUT):
+    def check():
+        with settings(hide('everything'), warn_only=True):
+            return sudo(cmd).return_code == 0
+    return wait_until(check, cmd, timeout)
+
+
+def port_registry(command, *args):
+    return run_script(port_registry_script, command, PORT_REGISTRY, str(FIRST_PORT), *args).split()
+
+
+def get_port_number(project_name, slot=None):
+    """
+    Allocate port for project (or its named slot, e.g. green color) in host port registry under lock.
+    Returns port already assigned to the same project and slot.
+    """
+    key = '{}:{}'.format(project_name, slot) if slot else project_name
+    return int(port_registry('allocate', key)[0])
+
+
+def release_ports(project_name, slot=None):
+    """
+    Return ports of project (or only of its named slot) to registry.
+    """
+    port_registry('release', '{}:{}'.format(project_name, slot) if slot else project_name)
+
+
+def prune_ports():
+    """
+    Release ports of projects whose home folder is gone. Returns list of released (port, key) assignments.
+    """
+    values = port_registry('prune')
+    return [(int(port), key) for port, key in zip(values[::2], values[1::2])]
+
+
+def port_owner(port):
+    """
+    Return project (or project:slot) owning port, None for free port.
+    """
+    owner = port_registry('who', str(port))
+    return owner[0] if owner else None
+
+
+def list_ports():
+    """
+    Return list of (port, project or project:slot) assignments.
+    """
+    values = port_registry('list')
+    return [(int(port), key) for port, key in zip(values[::2], values[1::2])]
+
+
+ENV_ASSIGNMENT = re.compile(r'^(?P<prefix>\s*(?:export\s+)?)(?P<key>[A-Za-z_][A-Za-z0-9_]*)=(?P<value>.*)$')
+
+
+class Environment(OrderedDict):
+    """
+    Variables of .env in file order. Lines of file are kept, so render() writes comments, blank lines and
+    untouched variables back exactly as they were; changed variables are rewritten in place, new ones appended.
+    Value is everything after first "=", spaces and "=" included. digest is sha256 of file as it was read.
+    """
+
+    def __init__(self, content='', digest='-'):
+        OrderedDict.__init__(self)
+        self.lines = content.splitlines()
+        while self.lines and not self.lines[-1].strip():
+            self.lines.pop()
+        self.digest = digest
+        for line in self.lines:
+            match = ENV_ASSIGNMENT.match(line)
+            if match:
+                self[match.group('key')] = match.group('value')
+
+    def copy(self):
+        environment = Environment('\n'.join(self.lines), self.digest)
+        environment.clear()
+        environment.update(self)
+        return environment
+
+    def render(self):
+        last = {}
+        for index, line in enumerate(self.lines):
+            match = ENV_ASSIGNMENT.match(line)
+            if match:
+                last[match.group('key')] = index
+        lines = []
+        for index, line in enumerate(self.lines):
+            match = ENV_ASSIGNMENT.match(line)
+            if match is None:
+                lines.append(line)
+                continue
+            key = match.group('key')
+            if key not in self:
+                continue
+            if last[key] == index and self[key] != match.group('value'):
+                line = '{}{}={}'.format(match.group('prefix'), key, self[key])
+            lines.append(line)
+        lines += ['{}={}'.format(key, value) for key, value in six.iteritems(self) if key not in last]
+        return ''.join(line + '\n' for line in lines)
+
+    def __setitem__(self, key, value, *args):
+        if not ENV_ASSIGNMENT.match('{}={}'.format(key, value)) or '\n' in value or '\r' in value:
+            abort('{!r} can not be written to .env'.format('{}={}'.format(key, value)))
+        OrderedDict.__setitem__(self, key, value, *args)
+
+
+def parse_environment(content, digest='-'):
+    """
+    Parse .env content, values of secret variables and passwords of URLs are registered for redaction.
+    """
+    environment = Environment(content, digest)
+    register_environment(environment)
+    return environment
 
-    def write(self, data):
-        for filter in self.filters:
-            data = data.replace(filter, '********')
-        self.stream.write(data)
-        self.stream.flush()
 
-    def flush(self):
-        self.stream.flush()
+def load_environment_dict(username):
+    environment = load_environment_dicts([username]).get(username)
+    if environment is None:
+        abort('{}: .env not found'.format(username))
+    return environment
+
+
+def render_environment(env_dict):
+    if isinstance(env_dict, Environment):
+        return env_dict.render()
+    return ''.join('{}={}\n'.format(k, v) for k, v in six.iteritems(env_dict))
+
+
+def load_environment_dicts(project_names=None):
+    """
+    Read .env of many projects (all projects when project_names is None) in one round trip.
+    Returns OrderedDict project name -> Environment, projects without .env are omitted.
+    """
+    output = run_script(load_environments_script, *(project_names or []))
+    env_dicts = OrderedDict()
+    digests = {}
+    name = None
+    for line in output.splitlines():
+        if line.startswith('@@'):
+            name, digest = (line[2:].strip().split(' ', 1) + ['-'])[:2]
+            env_dicts[name] = ''
+            digests[name] = digest
+        elif name is not None:
+            env_dicts[name] += line + '\n'
+    return OrderedDict((name, parse_environment(content, digests[name])) for name, content in env_dicts.items())
+
+
+def store_environment_dicts(env_dicts):
+    """
+    Write .env of many projects, each atomically: new content goes to temporary file in project folder which
+    is renamed over .env, previous .env is kept as one of last ENV_VERSIONS versions. .env changed by someone
+    else since it was read is not overwritten. One round trip, contents are sent over stdin.
+    Returns names of projects whose .env was written.
+    """
+    args = []
+    contents = []
+    for project_name, env_dict in env_dicts.items():
+        content = render_environment(env_dict).encode('utf-8')
+        args += [project_name, getattr(env_dict, 'digest', '-'), hashlib.sha256(content).hexdigest()]
+        contents.append(base64.b64encode(content).decode('ascii') + '\n')
+    output = run_script(store_environments_script, str(ENV_VERSIONS), *args, stdin=''.join(contents))
+    results = dict(reversed(line[2:].split(' ', 1)) for line in output.splitlines()
+                   if line.startswith('@@') and ' ' in line)
+    stored = []
+    for project_name in env_dicts:
+        if results.get(project_name) == 'stored':
+            stored.append(project_name)
+        elif results.get(project_name) == 'conflict':
+            puts(red('{}: .env was changed meanwhile, not written'.format(project_name)))
+        else:
+            puts(red('{}: .env could not be written'.format(project_name)))
+    return stored
 
-    def __enter__(self):
-        sys.stdout = self
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        sys.stdout = self.stream
+def store_environment_dict(username, env_dict):
+    if username not in store_environment_dicts({username: env_dict}):
+        abort('{}: .env was not written'.format(username))
 
 
-def load_environment_dict(username):
-    env_file = StringIO()
-    get('/home/{username}/{username}/.env'.format(username=username), env_file, use_sudo=True, temp_dir='/tmp')
-    env_lines = env_file.getvalue().split()
-    return dict((line.split('=')[0], line.split('=')[1]) for line in env_lines)
+def list_environment_versions(project_name):
+    """
+    Saved versions of .env, newest first.
+    """
+    return run_script(env_versions_script, 'list', project_name).split()
 
 
-def store_environment_dict(username, env_dict):
-    value = ''
-    for k, v in six.iteritems(env_dict):
-        value += '{}={}\n'.format(k, v)
-    env_file = StringIO(value)
-    put(env_file, '/tmp/.env')
-    home_folder = '/home/{username}'.format(username=username)
-    with cd(home_folder), settings(sudo_user=username), shell_env(HOME=home_folder):
-        sudo('yes | cp /tmp/.env /home/{username}/{username}/.env'.format(username=username))
-        sudo('chmod 0600 /home/{username}/{username}/.env'.format(username=username))
+def rollback_environment(project_name, version=None):
+    """
+    Put saved version of .env (newest one by default) back in place, current .env is saved as newest version,
+    so rolling back twice undoes rollback. Returns restored version, None when it is the same as current .env.
+    """
+    if version and not re.match(r'^[0-9.-]+$', version):
+        abort('{}: bad version {}'.format(project_name, version))
+    output = run_script(env_versions_script, 'rollback', project_name, version or '', str(ENV_VERSIONS)).strip()
+    if output.startswith('@@missing'):
+        abort('{}: no saved version {}of .env'.format(project_name, version + ' ' if version else ''))
+    if not output.startswith(('@@restored', '@@unchanged')):
+        abort('{}: .env could not be restored: {}'.format(project_name, output))
+    return output.split(' ', 1)[1] if output.startswith('@@restored') else None
 
 
 ###################
 
 
 def load_domain_list(project_name):
-    home_folder = '/home/{project_name}'.format(project_name=project_name)
-    remote_domain_file_path = '{home_folder}/.domains'.format(home_folder=home_folder)
-    if exists(remote_domain_file_path):
-        domain_file = StringIO()
-        get(remote_domain_file_path, domain_file, use_sudo=True, temp_dir='/tmp')
-        return domain_file.getvalue().split()
-    return []
+    remote_domain_file_path = '/home/{project_name}/.domains'.format(project_name=project_name)
+    with hide('running', 'output'):
+        content = sudo('cat {path} 2>/dev/null || true'.format(path=remote_domain_file_path), pty=False,
+                       combine_stderr=False)
+    return content.split()
 
 
 def store_domain_list(project_name, domain_list):
@@ -188,45 +770,48 @@ def store_domain_list(project_name, domain_list):
         sudo('chmod 0600 {remote_domain_file_path}'.format(remote_domain_file_path=remote_domain_file_path))
 
 
-def add_domain(project_name, domain):
-    domain_list = load_domain_list(project_name)
+def add_domain(project_name, domain, snapshot=None):
+    domain_list = load_domain_list(project_name) if snapshot is None else list(snapshot.domains)
     if isinstance(domain, six.string_types):
         domain_list.append(domain)
     else:
         domain_list = domain_list + domain
     store_domain_list(project_name, domain_list)
+    if snapshot is not None:
+        snapshot.domains = domain_list
 
 
-def remove_domain(project_name, domain):
-    domain_list = load_domain_list(project_name)
+def remove_domain(project_name, domain, snapshot=None):
+    domain_list = load_domain_list(project_name) if snapshot is None else list(snapshot.domains)
     if isinstance(domain, six.string_types):
         domain = [domain]
     domain_list = [d for d in domain_list if d not in domain]
     store_domain_list(project_name, domain_list)
+    if snapshot is not None:
+        snapshot.domains = domain_list
 
 #######################
 
 
-def get_project_type(project_name):
+def get_project_type(project_name, snapshot=None):
+    if snapshot is None:
+        snapshot = take_snapshot(project_name)
     home_folder = '/home/{username}'.format(username=project_name)
     project_folder = '/home/{username}/{username}/'.format(username=project_name)
     env_path = ''
-    if exists('{project_folder}/requirements.txt'.format(project_folder=project_folder)):
-        if not exists('{home_folder}/venv'.format(home_folder=home_folder)):
-            runtime_file = StringIO()
+    if snapshot.has_requirements:
+        if not snapshot.has_venv:
             runtime = 'python-3.5'
-            if exists('{project_folder}/runtime.txt'.format(project_folder=project_folder)):
-                get('{project_folder}/runtime.txt'.format(project_folder=project_folder), runtime_file)
-                runtime = runtime_file.getvalue()[:10]
+            if snapshot.has_runtime:
+                runtime = snapshot.runtime[:10]
             if runtime == 'python-2.7':
                 sudo('virtualenv venv')
             elif runtime == 'python-3.5':
                 sudo('virtualenv venv --python=/usr/bin/python3.5')
-        sudo('{home_folder}/venv/bin/pip install -r {project_folder}/requirements.txt'.format(
-            project_folder=project_folder, home_folder=home_folder), pty=False)
+        pip_install(project_name)
         env_path = '{home_folder}/venv/bin:'.format(home_folder=home_folder) + env_path
-    if exists('{project_folder}/package.json'.format(project_folder=project_folder)):
-        if exists('{project_folder}/yarn.lock'):
+    if snapshot.has_package_json:
+        if snapshot.has_yarn_lock:
             with cd(project_folder):
                 sudo('yarn install')
         else: